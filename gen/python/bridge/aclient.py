@@ -0,0 +1,467 @@
+
+# Asynchronous client of the Python-IDL bridge server
+
+# An AsyncClient sends requests without waiting for them: each call
+# returns a Future at once, whose result is set when the response
+# arrives. Requests share a few multiplexed connections (mux.Channel), so
+# thousands of calls may be outstanding without a thread for each; at most
+# max_inflight are sent on a connection at a time (the server's limit),
+# and the rest wait in a queue.
+
+# Errors are raised, not printed: Future.result raises BridgeError with
+# the server's message, or Timeout if the call timed out. Results are as
+# for client.py: run and get give the value, run_batch (result,error) for
+# each command.
+
+# prep and other sequences of calls are written as generators (see Task)
+# that yield a Future to wait for its result, as asyncio coroutines await
+# them, and return with Return(value).
+
+# Example:
+# >>> import aclient
+# >>> bridge=aclient.AsyncClient('localhost',10000,connections=2)
+# >>> futures=[bridge.run('result=%d*2' % i) for i in range(1000)]
+# >>> for future in aclient.as_completed(futures): print(future.result())
+# >>> prepped=bridge.prep('hsi_image.fits',outdir='/tmp').result()
+# >>> bridge.close()
+
+import collections,threading
+
+MAX_INFLIGHT=32       # requests sent at a time on one connection
+
+class BridgeError(Exception):
+    pass
+
+class Timeout(BridgeError):
+    pass
+
+class Cancelled(BridgeError):
+    pass
+
+##############################################################################
+# result of a call, set once. As concurrent.futures.Future, but a
+# cancelled Future's result raises Cancelled.
+
+class Future(object):
+
+    def __init__(self):
+
+        self.event=threading.Event()
+        self.lock=threading.Lock()
+        self.value=None
+        self.error=None
+        self.callbacks=[]
+
+    def done(self):
+
+        return self.event.is_set()
+
+# fail with Cancelled unless done. Returns True if cancelled.
+
+    def cancel(self):
+
+        self.finish(None,Cancelled('Cancelled.'))
+        return isinstance(self.error,Cancelled)
+
+    def result(self,timeout=None):
+
+        if not self.event.wait(timeout): raise Timeout('Timed out waiting for result.')
+        if self.error is not None: raise self.error
+        return self.value
+
+    def exception(self,timeout=None):
+
+        if not self.event.wait(timeout): raise Timeout('Timed out waiting for result.')
+        return self.error
+
+# call callback(future) once the result is set (at once if it is)
+
+    def add_done_callback(self,callback):
+
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_result(self,value):
+
+        self.finish(value,None)
+
+    def set_exception(self,error):
+
+        self.finish(None,error)
+
+    def finish(self,value,error):
+
+        with self.lock:
+            if self.event.is_set(): return
+            self.value=value
+            self.error=error
+            self.event.set()
+            callbacks,self.callbacks=self.callbacks,[]
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                print("Error in callback: "+str(e))
+
+##############################################################################
+# Future driven by generator gen, which yields Futures and is resumed with
+# their results (or their errors raised in it) as they complete. Its result
+# is the value of Return raised by gen, or None.
+
+class Return(Exception):
+
+    def __init__(self,value=None):
+
+        Exception.__init__(self)
+        self.value=value
+
+class Task(Future):
+
+    def __init__(self,gen):
+
+        Future.__init__(self)
+        self.gen=gen
+        self.step(None,None)
+
+    def step(self,value,error):
+
+        try:
+            if error is not None:
+                future=self.gen.throw(error)
+            else:
+                future=self.gen.send(value)
+        except Return as e:
+            self.set_result(e.value)
+        except StopIteration:
+            self.set_result(None)
+        except Exception as e:
+            self.set_exception(e)
+        else:
+            future.add_done_callback(lambda f: self.step(f.value,f.error))
+
+##############################################################################
+
+class AsyncClient(object):
+
+    def __init__(self,ip='localhost',port=10000,connections=1,timeout=None,compress=None,max_inflight=MAX_INFLIGHT,verbose=False):
+
+        self.ip=ip
+        self.port=port
+        self.connections=connections
+        self.timeout=timeout          # default seconds before a call fails with Timeout
+        self.compress=compress
+        self.max_inflight=max_inflight
+        self.verbose=verbose
+        self.lock=threading.Lock()
+        self.channels=[]
+        self.opening=0                # channels being opened
+        self.inflight={}              # channel -> requests sent and not answered
+        self.sent={}                  # Future -> (channel,Call) it was sent as
+        self.queue=collections.deque()
+        self.deadlines={}             # Future -> time it times out
+        self.watchdog=None
+        self.closed=False
+
+###############################################################################
+# IDL commands and variables
+
+    def run(self,cmd,is_function=0,timeout=None,**keywords):
+
+        tdict={'action':'execute','command':cmd,'is_function':int(bool(is_function)),'keywords':keywords}
+        return self.request(tdict,result,timeout)
+
+    def get(self,name,timeout=None):
+
+        return self.request({'action':'get','name':name},result,timeout)
+
+    def run_batch(self,commands,stop_on_error=0,timeout=None):
+
+        import client
+        items=client.batch_items(commands)
+        if items is None: return failed(BridgeError('Invalid batch.'))
+        tdict={'action':'batch','commands':items,'stop_on_error':int(bool(stop_on_error))}
+        return self.request(tdict,batch_result,timeout)
+
+    def ping(self,wait=0,timeout=None):
+
+        return self.request({'action':'ping','wait':wait},lambda call: call.header,timeout)
+
+###############################################################################
+# files. upload is queued as other calls, and the file sent when its turn
+# comes, unless the server takes it by path (see tools.connect). Its result
+# is the location of the file on the server. download's result is the name
+# of the local file, in outdir (current directory by default).
+
+    def upload(self,filename,timeout=None):
+
+        import os
+        import tools
+        filename=tools.expand_name(filename)
+        if not os.path.isfile(filename): return failed(BridgeError('Non-existent file: '+filename))
+        tdict={'action':'upload','filename':os.path.basename(filename),'size':os.path.getsize(filename)}
+        return self.request(tdict,lambda call: str(call.header['filename']),timeout,upload=filename)
+
+    def download(self,filename,outdir=None,timeout=None):
+
+        import os
+        import mux
+        if outdir is None: outdir=os.getcwd()
+        try:
+            if not os.path.isdir(outdir): os.makedirs(outdir)
+        except OSError as e:
+            return failed(BridgeError(str(e)))
+        local=os.path.join(outdir,os.path.basename(filename))
+        def complete(call):
+            path,error=mux.finish_download(call,local,outdir,filename)
+            if error: raise BridgeError(error)
+            return path
+        tdict={'action':'download','filename':filename,'link':1}
+        return self.request(tdict,complete,timeout,outfile=local+'.part')
+
+# prep file (local or URL) on server and download result to outdir, as
+# client.prep_file. The result is the name of the prepped file.
+
+    def prep(self,file,outdir=None,timeout=None):
+
+        import os
+        import tools
+        if outdir is None: outdir=os.getcwd()
+        if tools.valid_url(file):
+            fetched=self.request({'action':'url','url':file},lambda call: (str(call.header['filename']),str(call.header['name'])),timeout)
+        else:
+            fetched=self.upload(file,timeout)
+        return Task(self.prep_steps(file,fetched,outdir,timeout))
+
+    def prep_steps(self,file,fetched,outdir,timeout):
+
+        import os,urlparse
+        try:
+            tdir=yield self.request({'action':'session','name':'prep'},lambda call: str(call.header['dir']),timeout)
+        except BridgeError:
+            tdir=yield self.run('result=session_dir("prep",/new)',is_function=True,timeout=timeout)
+        outfile='prepped_'+os.path.basename(file)
+        try:
+            location=yield fetched
+        except BridgeError:
+            if not urlparse.urlparse(file).scheme: raise
+            location=file
+        if type(location) == tuple:
+            location,name=location
+            outfile='prepped_'+name
+        prep_cmd='prep_file,"'+location+'",out_dir="'+tdir+'",err=err'
+        yield self.run(prep_cmd,timeout=timeout)
+        try:
+            prepped=yield self.download(os.path.join(tdir,outfile),outdir,timeout)
+        except BridgeError as e:
+            raise BridgeError('Prep failed: '+str(e))
+        raise Return(prepped)
+
+###############################################################################
+# queue request tdict (sending file upload after it). Returns Future whose
+# result is convert(call) once the response arrives.
+
+    def request(self,tdict,convert,timeout=None,outfile=None,upload=None):
+
+        future=Future()
+        if self.closed:
+            future.set_exception(BridgeError('Client closed.'))
+            return future
+        self.watch(future,timeout)
+        with self.lock:
+            self.queue.append((tdict,convert,outfile,upload,future))
+        self.dispatch()
+        return future
+
+# send queued requests while a connection has room. A request's place on
+# its connection is given up when its Future is done, whether answered,
+# timed out or cancelled (see release).
+
+    def dispatch(self):
+
+        import os,socket
+        import tools
+        while True:
+            with self.lock:
+                if not self.queue: return
+                tdict,convert,outfile,upload,future=self.queue[0]
+                if future.done():
+                    self.queue.popleft()
+                    continue
+            try:
+                channel=self.channel()
+            except (IOError,socket.error) as e:
+                with self.lock:
+                    pending,self.queue=list(self.queue),collections.deque()
+                for item in pending: item[4].set_exception(BridgeError(str(e)))
+                return
+            with self.lock:
+                if channel is None or not self.queue or self.queue[0][4] is not future: return
+                self.queue.popleft()
+                self.inflight[channel]=self.inflight.get(channel,0)+1
+            if upload and tools.is_unix(channel.sock):
+                tdict={'action':'link','filename':os.path.abspath(upload)}
+                upload=None
+            call=channel.begin(tdict,outfile,upload)
+            with self.lock:
+                self.sent[future]=(channel,call)
+            future.add_done_callback(self.release)
+            call.add_callback(lambda call,convert=convert,future=future: self.finish(call,future,convert))
+
+    def finish(self,call,future,convert):
+
+        if not call.error and call.header: call.error=str(call.header.get('error',''))
+        if call.error:
+            future.set_exception(BridgeError(call.error))
+        else:
+            try:
+                future.set_result(convert(call))
+            except Exception as e:
+                future.set_exception(e if isinstance(e,BridgeError) else BridgeError(str(e)))
+
+# free the place of sent future on its connection, dropping its call if
+# it is still waiting for the response, and send the next request
+
+    def release(self,future):
+
+        with self.lock:
+            channel,call=self.sent.pop(future,(None,None))
+            self.deadlines.pop(future,None)
+            if channel: self.inflight[channel]=self.inflight.get(channel,1)-1
+        if call: channel.forget(call,str(future.error or 'Cancelled.'))
+        self.dispatch()
+
+# least busy open channel with room, opening one (outside the lock, as
+# the readers' callbacks take it) if all are busy and there are fewer than
+# connections. Returns None if all are full or being opened.
+
+    def channel(self):
+
+        import mux
+        with self.lock:
+            for channel in [c for c in self.channels if c.closed]:
+                self.channels.remove(channel)
+                self.inflight.pop(channel,None)
+            channels=sorted(self.channels,key=lambda c: self.inflight.get(c,0))
+            opened=len(channels)+self.opening
+            if channels and (self.inflight.get(channels[0],0) == 0 or opened >= self.connections):
+                if self.inflight.get(channels[0],0) >= self.max_inflight: return None
+                return channels[0]
+            if opened >= self.connections: return None
+            self.opening += 1
+        channel=None
+        try:
+            channel=mux.open_channel(self.ip,self.port,compress=self.compress,verbose=self.verbose)
+        finally:
+            with self.lock:
+                self.opening -= 1
+                if channel is not None: self.channels.append(channel)
+        return channel
+
+###############################################################################
+# fail future with Timeout after timeout seconds (the client's by default).
+# One thread checks the deadlines of all calls, while there are any.
+
+    def watch(self,future,timeout):
+
+        import time
+        if timeout is None: timeout=self.timeout
+        if timeout is None: return
+        with self.lock:
+            self.deadlines[future]=time.time()+timeout
+            if self.watchdog is None:
+                self.watchdog=threading.Thread(target=self.expire)
+                self.watchdog.daemon=True
+                self.watchdog.start()
+
+    def expire(self):
+
+        import time
+        while True:
+            time.sleep(0.1)
+            now=time.time()
+            with self.lock:
+                if self.closed or not self.deadlines:
+                    self.watchdog=None
+                    return
+                expired=[f for f,deadline in self.deadlines.items() if deadline <= now]
+                for future in expired: del self.deadlines[future]
+            for future in expired: future.set_exception(Timeout('Timed out.'))
+
+    def close(self):
+
+        self.closed=True
+        with self.lock:
+            channels,self.channels=self.channels,[]
+            pending,self.queue=list(self.queue),collections.deque()
+        for item in pending: item[4].set_exception(BridgeError('Client closed.'))
+        for channel in channels: channel.close()
+
+##############################################################################
+# results of calls
+
+def result(call):
+
+    import tools
+    if call.header.get('type') != 'array': return str(call.header['result'])
+    value=tools.make_array(call.header,call.payloads[0] if call.payloads else b'')
+    if value is None: raise BridgeError('Error reading array result.')
+    return value
+
+def batch_result(call):
+
+    import tools
+    payloads=list(call.payloads)
+    response=[]
+    for header in call.header['results']:
+        value=str(header['result'])
+        if header.get('type') == 'array':
+            payload=b''
+            if not header.get('shm'): payload=payloads.pop(0)
+            value=tools.make_array(header,payload)
+        response.append((value,str(header['error'])))
+    return response
+
+def failed(error):
+
+    future=Future()
+    future.set_exception(error)
+    return future
+
+##############################################################################
+# iterate over futures as they complete, for up to timeout seconds
+
+def as_completed(futures,timeout=None):
+
+    import time,Queue
+    done=Queue.Queue()
+    futures=list(futures)
+    for future in futures: future.add_done_callback(done.put)
+    deadline=None
+    if timeout is not None: deadline=time.time()+timeout
+    for i in range(len(futures)):
+        wait=1.
+        if deadline is not None:
+            wait=deadline-time.time()
+            if wait <= 0: raise Timeout('Timed out waiting for results.')
+        while True:
+            try:
+                yield done.get(True,min(wait,1.))
+                break
+            except Queue.Empty:
+                if deadline is not None and time.time() >= deadline: raise Timeout('Timed out waiting for results.')
+
+# wait until all futures are done, or timeout seconds. Returns the futures
+# that are done.
+
+def wait(futures,timeout=None):
+
+    futures=list(futures)
+    done=[]
+    try:
+        for future in as_completed(futures,timeout): done.append(future)
+    except Timeout:
+        pass
+    return done
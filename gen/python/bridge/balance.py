@@ -0,0 +1,201 @@
+
+# Load balancing of client requests across Python-IDL bridge servers
+
+# Client calls given servers=[(ip,port),...] (or 'host:port' strings) are
+# sent to one of them, chosen by policy:
+
+# least - server with fewest requests outstanding from this client (default)
+# hash  - consistent hashing on pin, or on the command or file name, so the
+#         same key goes to the same server while the server list is the same
+
+# A server that cannot be connected to is ejected for EJECT_TIME seconds
+# (doubling with each further failure, up to EJECT_MAX), and the request is
+# tried on another server. Requests that reached a server are not retried.
+
+# Requests that depend on data held by one server stay on it: files
+# uploaded, and jobs submitted, are pinned to the server that holds them,
+# so later downloads from the same directory and status/wait/fetch of the
+# job go there. client.tprep runs its whole upload, prep and download
+# sequence on one server. Calls given pin=key are sent to the server the
+# key hashes to.
+
+# Example:
+# >>> servers=['host1:10000','host2:10000']
+# >>> client.run('result=session_dir("prep",/new)',is_function=1,servers=servers)
+# >>> client.tprep(file,servers=servers)
+# >>> for f,out,err in client.prep_many(files,servers=servers): ...
+
+import collections,threading
+
+EJECT_TIME=5.
+EJECT_MAX=300.
+REPLICAS=100          # points per server on hash ring
+MAX_PINS=10000
+
+##############################################################################
+# health of servers, shared by all balancers: (ip,port) -> (ejected until,
+# number of failures). Updated by client.request on each connection.
+
+health={}
+health_lock=threading.Lock()
+
+def mark_down(server):
+
+    import time
+    with health_lock:
+        until,failures=health.get(server,(0.,0))
+        eject=min(EJECT_TIME*2**failures,EJECT_MAX)
+        health[server]=(time.time()+eject,failures+1)
+
+def mark_up(server):
+
+    if server not in health: return
+    with health_lock:
+        health.pop(server,None)
+
+def is_down(server):
+
+    import time
+    entry=health.get(server)
+    return entry is not None and entry[0] > time.time()
+
+##############################################################################
+
+class Balancer(object):
+
+    def __init__(self,servers,policy='least'):
+
+        import bisect
+        self.servers=[parse(s) for s in servers]
+        self.policy=policy
+        self.lock=threading.Lock()
+        self.outstanding=dict([(s,0) for s in self.servers])
+        self.pins=collections.OrderedDict()        # data location or job -> server
+        self.next=0
+        self.ring=[]
+        for server in self.servers:
+            for i in range(REPLICAS):
+                bisect.insort(self.ring,(hash_key('%s:%s#%d' % (server+(i,))),server))
+
+###############################################################################
+# choose server for request, not one of exclude. Returns None if all servers
+# are down or excluded.
+
+    def choose(self,key=None,exclude=()):
+
+        import bisect
+        candidates=[s for s in self.servers if s not in exclude and not is_down(s)]
+        if not candidates: return None
+        if key is not None and (self.policy == 'hash' or isinstance(key,Pin)):
+            start=bisect.bisect(self.ring,(hash_key(key),))
+            for i in range(len(self.ring)):
+                server=self.ring[(start+i) % len(self.ring)][1]
+                if server in candidates: return server
+        with self.lock:
+            fewest=min([self.outstanding[s] for s in candidates])
+            least=[s for s in candidates if self.outstanding[s] == fewest]
+            self.next += 1
+            return least[self.next % len(least)]
+
+    def begin(self,server):
+
+        with self.lock:
+            self.outstanding[server] += 1
+
+    def end(self,server):
+
+        with self.lock:
+            self.outstanding[server] -= 1
+
+# server holding data at location (file directory or job id), or None
+
+    def pinned(self,location):
+
+        with self.lock:
+            return self.pins.get(location)
+
+    def pin(self,location,server):
+
+        with self.lock:
+            self.pins.pop(location,None)
+            self.pins[location]=server
+            while len(self.pins) > MAX_PINS: self.pins.popitem(last=False)
+
+##############################################################################
+# key given by caller with pin=, which always selects server by hashing
+
+class Pin(str):
+    pass
+
+##############################################################################
+# balancers by server list and policy
+
+balancers={}
+
+def get(servers,policy='least'):
+
+    key=(tuple([parse(s) for s in servers]),policy)
+    with health_lock:
+        balancer=balancers.get(key)
+        if balancer is None: balancer=balancers[key]=Balancer(servers,policy)
+    return balancer
+
+##############################################################################
+# call func(*args,**kwargs) on a server chosen from kwargs['servers'], trying
+# other servers if it cannot connect (and failed(result) is true; by default
+# if result is None). If location is pinned to a server, only that server 
+# is used. If record is given, record(result) returns the location of data
+# the call left on the server (or None), which is pinned to it.
+
+def call(func,args,kwargs,key=None,location=None,record=None,failed=None):
+
+    kwargs=kwargs.copy()
+    servers=kwargs.pop('servers')
+    balancer=get(servers,kwargs.pop('balance','least'))
+    if 'pin' in kwargs: 
+        key=kwargs.pop('pin')
+        if isinstance(key,unicode): key=key.encode('utf-8')
+        key=Pin(key)
+    pinned=None
+    if location is not None: pinned=balancer.pinned(location)
+    tried=[]
+    while True:
+        server=pinned or balancer.choose(key,exclude=tried)
+        if server is None:
+            print("No Python-IDL server available.")
+            return None
+        kwargs['ip'],kwargs['port']=server
+        balancer.begin(server)
+        try:
+            result=func(*args,**kwargs)
+        finally:
+            balancer.end(server)
+        if failed is None: 
+            error=result is None
+        else:
+            error=failed(result)
+        if error and is_down(server) and not pinned:
+            tried.append(server)
+            continue
+        if record and not error:
+            data=record(result)
+            if data: balancer.pin(data,server)
+        return result
+
+##############################################################################
+
+def parse(server):
+
+    if type(server) in (str,unicode):
+        ip,sep,port=server.rpartition(':')
+        if not sep: return (server,10000)
+        return (ip,int(port))
+    return (server[0],int(server[1]))
+
+# hash of key (unicode keys as UTF-8) for the hash ring
+
+def hash_key(key):
+
+    import hashlib
+    if isinstance(key,unicode): key=key.encode('utf-8')
+    return int(hashlib.md5(str(key)).hexdigest()[:15],16)
@@ -0,0 +1,357 @@
+
+# Benchmarks for the Python-IDL bridge
+
+# Runs the server with the stand-in IDL backend (fakeidl.py) on localhost
+# and measures, through the client:
+
+# latency     - round trip of client.run, with string and array results,
+#               and of client.ping (no IDL)
+# transfer    - upload and download throughput across file sizes, over
+#               TCP (upload.*, download.*) and over the local transport
+#               (local.*), which hands files over by path
+# concurrency - requests per second with several clients at once against
+#               a pool of worker processes
+# tprep       - end-to-end client.tprep (upload, prep, download)
+# prep_many   - files prepped per second by client.prep_many with 1 to 
+#               --workers files at once against a pool of worker processes
+# overhead    - IDL statements run per command besides the command itself,
+#               in lean and full (lean=False) execution, with a cost per 
+#               call to the IDL session (--call_cost)
+
+# Results are printed and appended as one JSON record per run to the output
+# file, so runs before and after a change can be compared.
+
+# Usage:
+# python bench.py                    full run
+# python bench.py --quick            smaller files and fewer repeats
+# python bench.py --only latency,tprep
+# python bench.py --compare          compare with previous run in output file
+
+SIZES=[1024,1048576,16*1048576,64*1048576]
+QUICK_SIZES=[1024,1048576,8*1048576]
+CLIENTS=[1,2,4,8]
+OUTPUT='bench_output.txt'
+
+class Quiet(object):
+
+# discard output of client and server (printing would be timed too)
+
+    def write(self,data):
+        pass
+
+    def flush(self):
+        pass
+
+    def __enter__(self):
+        import sys
+        self.stdout=sys.stdout
+        sys.stdout=self
+        return self
+
+    def __exit__(self,*args):
+        import sys
+        sys.stdout=self.stdout
+
+##############################################################################
+# start server with fake IDL on free port. Returns (port,thread).
+
+def start_server(**kwargs):
+
+    import socket,time
+    import server,client
+    sock=socket.socket()
+    sock.bind(('localhost',0))
+    port=sock.getsockname()[1]
+    sock.close()
+    options={'delay':kwargs.pop('delay',0.),'overhead':kwargs.pop('call_cost',0.)}
+    with Quiet():
+        thread=server.start(port=port,backend='fakeidl',backend_options=options,**kwargs)
+        tstart=time.time()
+        while time.time()-tstart < 30:
+            status=client.ping(wait=30,port=port)
+            if status and status['ready']: break
+            time.sleep(0.1)
+    return (port,thread)
+
+def stop_server(port,thread):
+
+    import server,pool
+    with Quiet():
+        pool.clear()
+        server.stop(port=port)
+        thread.join(30)
+
+##############################################################################
+# summary of times in seconds as milliseconds
+
+def summary(name,times):
+
+    times=sorted(times)
+    n=len(times)
+    def pct(q): return times[min(n-1,int(q*n))]*1000.
+    return {name+'.mean_ms':sum(times)/n*1000.,name+'.p50_ms':pct(.5),
+            name+'.p90_ms':pct(.9),name+'.p99_ms':pct(.99)}
+
+def timed(func,count):
+
+    import time
+    times=[]
+    for i in range(count):
+        tstart=time.time()
+        func()
+        times.append(time.time()-tstart)
+    return times
+
+##############################################################################
+
+def bench_latency(count):
+
+    import client
+    port,thread=start_server()
+    results={}
+    try:
+        with Quiet():
+            for i in range(20): client.run("result='x'",port=port)
+            client.stats(reset=True,port=port)
+            times=timed(lambda: client.run("result='x'",port=port),count)
+            stats=client.stats(port=port)
+            results.update(summary('latency.run',times))
+            results['latency.run.server_ms']=stats['actions']['execute']['latency']['mean']*1000.
+            results['latency.run.idl_ms']=stats['timers']['idl']['mean']*1000.
+            results['latency.run.overhead_ms']=stats['timers']['overhead']['mean']*1000.
+            times=timed(lambda: client.run("result=fake_array(100000)",port=port),count)
+            results.update(summary('latency.run_array',times))
+            times=timed(lambda: client.ping(port=port),count)
+            results.update(summary('latency.ping',times))
+    finally:
+        stop_server(port,thread)
+    return results
+
+##############################################################################
+# upload and download files of random bytes, in MB/s (median of repeat)
+
+def bench_transfer(sizes,repeat):
+
+    results={}
+    results.update(transfer_rates(sizes,repeat,'',unix_socket=False))
+    results.update(transfer_rates(sizes,repeat,'local.'))
+    return results
+
+def transfer_rates(sizes,repeat,prefix,**options):
+
+    import os,shutil,tempfile,time
+    import client
+    port,thread=start_server(**options)
+    tdir=tempfile.mkdtemp(prefix='bench_')
+    outdir=os.path.join(tdir,'out')
+    os.mkdir(outdir)
+    results={}
+    try:
+        for size in sizes:
+            filename=os.path.join(tdir,'bench_%d.dat' % size)
+            with open(filename,'wb') as f: f.write(os.urandom(size))
+            label=size_label(size)
+            up=[] ; down=[]
+            with Quiet():
+                for i in range(repeat):
+                    tstart=time.time()
+                    location=client.upload(filename,port=port,cache=False)
+                    up.append(time.time()-tstart)
+                    if location: os.remove(location)
+                    tstart=time.time()
+                    client.download(filename,port=port,outdir=outdir)
+                    down.append(time.time()-tstart)
+                    os.remove(os.path.join(outdir,os.path.basename(filename)))
+            results[prefix+'upload.'+label+'.MBps']=size/median(up)/1048576.
+            results[prefix+'download.'+label+'.MBps']=size/median(down)/1048576.
+            os.remove(filename)
+    finally:
+        stop_server(port,thread)
+        shutil.rmtree(tdir,True)
+    return results
+
+##############################################################################
+# clients in threads each running count commands taking delay seconds
+
+def bench_concurrency(clients,workers,count,delay):
+
+    import threading,time
+    import client
+    port,thread=start_server(workers=workers,delay=delay)
+    results={}
+    try:
+        with Quiet():
+            for nclients in clients:
+                times=[]
+                def run():
+                    times.extend(timed(lambda: client.run("result='x'",port=port),count))
+                threads=[threading.Thread(target=run) for i in range(nclients)]
+                tstart=time.time()
+                for t in threads: t.start()
+                for t in threads: t.join()
+                elapsed=time.time()-tstart
+                label='concurrency.%dclients' % nclients
+                results[label+'.rps']=len(times)/elapsed
+                results.update(summary(label,times))
+    finally:
+        stop_server(port,thread)
+    return results
+
+##############################################################################
+
+def bench_prep_many(nfiles,workers,delay):
+
+    import os,shutil,tempfile,time
+    import client
+    port,thread=start_server(workers=workers,delay=delay)
+    tdir=tempfile.mkdtemp(prefix='bench_')
+    outdir=os.path.join(tdir,'out')
+    os.mkdir(outdir)
+    files=[]
+    for i in range(nfiles):
+        filename=os.path.join(tdir,'hsi_l0_bench%d.fits' % i)
+        with open(filename,'wb') as f: f.write(os.urandom(65536))
+        files.append(filename)
+    results={}
+    try:
+        max_workers=1
+        while max_workers <= workers:
+            with Quiet():
+                tstart=time.time()
+                for file,output,error in client.prep_many(files,max_workers=max_workers,port=port,outdir=outdir):
+                    if output: os.remove(output)
+                elapsed=time.time()-tstart
+            results['prep_many.%dworkers.files_per_s' % max_workers]=nfiles/elapsed
+            max_workers *= 2
+    finally:
+        stop_server(port,thread)
+        shutil.rmtree(tdir,True)
+    return results
+
+##############################################################################
+# run with keywords, recording client latency and server IDL overhead
+
+def bench_overhead(count,call_cost):
+
+    import client
+    results={}
+    for lean in (True,False):
+        port,thread=start_server(lean=lean,call_cost=call_cost)
+        label='overhead.'+('lean' if lean else 'full')
+        try:
+            with Quiet():
+                client.run("result='x'",port=port)
+                client.stats(reset=True,port=port)
+                times=timed(lambda: client.run("result=fake_string(10)",is_function=True,port=port,n=1),count)
+                stats=client.stats(port=port)
+            results[label+'.mean_ms']=sum(times)/len(times)*1000.
+            results[label+'.idl_overhead_ms']=stats['timers']['overhead']['mean']*1000.
+        finally:
+            stop_server(port,thread)
+    return results
+
+##############################################################################
+
+def bench_tprep(size,repeat):
+
+    import os,shutil,tempfile,time
+    import client
+    port,thread=start_server()
+    tdir=tempfile.mkdtemp(prefix='bench_')
+    filename=os.path.join(tdir,'hsi_l0_bench.fits')
+    with open(filename,'wb') as f: f.write(os.urandom(size))
+    outdir=os.path.join(tdir,'out')
+    os.mkdir(outdir)
+    results={}
+    try:
+        for thread_mode in (False,True):
+            times=[]
+            with Quiet():
+                for i in range(repeat):
+                    tstart=time.time()
+                    client.tprep(filename,port=port,outdir=outdir,thread=thread_mode)
+                    times.append(time.time()-tstart)
+                    os.remove(os.path.join(outdir,'prepped_'+os.path.basename(filename)))
+            label='tprep.'+size_label(size)+('.thread' if thread_mode else '')
+            results[label+'.s']=median(times)
+    finally:
+        stop_server(port,thread)
+        shutil.rmtree(tdir,True)
+    return results
+
+##############################################################################
+
+def median(values):
+
+    values=sorted(values)
+    return values[len(values)//2]
+
+def size_label(size):
+
+    if size >= 1048576: return '%dMB' % (size//1048576)
+    return '%dKB' % (size//1024)
+
+##############################################################################
+# print results, and change from previous results if given
+
+def report(results,previous=None):
+
+    for name in sorted(results):
+        line='%-40s %12.3f' % (name,results[name])
+        if previous and previous.get(name):
+            before=previous[name]
+            line += '   was %12.3f  (%+.1f%%)' % (before,(results[name]-before)/before*100.)
+        print(line)
+
+def load_previous(output):
+
+    import json,os
+    if not os.path.isfile(output): return None
+    record=None
+    with open(output) as f:
+        for line in f:
+            if line.strip(): record=json.loads(line)
+    if record: return record['results']
+    return None
+
+def save(results,options,output):
+
+    import json,platform,sys,time
+    record={'time':time.strftime('%Y-%m-%dT%H:%M:%S'),'host':platform.node(),
+            'python':sys.version.split()[0],'options':options,'results':results}
+    with open(output,'a') as f: f.write(json.dumps(record,sort_keys=True)+'\n')
+
+##############################################################################
+
+def main(args=None):
+
+    import argparse
+    parser=argparse.ArgumentParser(description='Benchmark Python-IDL bridge with fake IDL backend.')
+    parser.add_argument('--quick',action='store_true',help='smaller files and fewer repeats')
+    parser.add_argument('--only',default='latency,transfer,concurrency,tprep,prep_many,overhead',help='comma-separated benchmarks to run')
+    parser.add_argument('--workers',type=int,default=4,help='worker processes for concurrency benchmark')
+    parser.add_argument('--delay',type=float,default=0.01,help='IDL command time in concurrency benchmark')
+    parser.add_argument('--call_cost',type=float,default=0.0005,help='time per IDL call in overhead benchmark')
+    parser.add_argument('--output',default=OUTPUT,help='file to append results to')
+    parser.add_argument('--compare',action='store_true',help='show change from previous run in output file')
+    opts=parser.parse_args(args)
+
+    count=200 ; repeat=5 ; sizes=SIZES ; prep_size=16*1048576
+    if opts.quick: count=50 ; repeat=2 ; sizes=QUICK_SIZES ; prep_size=1048576
+    only=opts.only.split(',')
+    results={}
+    if 'latency' in only: results.update(bench_latency(count))
+    if 'transfer' in only: results.update(bench_transfer(sizes,repeat))
+    if 'concurrency' in only: results.update(bench_concurrency(CLIENTS,opts.workers,count//10,opts.delay))
+    if 'tprep' in only: results.update(bench_tprep(prep_size,repeat))
+    if 'prep_many' in only: results.update(bench_prep_many(count//10,opts.workers,opts.delay))
+    if 'overhead' in only: results.update(bench_overhead(count//4,opts.call_cost))
+
+    previous=None
+    if opts.compare: previous=load_previous(opts.output)
+    report(results,previous)
+    save(results,vars(opts),opts.output)
+    return results
+
+if __name__ == "__main__":
+    main()
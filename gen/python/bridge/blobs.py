@@ -0,0 +1,295 @@
+
+# Content-addressed store of uploaded files for the Python-IDL bridge server
+
+# Uploaded files are kept under the SHA-1 hash of their contents, so that a
+# client re-sending the same file (e.g. re-prepping a Level-0 file with
+# different options) can ask for it by hash and skip the transfer. The
+# store is bounded in size; least recently used files are removed first.
+
+# Files are hard-linked (copied if links are not supported) out of the
+# store into a new temporary directory under their original name, so each
+# request still gets its own path. Stored files are made read-only.
+
+# Uploads of files with a known hash are written to digest.part in the
+# store, so an interrupted upload can be resumed from the bytes already
+# received. Partial files unused for PART_AGE seconds are removed. The
+# hash of an interrupted upload's bytes is kept in memory (keyed by the
+# partial file's inode, size and modification time), so resuming does not
+# read the partial file again.
+
+# Example:
+# >>> store=blobs.BlobStore('/tmp/bridge_blobs',max_bytes=10*1024**3)
+# >>> path=store.checkout(digest,'hsi_l0.fits')     '' if not held
+# >>> store.add(digest,uploaded_file)
+
+import collections
+
+HASH='sha1'
+CHUNK=1048576
+PART_AGE=86400
+
+class BlobStore(object):
+
+    def __init__(self,root,max_bytes):
+
+        import os,time
+        self.root=root
+        self.max_bytes=max_bytes
+        self.entries=collections.OrderedDict()     # digest -> size, oldest first
+        self.total=0
+        self.partials=set()                        # digests being uploaded
+        self.part_hashes={}                        # digest -> (file_key,hash) of partial file
+        if not os.path.isdir(root): os.makedirs(root)
+        found=[]
+        now=time.time()
+        for name in os.listdir(root):
+            path=os.path.join(root,name)
+            if not os.path.isfile(path): continue
+            st=os.stat(path)
+            if name.endswith('.part'):
+                if now-st.st_mtime > PART_AGE: os.remove(path)
+                continue
+            if not valid_digest(name): continue
+            found.append((st.st_mtime,name,st.st_size))
+        for mtime,name,size in sorted(found):
+            self.entries[name]=size
+            self.total += size
+        self.evict()
+
+    def path(self,digest):
+
+        import os
+        return os.path.join(self.root,digest)
+
+###############################################################################
+# return path of new copy of file with hash digest, named filename, or ''
+# if the file is not in the store
+
+    def checkout(self,digest,filename):
+
+        import os,sys
+        import tools
+        if digest not in self.entries: return ''
+        blob=self.path(digest)
+        target=os.path.join(tools.get_temp_dir(),os.path.basename(filename))
+        try:
+            link(blob,target)
+            os.utime(blob,None)
+        except (IOError,OSError) as e:
+            print("Error reading cached file: "+str(e))
+            self.remove(digest)
+            return ''
+        size=self.entries.pop(digest)
+        self.entries[digest]=size
+        return target
+
+###############################################################################
+# add file with hash digest to store
+
+    def add(self,digest,filename):
+
+        import os
+        if not valid_digest(digest) or digest in self.entries: return
+        size=os.path.getsize(filename)
+        if size > self.max_bytes: return
+        blob=self.path(digest)
+        try:
+            link(filename,blob)
+            os.chmod(blob,0o444)
+        except (IOError,OSError) as e:
+            print("Error caching file: "+str(e))
+            return
+        self.entries[digest]=size
+        self.total += size
+        self.evict()
+
+    def remove(self,digest):
+
+        import os
+        size=self.entries.pop(digest,0)
+        self.total -= size
+        try:
+            os.remove(self.path(digest))
+        except OSError:
+            pass
+
+###############################################################################
+# partial uploads. begin returns path of partial file to write, or None if
+# the file is already being uploaded; part_size is the number of bytes 
+# received so far, and part_hash a copy of the hash object of those bytes
+# (None if not known or the file has changed).
+
+    def part_size(self,digest):
+
+        import os
+        if not valid_digest(digest) or digest in self.partials: return 0
+        try:
+            return os.path.getsize(self.path(digest)+'.part')
+        except OSError:
+            return 0
+
+    def part_hash(self,digest,size):
+
+        known=self.part_hashes.get(digest)
+        key=file_key(self.path(digest)+'.part')
+        if known is None or key is None or key != known[0] or key[1] != size: return None
+        return known[1].copy()
+
+    def keep_hash(self,digest,key,hash):
+
+        if key: self.part_hashes[digest]=(key,hash)
+
+    def begin(self,digest):
+
+        if not valid_digest(digest) or digest in self.partials: return None
+        self.partials.add(digest)
+        return self.path(digest)+'.part'
+
+# end upload, keeping partial file (and hash of its contents, if given)
+# for resuming if keep is set
+
+    def end(self,digest,keep=False,hash=None):
+
+        import os
+        self.partials.discard(digest)
+        if keep: 
+            if hash: self.keep_hash(digest,file_key(self.path(digest)+'.part'),hash.copy())
+            return
+        self.part_hashes.pop(digest,None)
+        try:
+            os.remove(self.path(digest)+'.part')
+        except OSError:
+            pass
+
+# move completed upload into store and return path of new copy named 
+# filename. Files too large to store are moved out to the copy instead.
+
+    def commit(self,digest,filename):
+
+        import os
+        import tools
+        part=self.path(digest)+'.part'
+        self.partials.discard(digest)
+        self.part_hashes.pop(digest,None)
+        size=os.path.getsize(part)
+        if digest in self.entries or size > self.max_bytes:
+            target=os.path.join(tools.get_temp_dir(),os.path.basename(filename))
+            os.rename(part,target)
+            return target
+        blob=self.path(digest)
+        os.rename(part,blob)
+        os.chmod(blob,0o444)
+        self.entries[digest]=size
+        self.total += size
+        self.evict()
+        return self.checkout(digest,filename)
+
+###############################################################################
+# remove least recently used files until store is within max_bytes
+
+    def evict(self):
+
+        while self.entries and self.total > self.max_bytes:
+            digest=next(iter(self.entries))
+            self.remove(digest)
+
+##############################################################################
+# hard-link src to dst, copying if links are not supported (e.g. another
+# file system)
+
+def link(src,dst):
+
+    import os,shutil
+    try:
+        os.link(src,dst)
+    except (AttributeError,OSError):
+        shutil.copyfile(src,dst)
+
+##############################################################################
+
+def valid_digest(digest):
+
+    import hashlib
+    size=hashlib.new(HASH).digest_size*2
+    if type(digest) not in (str,unicode) or len(digest) != size: return False
+    try:
+        int(digest,16)
+    except ValueError:
+        return False
+    return True
+
+##############################################################################
+# file object wrapper that hashes the bytes written to it
+
+class HashWriter(object):
+
+    def __init__(self,file,hash=None):
+        import hashlib
+        self.file=file
+        self.hash=hash or hashlib.new(HASH)
+
+    def write(self,data):
+        self.hash.update(data)
+        if self.file: self.file.write(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+##############################################################################
+# hash of file contents. Hashes are remembered by file name, inode, size and
+# modification time, so unchanged files are only read once. known_hash
+# returns a remembered hash without reading the file (None if there is
+# none), e.g. for the server, which hashes files in a thread.
+
+hashes={}
+
+def file_hash(filename):
+
+    digest=known_hash(filename)
+    if digest: return digest
+    digest=hash_file(filename).hexdigest()
+    remember_hash(filename,digest)
+    return digest
+
+def known_hash(filename):
+
+    import os
+    key=file_key(filename)
+    if key is None: return None
+    return hashes.get((os.path.realpath(filename),)+key)
+
+def remember_hash(filename,digest,key=None):
+
+    import os
+    key=key or file_key(filename)
+    if key: hashes[(os.path.realpath(filename),)+key]=digest
+
+# (inode,size,modification time) of file, or None if it does not exist
+
+def file_key(filename):
+
+    import os
+    try:
+        st=os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_ino,st.st_size,st.st_mtime)
+
+##############################################################################
+# hash object updated with length bytes of file from offset (to end of file
+# if length is None)
+
+def hash_file(filename,offset=0,length=None):
+
+    import hashlib
+    h=hashlib.new(HASH)
+    with open(filename,'rb') as f:
+        f.seek(offset)
+        while length is None or length > 0:
+            count=CHUNK
+            if length is not None: count=min(count,length)
+            data=f.read(count)
+            if not data: break
+            h.update(data)
+            if length is not None: length -= len(data)
+    return h
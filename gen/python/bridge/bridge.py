@@ -14,11 +14,39 @@
 # >>> a
 # array([ 0.,  1.,  2.,  3.,  4.,  5.,  6.,  7.,  8.,  9.], dtype=float32)
 
-def startup():
+# Warm start:
+# >>> IDL=bridge.startup(warm=True)
+
+# With warm=True, the environment and system variables (including !path)
+# set up by ssw_load are saved to state_file the first time, and restored
+# from it on later startups instead of running ssw_load again. The saved
+# state is used while $SSW, $SSW_INSTR and $IDL_STARTUP are unchanged and
+# it is less than STATE_TTL seconds old.
+
+# As restoring the state sets the environment and !path of the session, it
+# is kept in a directory only the user can write (STATE_DIR in the home 
+# directory, made with mode 0700), and is only used if its files (and 
+# their directory) are owned by the user and not writable by others.
+
+# The time taken by each phase of the last startup is kept in timings as a
+# list of (phase,seconds).
+
+STATE_TTL=86400
+STATE_DIR='~/.cache/pyidl_bridge'
+timings=[]
+
+def startup(warm=False,state_file=None):
    
    print("Loading Python-IDL bridge...")
-   import os
+   import os,time
    cur_dir=os.getcwd()
+   del timings[:]
+   tstart=time.time()
+   clock=[tstart]
+   def phase(name):
+     now=time.time()
+     timings.append((name,now-clock[0]))
+     clock[0]=now
    
 # check that required environmentals are defined  
   
@@ -50,10 +78,14 @@ def startup():
    cur_dir=os.getcwd()
    os.chdir(bridge_dir)
    from idlpy import IDL
+   phase('idlpy')
    
 # load preferred instruments
 
    if ssw:				
+    ssw_instr=os.environ.get('SSW_INSTR','')
+    state=None
+    if warm: state=load_state(state_file,ssw,ssw_instr,pers_start)
     try:
       ssw_instr=os.environ['SSW_INSTR']
       IDL.ssw_instr=ssw_instr
@@ -66,7 +98,14 @@ def startup():
     startup_dir=os.path.join(ssw,'gen','idl','ssw_system')
     os.chdir(startup_dir)
     IDL.run("!quiet=1")
-    IDL.run("ssw_load")
+    if state and restore_state(IDL,state):
+      phase('restore')
+    else:
+      IDL.run("ssw_load")
+      phase('ssw_load')
+      if warm: 
+        save_state(IDL,state_file,ssw,ssw_instr,pers_start)
+        phase('save')
     IDL.run("a=is_pyidl(/set)")
    
  # now load personal startup
@@ -76,9 +115,99 @@ def startup():
      os.environ['IDL_STARTUP']=pers_start
      print('Executing personal IDL_STARTUP: '+pers_start)
      IDL.run('@'+pers_start)
+     phase('personal startup')
 
    IDL.run("!quiet=0")   
    os.chdir(cur_dir)
+   timings.append(('total',time.time()-tstart))
+   print('IDL startup: '+', '.join(['%s %.2f s' % t for t in timings]))
    return IDL
 
+###############################################################################
+# Saved SSW state: state_file.json holds the environment variables set by
+# ssw_load, and state_file.sav the IDL system variables.
+
+def state_files(state_file=None):
+
+   import os
+   if not state_file:
+     state_file=os.path.join(os.path.expanduser(STATE_DIR),'ssw_state')
+   return (state_file+'.json',state_file+'.sav')
+
+# check that file (or directory) is owned by the user and not writable by
+# group or others
+
+def private(path):
+
+   import os,stat
+   try:
+     st=os.stat(path)
+   except OSError:
+     return False
+   return st.st_uid == os.getuid() and not st.st_mode & (stat.S_IWGRP|stat.S_IWOTH)
+
+# return saved state if valid for current setup, else None
+
+def load_state(state_file,ssw,ssw_instr,pers_start):
+
+   import os,json,time
+   jfile,sfile=state_files(state_file)
+   if not os.path.isfile(jfile) or not os.path.isfile(sfile): return None
+   for path in (os.path.dirname(os.path.abspath(jfile)),jfile,sfile):
+     if not private(path):
+       print('Ignoring SSW state not private to user: '+path)
+       return None
+   try:
+     with open(jfile) as f: state=json.load(f)
+   except (IOError,ValueError):
+     return None
+   if state.get('key') != [ssw,ssw_instr,pers_start]: return None
+   if time.time()-state.get('created',0) > STATE_TTL: return None
+   state['sav']=sfile
+   return state
+
+def restore_state(IDL,state):
+
+   print('Restoring saved SSW state.')
+   try:
+     IDL.ssw_env=[str(e) for e in state['env']]
+     if state['env']: IDL.run("for i=0,n_elements(ssw_env)-1 do setenv,ssw_env[i]")
+     IDL.run("restore,'"+state['sav']+"'")
+   except Exception as e:
+     print('Failed to restore SSW state: '+str(e))
+     return False
+   return True
+
+# save environment variables that ssw_load set or changed, and system 
+# variables
+
+def save_state(IDL,state_file,ssw,ssw_instr,pers_start):
+
+   import os,json,time
+   jfile,sfile=state_files(state_file)
+   try:
+     sdir=os.path.dirname(os.path.abspath(jfile))
+     if not os.path.isdir(sdir): os.makedirs(sdir,0o700)
+     if not private(sdir):
+       print('Not saving SSW state in directory not private to user: '+sdir)
+       return
+     IDL.run("ssw_env=getenv(/environment)")
+     env=[]
+     for entry in IDL.ssw_env:
+       entry=str(entry)
+       name,sep,value=entry.partition('=')
+       if sep and os.environ.get(name) != value: env.append(entry)
+
+# write to temporary files and rename, as several workers may save at once
+
+     tmp='.'+str(os.getpid())
+     IDL.run("save,/system_variables,file='"+sfile+tmp+"'")
+     os.chmod(sfile+tmp,0o600)
+     with os.fdopen(os.open(jfile+tmp,os.O_WRONLY|os.O_CREAT|os.O_TRUNC,0o600),'w') as f:
+       json.dump({'key':[ssw,ssw_instr,pers_start],'created':time.time(),'env':env},f)
+     os.rename(sfile+tmp,sfile)
+     os.rename(jfile+tmp,jfile)
+   except Exception as e:
+     print('Failed to save SSW state: '+str(e))
+
   
@@ -10,17 +10,52 @@ def run(*arg,**kwargs):
 # client.run('plot,findgen(100)')     plots IDL findgen array
 # client.run(filename,1)              upload file to server
 
+# Connections are kept open in a pool and reused by later calls to the 
+# same server. Set persist=False to close the connection after the call.
+
+# Large messages and file transfers are compressed if the server supports
+# it. By default this is done only for remote servers; set compress=True
+# or False to force it on or off.
+
+# Uploaded files are identified by a hash of their contents, and a file 
+# the server already holds is not sent again. Set cache=False to always
+# upload.
+
+# Results of idempotent commands (idempotent=True, or matching memo.ALLOW)
+# are cached on the client and server (see memo.py).
+
+# Interrupted downloads (and uploads) are resumed from the bytes already
+# transferred. Set resume=False to start again. For downloads:
+# offset,length - download only length bytes of file from offset
+# verify - check downloaded file against hash sent by server (always done
+#          when resuming)
+
+# Set servers to a list of servers to send the request to one of them (see
+# balance.py). Uploaded files are pinned to the server that holds them.
+
+# A server on the same host is reached through its Unix socket. Files are
+# then uploaded and downloaded by linking them rather than sending their
+# bytes, and large arrays are passed in shared memory (see tools.connect).
+
     import socket
     import sys
     import os, time, random, json
     import tools
 
+    if 'servers' in kwargs:
+        import balance
+        location=None ; record=None
+        if len(arg) == 2 and arg[1] == 2: location=os.path.dirname(tools.expand_name(arg[0]))
+        if len(arg) == 2 and arg[1] == 1: record=os.path.dirname
+        return balance.call(run,arg,kwargs,key=arg[0] if arg else None,location=location,record=record)
+
     ip="localhost"
     port=10000
     timeout=60
-    RECV_BUFFER = 4096
+    RECV_BUFFER = tools.DEF_RECV_BUFFER
     verbose=False
     is_function=0
+    persist=True
 
     if not tools.valid_arg(*arg): return None 
 	
@@ -46,6 +81,46 @@ def run(*arg,**kwargs):
         del twargs['is_function']
         if is_function: is_function=1
 
+    if 'persist' in kwargs:
+        persist=kwargs['persist']
+        del twargs['persist']
+
+    if 'RECV_BUFFER' in kwargs:
+        RECV_BUFFER=kwargs['RECV_BUFFER']
+        del twargs['RECV_BUFFER']
+
+    compress=None
+    if 'compress' in kwargs:
+        compress=kwargs['compress']
+        del twargs['compress']
+
+    cache=True
+    if 'cache' in kwargs:
+        cache=kwargs['cache']
+        del twargs['cache']
+
+    resume=True
+    if 'resume' in kwargs:
+        resume=kwargs['resume']
+        del twargs['resume']
+
+    verify=False
+    if 'verify' in kwargs:
+        verify=kwargs['verify']
+        del twargs['verify']
+
+    idempotent=False
+    if 'idempotent' in kwargs:
+        idempotent=kwargs['idempotent']
+        del twargs['idempotent']
+
+    offset=0L ; length=None
+    if 'offset' in kwargs:
+        offset=long(kwargs['offset'])
+        del twargs['offset']
+    if 'length' in kwargs:
+        length=long(kwargs['length'])
+        del twargs['length']
 	  	
 # if second argument is set to 1, then input string is a filename to upload to server
 
@@ -62,45 +137,75 @@ def run(*arg,**kwargs):
             if slen == 0:
                 print("Zero block length file.")
                 return None
+
+# local server takes file by path
+
+            if tools.is_local(ip) and tools.local_server(port):
+                location=handoff(filename,ip,port,timeout,persist,verbose)
+                if location: return location
+
+# skip upload if server already has file, or resume partial upload
+
+            digest=None ; offset=0L
+            if cache:
+                import blobs
+                digest=blobs.file_hash(filename)
+                location,offset=lookup(filename,digest,ip,port,timeout,persist,verbose,compress)
+                if location: return location
+                if not resume: offset=0L
+
+# return cached result of idempotent command
+
+    ckey=None
+    if flag == 0:
+        import memo
+        if memo.client_cache.cacheable(cmd,idempotent):
+            ckey=(ip,port,memo.key(cmd,is_function,twargs))
+            value=memo.client_cache.get(ckey)
+            if value is not memo.MISSING: return value
+
+# resume partial download unless byte range requested
+
+    local_offset=0L
+    if flag == 2 and resume and offset == 0 and length is None:
+        local_offset=tools.part_size(filename,**kwargs)
+        offset=local_offset
              
-# Create a TCP/IP socket
-# Connect the socket to the port where the server is listening
-   
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_address = (ip,port)
-    if verbose: print 'Connecting to server: %s on port: %s' % server_address
-    try:
-        sock.connect(server_address)
-    except socket.error as msg:
-        print('Error Code : ' + str(msg[0]) + ' Message: ' + msg[1])
-        print("Failed to connect to server. Check if server is running on port: "+str(port))
-        return None
-		
-    sock.settimeout(timeout)
-    response=None
-    data=''
-    error=''
-    try:
+# Send request and wait for response 
+
+    def send(sock,codec):
     
-# If uploading file, read and send bytes. 
+# If uploading file, read and send bytes (compressed if negotiated). 
 
         if flag == 1:
             sfile=os.path.basename(filename)
             tdict={'action':'upload','filename':sfile, 'size':str(slen)} 
+            if codec and tools.compressible(filename,slen): tdict['encoding']=codec
+            if digest: tdict['hash']=digest
+            if offset: tdict['offset']=offset
             sdict=json.dumps(tdict)
             tools.send_data(sock,sdict)
-            with open(filename,'rb') as file:
-                sdata=file.read()
-                if verbose:
-                    print("Client uploading file: "+filename)
-                    print "# of bytes: ",slen
-                sock.sendall(sdata)
+            if verbose:
+                print("Client uploading file: "+filename)
+                if offset: print "Resuming at byte: ",offset
+                print "# of bytes: ",slen-offset
+            tstart=time.time()
+            if 'encoding' in tdict:
+                tools.send_compressed(sock,filename,codec,offset=offset)
+            else:
+                tools.send_file(sock,filename,offset=offset,size=slen-offset)
+            if verbose: print(tools.throughput(slen-offset,time.time()-tstart))
 
 # Send download request 
 
         elif flag == 2:
             if verbose: print("Downloading file: "+filename)
             tdict={'action':'download','filename':filename}
+            if tools.is_unix(sock) and not (offset or verify or length is not None): tdict['link']=1
+            if offset: tdict['offset']=offset
+            if length is not None: tdict['length']=length
+            if verify or local_offset: tdict['checksum']=offset-local_offset
+            if verbose and local_offset: print "Resuming at byte: ",local_offset
             sdict=json.dumps(tdict)
             tools.send_data(sock,sdict)
 
@@ -110,51 +215,631 @@ def run(*arg,**kwargs):
 
             if verbose: print("Executing IDL command: " +cmd)
             tdict={'action':'execute','command':cmd,'is_function':is_function}
+            if idempotent: tdict['idempotent']=1
             sdict=json.dumps(tdict)
-            tools.send_data(sock,sdict)
+            tools.send_data(sock,sdict,codec)
             edict=json.dumps(twargs)  
-            tools.send_data(sock,edict)
+            tools.send_data(sock,edict,codec)
            
-# Wait for response
- 
-        tstart=time.time()  
-        while 1:		
-            data=tools.recv_data(sock)
-            elapsed=time.time()-tstart
-            if data or (elapsed > timeout) : break
-
-    finally:
-        if not data:
-            error="Server not responding."
+    sock,data=request(send,ip,port,timeout,persist,verbose,compress)
+    if not sock: return None
+
+    response=None
+    error=''
+    reusable=bool(data)
+    if not data:
+        error="Server not responding."
+    else:
+        tdict=json.loads(data)
+        if verbose: 
+            print("Server sent response: ")
+            print(tdict)
+
+        action=str(tdict['action'])
+
+        if action == 'upload':
+            if tdict['filename']: response=str(tdict['filename'])
+            error=str(tdict['error'])
+
+        if action == 'download':
+            requested=filename
+            filename=str(tdict['filename'])
+            dsize=long(str(tdict['size']))
+            error=str(tdict['error'])
+            if not error and 'path' in tdict:
+               response,error = tools.link_file(str(tdict['path']),requested,**kwargs)
+            elif not error and (dsize != 0 or local_offset): 
+               rwargs=kwargs.copy()
+               rwargs['RECV_BUFFER']=RECV_BUFFER
+               rwargs['offset']=local_offset
+               if 'encoding' in tdict: rwargs['encoding']=str(tdict['encoding'])
+               if 'hash' in tdict: rwargs['checksum']=str(tdict['hash'])
+               response,error = tools.rdwrt(sock,filename,dsize,**rwargs)
+               if response is None and not error.startswith('Checksum'): reusable=False
+
+        if action == 'execute':
+            response=tools.recv_result(sock,tdict)
+            error=str(tdict['error'])
+            if response is None: reusable=False
+            if ckey and response is not None and not error: memo.client_cache.put(ckey,response)
+
+    finish(sock,ip,port,persist,reusable,verbose)
+    if verbose and len(error) !=0 : print("Error: "+error)
+
+# partial file did not match server file: start again
+
+    restart=False
+    if flag == 1 and offset and not response: 
+        restart=True
+        if verbose: print("Cannot resume upload. Restarting.")
+    if flag == 2 and local_offset and error in ('Invalid offset.','Checksum mismatch: '+filename):
+        restart=True
+        if verbose: print("Cannot resume download. Restarting.")
+        tools.remove_part(filename,**kwargs)
+    if restart:
+        rwargs=kwargs.copy()
+        rwargs['resume']=False
+        return run(*arg,**rwargs)
+
+    return response
+
+################################################################################
+# Return (path,offset) where path is the path of copy of file with hash 
+# digest if server already holds it, else '', and offset is the number of 
+# bytes of the file received by an interrupted upload. Servers that 
+# predate the handshake are not asked.
+
+def lookup(filename,digest,ip,port,timeout,persist,verbose,compress=None):
+
+    import os,json
+    import tools,pool
+
+    if (ip,port) in pool.legacy: return ('',0L)
+
+    def send(sock,codec):
+        tdict={'action':'have','filename':os.path.basename(filename),'hash':digest}
+        tools.send_data(sock,json.dumps(tdict),codec)
+
+    sock,data=request(send,ip,port,timeout,persist,verbose,compress)
+    if not sock: return ('',0L)
+    location='' ; offset=0L
+    if data:
+        tdict=json.loads(data)
+        if not tdict['error']: 
+            location=str(tdict['filename'])
+            offset=long(tdict.get('offset',0))
+    finish(sock,ip,port,persist,bool(data),verbose)
+    if location and verbose: print("Server already has file: "+location)
+    return (location,offset)
+
+################################################################################
+# Hand file to server on the same host by path. Returns the path of the
+# server's link to it, or None if the server cannot take it (e.g. the
+# connection is not through its Unix socket).
+
+def handoff(filename,ip,port,timeout,persist,verbose,compress=None):
+
+    import os,json
+    import tools
+
+    def send(sock,codec):
+        tdict={'action':'link','filename':os.path.abspath(filename)}
+        tools.send_data(sock,json.dumps(tdict),codec)
+
+    sock,data=request(send,ip,port,timeout,persist,verbose,compress)
+    if not sock: return None
+    location=None
+    if data:
+        tdict=json.loads(data)
+        if tdict['error']:
+            if verbose: print("Server cannot link file: "+str(tdict['error']))
         else:
-            tdict=json.loads(data)
-            if verbose: 
-                print("Server sent response: ")
-                print(tdict)
-
-            action=str(tdict['action'])
-
-            if action == 'upload':
-                response=str(tdict['filename'])
-                error=str(tdict['error'])
-
-            if action == 'download':
-                filename=str(tdict['filename'])
-                dsize=long(str(tdict['size']))
-                error=str(tdict['error'])
-                if dsize != 0 : 
-                   response,error = tools.rdwrt(sock,filename,dsize,RECV_BUFFER=RECV_BUFFER,**kwargs)
-
-            if action == 'execute':
-                response=str(tdict['result'])
-                error=str(tdict['error'])
-                
-                
+            location=str(tdict['filename'])
+    finish(sock,ip,port,persist,bool(data),verbose)
+    if location and verbose: print("Server linked file: "+location)
+    return location
+
+################################################################################
+# Get a connection to the server, reusing a pooled one if available, and
+# call send(sock) to send a request. Return (sock,data) where data is the
+# response header, or (None,None) if unable to connect.
+
+# A pooled connection may have been dropped by the server since it was
+# last used, in which case the request is retried once on a new connection.
+# It is retried only if the connection was reset or closed before any of
+# the response arrived, so the server cannot have run it; never after a
+# timeout, as the server may still be running it.
+
+def request(send,ip,port,timeout,persist,verbose,compress=None):
+
+    import socket,errno
+    import tools, pool, balance
+
+    if compress is None: compress=not tools.is_local(ip)
+
+    data=None
+    for attempt in range(2):
+        try:
+            if persist:
+                sock,reused=pool.get(ip,port,timeout=timeout,verbose=verbose)
+            else:
+                if verbose: print 'Connecting to server: %s on port: %s' % (ip,port)
+                sock,reused=tools.connect(ip,port,timeout),False
+                tools.tune_socket(sock)
+                sock.settimeout(timeout)
+        except socket.error as msg:
+            print('Error Code : ' + str(msg.errno) + ' Message: ' + str(msg))
+            print("Failed to connect to server. Check if server is running on port: "+str(port))
+            balance.mark_down((ip,port))
+            return (None,None)
+        balance.mark_up((ip,port))
+
+        stale=False
+        phase='send'
+        try:
+
+# Agree on compression codec for new connection
+
+            if not reused and compress and (ip,port) not in pool.legacy:
+                codec=tools.negotiate(sock)
+                if codec is None: 
+                    pool.legacy.add((ip,port))
+                    if verbose: print("Server does not support compression.")
+                elif verbose: 
+                    print("Compression: "+(codec or 'none'))
+                pool.set_codec(sock,codec)
+            codec=pool.get_codec(sock)
+            send(sock,codec)
+
+# Wait for response. A connection closed before the first byte of the
+# response is stale.
+ 
+            phase='wait'
+            if response_pending(sock):
+                phase='read'
+                data=tools.recv_data(sock,codec)
+            else:
+                stale=True
+        except socket.timeout as e:
+            if verbose: print("Socket timeout: "+str(e))
+            data=None
+        except socket.error as e:
+            if verbose: print("Socket error: "+str(e))
+            data=None
+            stale=phase != 'read' and e.errno in (errno.ECONNRESET,errno.EPIPE)
+
+        if data or not (reused and stale): break
+        pool.close(sock)
+        if verbose: print("Pooled connection closed by server. Reconnecting.")
+
+# Server at its connection limit refuses new connections. Other servers
+# are tried first for a while (see balance.py).
+
+    reason=tools.refusal(data)
+    if reason:
+        print(reason)
+        pool.close(sock)
+        balance.mark_down((ip,port))
+        return (None,None)
+
+    return (sock,data)
+
+# wait for response on sock. Returns False if the connection was closed
+# before any of it arrived.
+
+def response_pending(sock):
+
+    import socket
+    return len(sock.recv(1,socket.MSG_PEEK)) > 0
+
+################################################################################
+# Keep connection open for the next request unless it was left in an 
+# unknown state (no response or a partially read download)
+
+def finish(sock,ip,port,persist,reusable,verbose):
+
+    import pool
+    if persist and reusable:
+        pool.release(ip,port,sock)
+    else:
         if verbose: print("Closing socket.")
-        sock.close()
-        if verbose and len(error) !=0 : print("Error: "+error)
+        pool.close(sock)
+
+################################################################################
+# Split keywords into client connection options and IDL keywords
+
+CLIENT_OPTIONS=('ip','port','timeout','verbose','persist','RECV_BUFFER','compress','cache','resume','verify','idempotent','servers','balance','pin')
+
+def split_kwargs(kwargs):
+
+    options={}
+    keywords={}
+    for key in kwargs:
+        if key in CLIENT_OPTIONS:
+            options[key]=kwargs[key]
+        else:
+            keywords[key]=kwargs[key]
+    return (options,keywords)
+
+################################################################################
+# Send list of IDL commands to server and execute them in order in a 
+# single request. Each command is a string or a dict with 'command' and
+# optional 'is_function' and 'keywords' entries.
+# Returns list of (result,error) for each command executed, or None if the
+# server is not responding.
+
+# Example:
+# client.run_batch(['a=findgen(10)','result=string(total(a))'])
+# client.run_batch(cmds,stop_on_error=True)    stop at first failed command
+
+def run_batch(commands,**kwargs):
+
+    import json
+    import tools
+
+    if 'servers' in kwargs:
+        import balance
+        return balance.call(run_batch,(commands,),kwargs)
+
+    ip="localhost"
+    port=10000
+    timeout=60
+    verbose=False
+    persist=True
+    stop_on_error=0
+
+    if type(commands) not in (list,tuple) or len(commands) == 0:
+        print("Commands must be non-empty list.")
+        return None
+
+    if 'ip' in kwargs: ip=kwargs['ip']
+    if 'port' in kwargs: port=kwargs['port']
+    if 'timeout' in kwargs: timeout=kwargs['timeout']
+    if 'verbose' in kwargs: verbose=True
+    if 'persist' in kwargs: persist=kwargs['persist']
+    compress=kwargs.get('compress')
+    if 'stop_on_error' in kwargs: 
+        if kwargs['stop_on_error']: stop_on_error=1
+
+    items=batch_items(commands)
+    if items is None: return None
+
+    def send(sock,codec):
+        if verbose: print("Executing batch of "+str(len(items))+" IDL commands.")
+        tdict={'action':'batch','commands':items,'stop_on_error':stop_on_error}
+        sdict=json.dumps(tdict)
+        tools.send_data(sock,sdict,codec)
+
+    sock,data=request(send,ip,port,timeout,persist,verbose,compress)
+    if not sock: return None
+
+    response=None
+    reusable=bool(data)
+    if not data:
+        print("Server not responding.")
+    else:
+        tdict=json.loads(data)
+        if verbose: 
+            print("Server sent response: ")
+            print(tdict)
+        response=recv_results(sock,tdict['results'])
+        if response is None:
+            print("Error reading batch results.")
+            reusable=False
+        if tdict['error']: print("Error: "+str(tdict['error']))
+        if verbose and response:
+            for r in response:
+                if r[1]: print("Error: "+r[1])
+
+    finish(sock,ip,port,persist,reusable,verbose)
+    return response
+
+# read results of batch described by headers, as (result,error). Returns
+# None if any cannot be read, as the connection is then out of step.
+
+def recv_results(sock,headers):
+
+    import socket
+    import tools
+    response=[]
+    for header in headers:
+        try:
+            result=tools.recv_result(sock,header)
+        except (socket.error,IOError,ValueError):
+            return None
+        if result is None: return None
+        response.append((result,str(header['error'])))
+    return response
+
+################################################################################
+# Convert list of commands (strings or dicts) to list of batch request 
+# items, or None if a command is invalid
+
+def batch_items(commands):
+
+    items=[]
+    for cmd in commands:
+        if type(cmd) == str: cmd={'command':cmd}
+        if type(cmd) != dict or type(cmd.get('command')) != str:
+            print("Each command must be string or dict with 'command' string.")
+            return None
+        item={'command':cmd['command'],'is_function':0,'keywords':cmd.get('keywords',{})}
+        if cmd.get('is_function'): item['is_function']=1
+        items.append(item)
+    return items
+
+################################################################################
+# Return value of IDL variable on server. Numeric values are returned as
+# numpy arrays sent in binary (scalars as numpy scalars).
+
+# Example:
+# client.run('a=findgen(2048,2048)')
+# a=client.get('a')
+
+def get(name,**kwargs):
+
+    if 'servers' in kwargs:
+        import balance
+        return balance.call(get,(name,),kwargs)
+
+    import json
+    import tools
+
+    if not tools.valid_arg(name,label='Variable name'): return None
+    options,keywords=split_kwargs(kwargs)
+    ip=options.get('ip',"localhost")
+    port=options.get('port',10000)
+    timeout=options.get('timeout',60)
+    verbose='verbose' in options
+    persist=options.get('persist',True)
+    compress=options.get('compress')
 
-        return response
+    def send(sock,codec):
+        if verbose: print("Getting IDL variable: "+name)
+        tdict={'action':'get','name':name}
+        tools.send_data(sock,json.dumps(tdict),codec)
+
+    sock,data=request(send,ip,port,timeout,persist,verbose,compress)
+    if not sock: return None
+
+    response=None
+    reusable=bool(data)
+    if not data:
+        print("Server not responding.")
+    else:
+        tdict=json.loads(data)
+        error=str(tdict['error'])
+        response=tools.recv_result(sock,tdict)
+        if response is None: reusable=False
+        if error: 
+            print("Error: "+error)
+            response=None
+
+    finish(sock,ip,port,persist,reusable,verbose)
+    return response
+
+################################################################################
+# Return server status as dict with ready (True once an IDL session has
+# started), sessions (number started), total, startup (seconds until ready),
+# uptime and timings of each startup phase, or None if no server is 
+# running. If wait is set, wait up to wait seconds for server to be ready.
+
+# Example:
+# client.ping(wait=120)['ready']
+
+def ping(wait=0,**kwargs):
+
+    options=kwargs.copy()
+    if wait: options['timeout']=max(options.get('timeout',60),wait+30)
+    rdict=call({'action':'ping','wait':wait},**options)
+    if rdict is None or rdict['error']: return None
+    return rdict
+
+################################################################################
+# Return server metrics as dict: per action (execute, upload, download...) 
+# count, errors, error_rate, bytes_in, bytes_out and latency histogram; 
+# timers of time spent queueing, in IDL and transferring data; and gauges 
+# of connections, queued and running IDL jobs. If reset is set, the server
+# starts counting again. If verbose is set, the metrics are printed as a
+# table.
+
+# Example:
+# client.stats()['actions']['execute']['latency']['p90']
+
+def stats(reset=False,**kwargs):
+
+    import metrics
+
+    rdict=call({'action':'stats','reset':reset},**kwargs)
+    if rdict is None: return None
+    if rdict['error']:
+        print("Error: "+str(rdict['error']))
+        return None
+    if 'verbose' in kwargs: print(metrics.report(rdict))
+    return rdict
+
+################################################################################
+# Jobs: run IDL command (or list of commands, as in run_batch) on server 
+# without waiting for it. submit returns job id; wait returns job status
+# when job finishes (or None if it does not finish within timeout). 
+# Files in server directory job_dir when job finishes are listed in 
+# status['outputs'].
+
+# Example:
+# job=client.submit('prep_file,"'+file+'",out_dir="'+tdir+'"',job_dir=tdir)
+# status=client.wait(job,timeout=600)
+# result=client.fetch(job)
+
+def submit(command,**kwargs):
+
+    import tools
+
+    if 'servers' in kwargs:
+        import balance
+        return balance.call(submit,(command,),kwargs,key=command,record=lambda job: job)
+
+    options,keywords=split_kwargs(kwargs)
+    tdict={'action':'submit'}
+    if 'job_dir' in keywords: tdict['job_dir']=keywords.pop('job_dir')
+    if type(command) in (list,tuple):
+        tdict['commands']=batch_items(command)
+        if tdict['commands'] is None: return None
+        if keywords.pop('stop_on_error',0): tdict['stop_on_error']=1
+    else:
+        if not tools.valid_arg(command): return None
+        tdict['command']=command
+        tdict['is_function']=1 if keywords.pop('is_function',0) else 0
+        tdict['keywords']=keywords
+    rdict=call(tdict,**options)
+    if rdict is None: return None
+    if rdict['error']:
+        print("Error: "+str(rdict['error']))
+        return None
+    if 'verbose' in options: print("Submitted job: "+str(rdict['job']))
+    return str(rdict['job'])
+
+################################################################################
+# Return status of job as dict with state ('running','done' or 'failed'),
+# job_error, outputs, submitted and finished times
+
+def status(job,**kwargs):
+
+    if 'servers' in kwargs:
+        import balance
+        return balance.call(status,(job,),kwargs,location=job)
+
+    rdict=call({'action':'status','job':job},**kwargs)
+    if rdict is None: return None
+    if rdict['error']:
+        print("Error: "+str(rdict['error']))
+        return None
+    return rdict
+
+################################################################################
+# Wait for job to finish and return its status, or None if timeout seconds
+# pass first. The server replies as soon as the job finishes; requests are
+# renewed every poll seconds to keep connections from timing out.
+
+def wait(job,timeout=None,poll=60.,**kwargs):
+
+    import time
+
+    if 'servers' in kwargs:
+        import balance
+        return balance.call(wait,(job,timeout,poll),kwargs,location=job)
+
+    tstart=time.time()
+    while True:
+        interval=poll
+        if timeout is not None: interval=min(poll,max(timeout-(time.time()-tstart),0.))
+        options=kwargs.copy()
+        options['timeout']=interval+30.
+        rdict=call({'action':'wait','job':job,'timeout':interval},**options)
+        if rdict is None: return None
+        if rdict['error']:
+            print("Error: "+str(rdict['error']))
+            return None
+        if rdict['state'] != 'running': return rdict
+        if timeout is not None and time.time()-tstart >= timeout: return None
+
+################################################################################
+# Return result of finished job (list of (result,error) for list of 
+# commands)
+
+def fetch(job,**kwargs):
+
+    import json
+    import tools
+
+    if 'servers' in kwargs:
+        import balance
+        return balance.call(fetch,(job,),kwargs,location=job)
+
+    options,keywords=split_kwargs(kwargs)
+    ip=options.get('ip',"localhost")
+    port=options.get('port',10000)
+    timeout=options.get('timeout',60)
+    verbose='verbose' in options
+    persist=options.get('persist',True)
+    compress=options.get('compress')
+
+    def send(sock,codec):
+        tools.send_data(sock,json.dumps({'action':'fetch','job':job}),codec)
+
+    sock,data=request(send,ip,port,timeout,persist,verbose,compress)
+    if not sock: return None
+
+    response=None
+    reusable=bool(data)
+    if not data:
+        print("Server not responding.")
+    else:
+        tdict=json.loads(data)
+        if tdict['error']: 
+            print("Error: "+str(tdict['error']))
+        elif 'results' in tdict:
+            response=recv_results(sock,tdict['results'])
+            if response is None: reusable=False
+        else:
+            response=tools.recv_result(sock,tdict)
+            if response is None: reusable=False
+        if tdict.get('job_error'): print("Error: "+str(tdict['job_error']))
+
+    finish(sock,ip,port,persist,reusable,verbose)
+    return response
+
+################################################################################
+# Send request tdict and return response dict (for requests without 
+# payloads), or None if server is not responding
+
+def call(tdict,**kwargs):
+
+    import json
+    import tools
+
+    ip=kwargs.get('ip',"localhost")
+    port=kwargs.get('port',10000)
+    timeout=kwargs.get('timeout',60)
+    verbose='verbose' in kwargs
+    persist=kwargs.get('persist',True)
+    compress=kwargs.get('compress')
+
+    def send(sock,codec):
+        tools.send_data(sock,json.dumps(tdict),codec)
+
+    sock,data=request(send,ip,port,timeout,persist,verbose,compress)
+    if not sock: return None
+    rdict=None
+    if data:
+        rdict=json.loads(data)
+    else:
+        print("Server not responding.")
+    finish(sock,ip,port,persist,bool(data),verbose)
+    return rdict
+
+################################################################################
+# Fetch file at URL on server (see urlcache.py). Returns (path of file on
+# server,file name given by remote server), or None if the server cannot
+# fetch it or has no URL cache.
+
+def get_url(url,**kwargs):
+
+    import os
+    import tools
+
+    if 'servers' in kwargs:
+        import balance
+        return balance.call(get_url,(url,),kwargs,key=url,record=lambda r: os.path.dirname(r[0]))
+
+    if not tools.valid_url(url): 
+        print("Invalid URL: "+str(url))
+        return None
+    rdict=call({'action':'url','url':url},**kwargs)
+    if rdict is None: return None
+    if rdict['error']:
+        if 'verbose' in kwargs: print("Error: "+str(rdict['error']))
+        return None
+    return (str(rdict['filename']),str(rdict['name']))
 
 ################################################################################
    
@@ -167,13 +852,110 @@ def download(file,**kwargs):
     return run(file,2,**kwargs)
 
 ################################################################################
+# Get part of FITS file on server (see fitscut.py): HDU hdu (number or
+# EXTNAME), table rows ([start,stop]) or rows whose sorted column is in
+# [low,high] (between=[column,low,high]), table columns (list of names),
+# or image section ([start,stop] for each axis, slowest varying first).
+# Only the bytes selected are read and sent. Returns name of FITS file 
+# written to outdir (current directory by default), or with format='array'
+# a numpy array (and the HDU header cards, if header is set), or None.
 
-# Prep function
+# Examples:
+# client.fits('/data/hsi_events.fits',hdu='EVENTS',between=['TIME',10.,20.])
+# image=client.fits(file,section=[[0,512],[0,512]],format='array')
+
+def fits(file,**kwargs):
+
+    if 'servers' in kwargs:
+        import balance
+        return balance.call(fits,(file,),kwargs,key=file)
+
+    import json,os
+    import tools
+
+    if not tools.valid_arg(file,label='Filename'): return None
+    ip=kwargs.get('ip',"localhost")
+    port=kwargs.get('port',10000)
+    timeout=kwargs.get('timeout',60)
+    verbose='verbose' in kwargs
+    persist=kwargs.get('persist',True)
+    compress=kwargs.get('compress')
+
+    outdir=os.getcwd()
+    if 'outdir' in kwargs: outdir=tools.expand_name(kwargs['outdir'])
+    format='fits'
+    if 'format' in kwargs: format=kwargs['format']
+    if format not in ('fits','array'):
+        print("Invalid format: "+str(format))
+        return None
+
+    tdict={'action':'fits','filename':file,'format':format}
+    for key in ('hdu','rows','between','columns','section'):
+        if key in kwargs: tdict[key]=kwargs[key]
+
+    def send(sock,codec):
+        if verbose: print("Getting part of FITS file: "+file)
+        tools.send_data(sock,json.dumps(tdict),codec)
+
+    sock,data=request(send,ip,port,timeout,persist,verbose,compress)
+    if not sock: return None
+
+    response=None
+    reusable=bool(data)
+    if not data:
+        print("Server not responding.")
+    else:
+        rdict=json.loads(data)
+        error=str(rdict['error'])
+        if error:
+            print("Error: "+error)
+        elif format == 'array':
+            response=tools.recv_result(sock,rdict)
+            if response is None: 
+                reusable=False
+            elif 'header' in kwargs:
+                response=(response,[str(card) for card in rdict['cards']])
+        else:
+            rkwargs={'outdir':outdir}
+            if verbose: rkwargs['verbose']=True
+            response,error=tools.rdwrt(sock,str(rdict['filename']),rdict['size'],**rkwargs)
+            if error:
+                print(error)
+                reusable=False
+
+    finish(sock,ip,port,persist,reusable,verbose)
+    return response
+
+################################################################################
+
+# Prep function. Returns name of downloaded prepped file, or None.
 
 def tprep(*arg,**kwargs):
-    import tools,os,time
+    import tools
     if not tools.valid_arg(*arg,label='Filename'): return None
-    file=arg[0]
+    f,error=prep_file(arg[0],**kwargs)
+    if f:
+        print("Results downloaded in file: "+f)
+    else:
+        print(error)
+    return f
+
+###############################################################################
+# prep file (local or URL) on server and download result. Returns
+# (name of downloaded file,'') or (None,error). Options as for tprep:
+# outdir, thread (run prep as server job), timeout.
+
+def prep_file(file,**kwargs):
+    import tools,os
+    if not tools.valid_arg(file,label='Filename'): return (None,'Invalid filename.')
+
+# with several servers, the whole sequence is run on one of them
+
+    if 'servers' in kwargs:
+        import balance
+        result=balance.call(prep_file,(file,),kwargs,key=file,failed=lambda r: r[0] is None)
+        if result is None: return (None,"No Python-IDL server available.")
+        return result
 
 # check if threading
 
@@ -197,63 +979,58 @@ def tprep(*arg,**kwargs):
 
     outdir=tools.expand_name(outdir)
     vdir=tools.valid_dir(outdir)
-    if not vdir[0]:
-       print("Output directory does not exist.")
-       return None
-    if not vdir[1]:
-       print("Output directory not writeable.") 
-       return None
+    if not vdir[0]: return (None,"Output directory does not exist.")
+    if not vdir[1]: return (None,"Output directory not writeable.")
 
-# determine location of prepped file on server
+# determine location of prepped file on server: a session in the 
+# server's scratch space, or one made by IDL if it has none
 
-    tdir=run('result=session_dir("prep",/new)',is_function=True,**twargs)
-    if not tdir: return None
+    tdir=None
+    rdict=call({'action':'session','name':'prep'},**twargs)
+    if rdict and not rdict['error']: tdir=str(rdict['dir'])
+    if not tdir: tdir=run('result=session_dir("prep",/new)',is_function=True,**twargs)
+    if not tdir: return (None,"Failed to create directory on server.")
 
 # upload file to server if local (ie not URL)
 
+# URLs are fetched by the server through its URL cache, which also gives
+# the remote file name. Servers without the cache fetch them in IDL.
+
     outfile='prepped_'+os.path.basename(file)
     if tools.valid_url(file):
-        URL=True
-        location=file
-        disp=tools.disp_url(file)
-        if type(disp) != str: 
-            print("Error accessing URL: "+file)
-            return None
+        fetched=get_url(file,timeout=timeout,**twargs)
+        if fetched:
+            location,disp=fetched
+        else:
+            location=file
+            disp=tools.disp_url(file)
+            if type(disp) != str: return (None,"Error accessing URL: "+file)
         if disp: outfile='prepped_'+disp
     else:
         location=upload(file,**kwargs)
-        if not location: return None
-        URL=False
+        if not location: return (None,"Failed to upload: "+file)
 
-# Send prep command to server
+# Send prep command to server. In thread mode it is run as a server job,
+# and the result is downloaded as soon as the job finishes.
 
     ofile=os.path.join(tdir,outfile)
-    prep_cmd='prep_file,'
-    if thread: prep_cmd='thread,"prep_file",'
-    prep_cmd=prep_cmd+'"'+location+'",out_dir="'+tdir+'",err=err'
-    pfile=run(prep_cmd,**twargs)
-   
-    print("Waiting for results...")
+    prep_cmd='prep_file,"'+location+'",out_dir="'+tdir+'",err=err'
     if thread:
-        tstart=time.time()
-        while True:
-            f=download(ofile,**kwargs)
-            elapsed=time.time()-tstart
-            if f or elapsed > timeout: break
-            time.sleep(3)
-            print("Waiting for results...")
-    else:
-        f=download(ofile,**kwargs)
-
-    if f:
-        print("Results downloaded in file: "+f)
+        job=submit(prep_cmd,job_dir=tdir,**twargs)
+        if not job: return (None,"Failed to submit prep job.")
+        print("Waiting for results...")
+        state=wait(job,timeout=timeout,**twargs)
+        if not state: return (None,"Server timed out.")
+        if state['job_error']: return (None,"Prep failed: "+str(state['job_error']))
     else:
-        print("Server timed out.")
-    return
+        run(prep_cmd,**twargs)
+    f=download(ofile,**kwargs)
+    if not f: return (None,"Prep failed.")
+    return (f,'')
 
 ###############################################################################
 
-# run prep function in a thread
+# run prep function in a thread. Returns the thread.
 
 def prep(*args,**kwargs):
 
@@ -264,6 +1041,96 @@ def prep(*args,**kwargs):
     t=threading.Thread(target=tprep,args=args,kwargs=kwargs)
     t.start()
 
-    return
+    return t
+
+###############################################################################
+# Prep list of files, max_workers at a time, and return iterator over
+# (file,prepped file,error) in the order the preps finish. Preps that fail
+# for a transient reason (see transient) are tried again up to retries 
+# times, after RETRY_WAIT seconds (doubled for each further try); those
+# that fail in IDL, or for a missing file, are not. Options are as for
+# tprep. By default as many files are prepped at once as the server has
+# IDL sessions (plus one, so that transfers overlap with IDL), or job
+# workers if thread is set. Returns None if max_workers is less than 1.
+
+# Example:
+# for file,output,error in client.prep_many(files,outdir='/data/prepped'):
+#     if error: print(file+': '+error)
+
+def prep_many(files,max_workers=None,retries=1,**kwargs):
+
+    import socket,threading,time,Queue
+
+    files=list(files)
+    if max_workers is None: max_workers=capacity(**kwargs)
+    if max_workers < 1:
+        print("Error: max_workers must be at least 1.")
+        return None
+    tasks=Queue.Queue()
+    for file in files: tasks.put(file)
+    results=Queue.Queue()
+
+    def work():
+        while True:
+            try:
+                file=tasks.get_nowait()
+            except Queue.Empty:
+                return
+            for attempt in range(retries+1):
+                retry=False
+                try:
+                    output,error=prep_file(file,**kwargs)
+                    retry=not output and transient(file,error)
+                except socket.error as e:
+                    output,error,retry=None,str(e),True
+                except Exception as e:
+                    output,error=None,str(e)
+                if not retry or attempt == retries: break
+                time.sleep(RETRY_WAIT*2**attempt)
+            results.put((file,output,error))
+
+    for i in range(min(max_workers,len(files))):
+        t=threading.Thread(target=work)
+        t.daemon=True
+        t.start()
+
+# wait with timeout so that the wait can be interrupted
+
+    def iterate():
+        for i in range(len(files)):
+            while True:
+                try:
+                    yield results.get(True,1.)
+                    break
+                except Queue.Empty:
+                    pass
+    return iterate()
+
+RETRY_WAIT=0.5
+
+# check if prep_file error is transient (server unreachable, busy or timed
+# out), so that trying again may succeed
+
+TRANSIENT=('Failed to create directory on server.','Failed to submit prep job.',
+           'Server timed out.','No Python-IDL server available.')
+
+def transient(file,error):
+
+    import os
+    if error in TRANSIENT: return True
+    return error.startswith('Failed to upload: ') and os.path.isfile(file)
+
+# number of requests the server (or servers) can run at once
 
+def capacity(**kwargs):
 
+    if 'servers' in kwargs:
+        import balance
+        servers=[balance.parse(s) for s in kwargs['servers']]
+        options=dict([(k,v) for k,v in kwargs.items() if k not in ('servers','balance','pin')])
+        return sum([capacity(ip=s[0],port=s[1],**options) for s in servers if not balance.is_down(s)]) or 4
+    options,keywords=split_kwargs(kwargs)
+    status=ping(**options)
+    if not status: return 4
+    if kwargs.get('thread'): return max(status.get('job_workers',1),1)
+    return max(status['total'],1)+1
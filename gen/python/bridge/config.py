@@ -3,7 +3,8 @@
 # share import.config
 
 file=''
-stop_server=False
+servers={}         # running servers keyed by port
+scratch=None       # scratch store of running server (see scratch.py)
 
 
  
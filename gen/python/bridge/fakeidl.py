@@ -0,0 +1,139 @@
+
+# Stand-in IDL backend for the Python-IDL bridge server
+
+# Runs the server without an IDL licence, for testing and benchmarks (see
+# bench.py). It understands the few commands the bridge sends, and:
+
+# wait,seconds                      sleep
+# message,...                       fail with an IDL error
+# prep_file,"file",out_dir="dir"    copy file to dir/prepped_<file name>
+# name=value                        set variable to a string or number
+# name=fake_array(n)                float array of n elements (result_size
+#                                   bytes if n is not given)
+# name=fake_string(n)               string of n characters
+# name=session_dir("name",...)      new temporary directory (in USER_TMPDIR)
+# name=pyidl_path("name")           path of registered program
+
+# Any other procedure does nothing. Each command from a client takes delay
+# seconds, each call to the session (run, or setting a variable) another
+# overhead seconds, as the IDL bridge has a cost per call, and startup 
+# takes startup_time seconds.
+
+# Example:
+# >>> server.start(backend='fakeidl',backend_options={'delay':0.01})
+# >>> IDL=fakeidl.startup(result_size=1048576)
+# >>> IDL.run('result=fake_array()')
+
+import re
+
+timings=[]
+
+# commands run by the bridge itself, which take no time
+
+HOUSEKEEPING=re.compile(r'^\s*(retall|message,/reset|catch,/cancel|\.reset|help,|!quiet|a=is_pyidl)',re.I)
+ASSIGN=re.compile(r'^\s*(\w+)\s*=\s*(.*?)\s*$')
+CALL=re.compile(r'^(\w+)\s*\((.*)\)$')
+SEPARATOR=re.compile(r'\s+[;&]\s+')
+PREP=re.compile(r'^\s*prep_file\s*,\s*["\']([^"\']+)["\']\s*,\s*out_dir\s*=\s*["\']([^"\']+)["\']',re.I)
+
+class FakeIDL(object):
+
+    def __init__(self,delay=0.,result_size=0,overhead=0.):
+
+        self.__dict__['_vars']={}
+        self.__dict__['_delay']=delay
+        self.__dict__['_result_size']=result_size
+        self.__dict__['_overhead']=overhead
+
+# variables, named without regard to case as in IDL. Undefined ones are None.
+
+    def __getattr__(self,name):
+
+        if name.startswith('__'): raise AttributeError(name)
+        return self._vars.get(name.lower())
+
+    def __setattr__(self,name,value):
+
+        import time
+        if self._overhead: time.sleep(self._overhead)
+        self._vars[name.lower()]=value
+
+###############################################################################
+# run IDL command. Errors are raised as exceptions, as by the IDL bridge.
+
+    def run(self,cmd,stdout=False):
+
+        import time
+        if self._overhead: time.sleep(self._overhead)
+        for part in [c for c in SEPARATOR.split(cmd) if c.strip()]:
+            if HOUSEKEEPING.match(part): continue
+            if part.strip().startswith('extra=hash2struct'):
+                self._vars['extra']=dict(self._vars.get('extra_keywords') or {})
+                continue
+            if self._delay: time.sleep(self._delay)
+            self.command(part.replace(',_extra=extra',''))
+
+    def command(self,cmd):
+
+        import os,shutil,time
+        cmd=cmd.strip()
+        name=cmd.split(',')[0].strip().lower()
+        if name == 'wait':
+            time.sleep(float(cmd.split(',')[1]))
+            return
+        if name == 'message':
+            raise Exception('% '+cmd)
+        match=PREP.match(cmd)
+        if match:
+            infile,out_dir=match.groups()
+            shutil.copyfile(infile,os.path.join(out_dir,'prepped_'+os.path.basename(infile)))
+            self._vars['err']=''
+            return
+        match=ASSIGN.match(cmd)
+        if match:
+            self._vars[match.group(1).lower()]=self.evaluate(match.group(2))
+
+    def evaluate(self,expr):
+
+        import ast,os,tempfile
+        call=CALL.match(expr)
+        if call is None:
+            try:
+                return ast.literal_eval(expr)
+            except (ValueError,SyntaxError):
+                if expr.lower() in self._vars: return self._vars[expr.lower()]
+                raise Exception('% Variable is undefined: '+expr.upper())
+        func=call.group(1).lower()
+        args=[a.strip() for a in call.group(2).split(',') if a.strip() and not a.strip().startswith('/')]
+        if func == 'fake_array':
+            import numpy
+            n=self._result_size//4
+            if args: n=int(args[0])
+            return numpy.arange(n,dtype=numpy.float32)
+        if func == 'fake_string':
+            n=self._result_size
+            if args: n=int(args[0])
+            return 'x'*n
+        if func == 'session_dir':
+            top=os.environ.get('USER_TMPDIR') or tempfile.gettempdir()
+            if args and args[0][0] in '"\'': top=os.path.join(top,ast.literal_eval(args[0]))
+            if not os.path.isdir(top): os.makedirs(top)
+            return tempfile.mkdtemp(prefix='fakeidl_',dir=top)
+        if func == 'pyidl_path':
+            import memo
+            name=ast.literal_eval(args[0])
+            return os.path.join(memo.registered_dir(),name+'.pro')
+        raise Exception('% Function not found: '+func.upper())
+
+###############################################################################
+# start session, as bridge.startup
+
+def startup(warm=False,delay=0.,result_size=0,overhead=0.,startup_time=0.):
+
+    import time
+    del timings[:]
+    tstart=time.time()
+    if startup_time: time.sleep(startup_time)
+    IDL=FakeIDL(delay=delay,result_size=result_size,overhead=overhead)
+    timings.append(('total',time.time()-tstart))
+    return IDL
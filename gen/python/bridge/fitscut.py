@@ -0,0 +1,428 @@
+
+# Partial reads of FITS files for the Python-IDL bridge server
+
+# Reads one HDU of a FITS file on the server, or part of it, so that only
+# the data wanted is sent (the 'fits' action, client.fits):
+
+# hdu      - HDU number (0 is the primary) or EXTNAME
+# rows     - [start,stop] rows of a table, as a Python slice
+# between  - [column,low,high] rows of a table whose column (sorted in
+#            increasing order, e.g. TIME of an event list) is in [low,high]
+# columns  - names of table columns (kept in table order)
+# section  - [start,stop] for each image axis, in numpy order (slowest
+#            varying first); null for the whole axis
+
+# The result is a valid FITS file (cut, which is sent as it is read, a
+# CHUNK at a time) or a numpy array (array). Images keep their header, with
+# NAXISn and CRPIXn updated for the section; tables are written after an
+# empty primary HDU, with their column keywords renumbered. Arrays hold the
+# values as stored, without BSCALE/BZERO or TSCALn/TZEROn applied.
+
+# Files are read with numpy memory maps, so only the bytes selected are
+# read from disk. Compressed (.gz) files are not supported.
+
+# Example:
+# >>> cut=fitscut.cut('hsi_events.fits',hdu='EVENTS',between=['TIME',10.,20.])
+# >>> image=fitscut.array('prepped.fits',section=[[100,200],[100,200]])
+
+import re
+
+BLOCK=2880
+CARD=80
+CHUNK=1048576
+
+BITPIX={8:'u1',16:'>i2',32:'>i4',64:'>i8',-32:'>f4',-64:'>f8'}
+TFORM=re.compile(r'^\s*(\d*)([LXBIJKAEDCMPQ])',re.I)
+TYPES={'L':'S1','B':'u1','I':'>i2','J':'>i4','K':'>i8','A':'S','E':'>f4','D':'>f8',
+       'C':'>c8','M':'>c16','P':'>i4','Q':'>i8'}
+COLUMN_KEYS=('TTYPE','TFORM','TUNIT','TNULL','TSCAL','TZERO','TDISP','TDIM','TBCOL',
+             'TLMIN','TLMAX','TDMIN','TDMAX','TCTYP','TCUNI','TCRVL','TCDLT','TCRPX','TCROT')
+
+class FITSError(Exception):
+    pass
+
+##############################################################################
+# header and location of an HDU
+
+class HDU(object):
+
+    def __init__(self,cards,offset,data_offset):
+
+        self.cards=cards              # 80-character card images, without END
+        self.offset=offset
+        self.data_offset=data_offset
+        self.keys={}
+        for card in cards:
+            key=card[:8].strip()
+            if key and key not in self.keys and card[8:10] == '= ': self.keys[key]=parse_value(card[10:])
+        if 'XTENSION' in self.keys:
+            self.kind=str(self.keys['XTENSION']).strip().upper()
+        else:
+            self.kind='PRIMARY'
+        naxis=int(self.keys.get('NAXIS',0))
+        self.axes=[int(self.keys['NAXIS'+str(i+1)]) for i in range(naxis)]
+        size=0
+        if naxis:
+            size=1
+            for n in self.axes: size *= n
+        self.pcount=int(self.keys.get('PCOUNT',0))
+        gcount=int(self.keys.get('GCOUNT',1))
+        self.bitpix=int(self.keys['BITPIX'])
+        self.data_size=abs(self.bitpix)//8*gcount*(self.pcount+size)
+
+    def get(self,key,default=None):
+
+        return self.keys.get(key,default)
+
+    def name(self):
+
+        return str(self.keys.get('EXTNAME','')).strip()
+
+##############################################################################
+# list HDUs in file, reading only their headers
+
+def read_hdus(filename):
+
+    import os
+    if filename.lower().endswith(('.gz','.fz','.z','.bz2')):
+        raise FITSError('Compressed FITS files are not supported: '+filename)
+    size=os.path.getsize(filename)
+    hdus=[]
+    with open(filename,'rb') as f:
+        offset=0
+        while offset < size:
+            f.seek(offset)
+            cards=read_cards(f)
+            if cards is None:
+                if hdus: break
+                raise FITSError('Not a FITS file: '+filename)
+            data_offset=offset+padded(len(cards)*CARD)
+            hdu=HDU(cards[:-1],offset,data_offset)
+            hdus.append(hdu)
+            offset=data_offset+padded(hdu.data_size)
+    return hdus
+
+# card images of header at current position, up to and including END, or
+# None if there is no header there
+
+def read_cards(f):
+
+    cards=[]
+    while True:
+        block=f.read(BLOCK)
+        if len(block) < BLOCK: return None
+        if not cards and not block.startswith(('SIMPLE  =','XTENSION=')): return None
+        for i in range(0,BLOCK,CARD):
+            card=block[i:i+CARD]
+            cards.append(card)
+            if card[:8] == 'END     ': return cards
+
+def find_hdu(hdus,hdu):
+
+    if type(hdu) in (str,unicode):
+        for h in hdus:
+            if h.name().upper() == str(hdu).upper(): return h
+        raise FITSError('No HDU named '+str(hdu))
+    if hdu < 0 or hdu >= len(hdus): raise FITSError('No HDU %d (file has %d).' % (hdu,len(hdus)))
+    return hdus[hdu]
+
+##############################################################################
+# values in card images
+
+def parse_value(text):
+
+    text=text.strip()
+    if text.startswith("'"):
+        end=1
+        while True:
+            end=text.find("'",end)
+            if end < 0: return text[1:].rstrip()
+            if text[end+1:end+2] != "'": break
+            end += 2
+        return text[1:end].replace("''","'").rstrip()
+    text=text.split('/')[0].strip()
+    if text in ('T','F'): return text == 'T'
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return float(text.replace('D','E').replace('d','e'))
+    except ValueError:
+        return text
+
+def format_card(key,value,comment=''):
+
+    if type(value) == bool:
+        text='%20s' % ('T' if value else 'F')
+    elif type(value) in (int,long):
+        text='%20d' % value
+    elif type(value) == float:
+        text='%20s' % repr(value).upper()
+    else:
+        text="'%-8s'" % str(value).replace("'","''")
+    card='%-8s= %s' % (key,text)
+    if comment: card += ' / '+comment
+    return card[:CARD].ljust(CARD)
+
+def set_card(cards,key,value):
+
+    for i,card in enumerate(cards):
+        if card[:8].strip() == key:
+            comment=''
+            if '/' in card[10:] and not card[10:].strip().startswith("'"): comment=card[10:].split('/',1)[1].strip()
+            cards[i]=format_card(key,value,comment)
+            return
+    cards.append(format_card(key,value))
+
+def header_bytes(cards):
+
+    data=''.join(cards)+'END'.ljust(CARD)
+    return data.ljust(padded(len(data)))
+
+def padded(size):
+
+    return (size+BLOCK-1)//BLOCK*BLOCK
+
+##############################################################################
+# images
+
+def image_section(hdu,section):
+
+    if not hdu.axes: raise FITSError('HDU has no data.')
+    shape=list(reversed(hdu.axes))
+    section=section or []
+    if len(section) > len(shape): raise FITSError('Section has %d axes, image has %d.' % (len(section),len(shape)))
+    slices=[]
+    for i,n in enumerate(shape):
+        limits=None
+        if i < len(section): limits=section[i]
+        if limits is None:
+            slices.append(slice(0,n))
+        else:
+            start,stop,step=slice(limits[0],limits[1]).indices(n)
+            if stop <= start: raise FITSError('Empty section on axis %d.' % i)
+            slices.append(slice(start,stop))
+    return slices
+
+def image_map(filename,hdu):
+
+    import numpy
+    if hdu.bitpix not in BITPIX: raise FITSError('Unsupported BITPIX %d.' % hdu.bitpix)
+    shape=tuple(reversed(hdu.axes))
+    return numpy.memmap(filename,dtype=BITPIX[hdu.bitpix],mode='r',offset=hdu.data_offset,shape=shape)
+
+def image_cards(hdu,slices):
+
+    cards=list(hdu.cards)
+    if hdu.kind != 'PRIMARY':
+        cards[0]=format_card('SIMPLE',True,'conforms to FITS standard')
+        cards=[c for c in cards if c[:8].strip() not in ('PCOUNT','GCOUNT')]
+    naxis=len(hdu.axes)
+    for i,s in enumerate(slices):
+        axis=naxis-i
+        set_card(cards,'NAXIS'+str(axis),s.stop-s.start)
+        crpix='CRPIX'+str(axis)
+        if s.start and crpix in hdu.keys: set_card(cards,crpix,float(hdu.keys[crpix])-s.start)
+    return cards
+
+##############################################################################
+# tables
+
+def table_dtype(hdu):
+
+    import numpy
+    if hdu.kind != 'BINTABLE': raise FITSError('Not a binary table: '+hdu.kind)
+    fields=[]
+    for i in range(int(hdu.get('TFIELDS',0))):
+        tform=str(hdu.get('TFORM'+str(i+1),''))
+        match=TFORM.match(tform)
+        if match is None: raise FITSError('Unsupported TFORM: '+tform)
+        repeat=int(match.group(1) or 1)
+        code=match.group(2).upper()
+        name=str(hdu.get('TTYPE'+str(i+1),'') or 'COL'+str(i+1))
+        if code == 'X':
+            fields.append((name,'u1',((repeat+7)//8,)))
+        elif code == 'A':
+            fields.append((name,'S'+str(max(repeat,1))))
+        elif code in 'PQ':
+            fields.append((name,TYPES[code],(2,)))
+        elif repeat == 1:
+            fields.append((name,TYPES[code]))
+        elif repeat > 1:
+            fields.append((name,TYPES[code],(repeat,)))
+    dtype=numpy.dtype(fields)
+    if dtype.itemsize != hdu.axes[0]: raise FITSError('Row size does not match NAXIS1.')
+    return dtype
+
+def table_map(filename,hdu):
+
+    import numpy
+    return numpy.memmap(filename,dtype=table_dtype(hdu),mode='r',offset=hdu.data_offset,shape=(hdu.axes[1],))
+
+# row range from rows or between
+
+def table_rows(table,rows=None,between=None):
+
+    import numpy
+    start,stop=0,len(table)
+    if rows:
+        start,stop,step=slice(rows[0],rows[1]).indices(len(table))
+    if between:
+        column,low,high=between
+        values=table[str(column)]
+        if values.ndim > 1: raise FITSError('Column is not a scalar: '+str(column))
+        start=max(start,int(numpy.searchsorted(values,low,'left')))
+        stop=min(stop,int(numpy.searchsorted(values,high,'right')))
+    return (start,max(start,stop))
+
+# names of columns, in the order they are in the table
+
+def table_columns(dtype,columns):
+
+    if not columns: return list(dtype.names)
+    names=[]
+    upper=dict([(n.upper(),n) for n in dtype.names])
+    for column in columns:
+        name=upper.get(str(column).upper())
+        if name is None: raise FITSError('No column '+str(column))
+        if name not in names: names.append(name)
+    return [n for n in dtype.names if n in names]
+
+def table_cards(hdu,names,nrows,row_size,heap_size):
+
+    all_names=table_dtype(hdu).names
+    numbers=dict([(name,all_names.index(name)+1) for name in names])
+    cards=[format_card('XTENSION','BINTABLE','binary table extension')]
+    for card in hdu.cards[1:]:
+        key=card[:8].strip()
+        match=re.match(r'^([A-Z]+)(\d+)$',key)
+        if match and match.group(1) in COLUMN_KEYS:
+            n=int(match.group(2))
+            if n not in numbers.values(): continue
+            key=match.group(1)+str(sorted(numbers.values()).index(n)+1)
+            card=key.ljust(8)+card[8:]
+        elif key == 'THEAP':
+            continue
+        cards.append(card)
+    set_card(cards,'NAXIS1',row_size)
+    set_card(cards,'NAXIS2',nrows)
+    set_card(cards,'PCOUNT',heap_size)
+    set_card(cards,'TFIELDS',len(names))
+    return cards
+
+# selected fields of rows, packed as in a FITS table
+
+def pack(rows,dtype,names):
+
+    import numpy
+    if list(names) == list(dtype.names): return numpy.ascontiguousarray(rows)
+    out=numpy.empty(len(rows),dtype=numpy.dtype([dtype.descr[dtype.names.index(n)] for n in names]))
+    for name in names: out[name]=rows[name]
+    return out
+
+##############################################################################
+# FITS file of selection, as a source of bytes (read(count), remaining,
+# close(), as tools.FileSource) that reads the data a CHUNK at a time
+
+class Cut(object):
+
+    def __init__(self,chunks,size):
+
+        self.chunks=chunks
+        self.remaining=size
+        self.size=size
+        self.buf=''
+
+    def read(self,count):
+
+        while len(self.buf) < count and self.chunks is not None:
+            try:
+                self.buf += next(self.chunks)
+            except StopIteration:
+                self.chunks=None
+        data=self.buf[:count]
+        self.buf=self.buf[count:]
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+
+        self.chunks=None
+        self.buf=''
+
+def cut(filename,hdu=0,rows=None,between=None,columns=None,section=None):
+
+    hdus=read_hdus(filename)
+    h=find_hdu(hdus,hdu)
+    if h.kind in ('PRIMARY','IMAGE'):
+        if rows or between or columns: raise FITSError('rows, between and columns apply to tables.')
+        image=image_map(filename,h)
+        slices=image_section(h,section)
+        head=header_bytes(image_cards(h,slices))
+        part=image[tuple(slices)]
+        nbytes=part.size*part.itemsize
+        return Cut(chain(head,image_chunks(part),nbytes,'\0'),len(head)+padded(nbytes))
+    if section: raise FITSError('section applies to images.')
+    table=table_map(filename,h)
+    start,stop=table_rows(table,rows,between)
+    names=table_columns(table.dtype,columns)
+    heap_start=h.axes[0]*h.axes[1]
+    heap_size=0
+    if h.pcount:
+        heap_start=int(h.get('THEAP',heap_start))
+        heap_size=h.pcount-(heap_start-h.axes[0]*h.axes[1])
+    row_size=pack(table[:0],table.dtype,names).dtype.itemsize
+    primary=header_bytes([format_card('SIMPLE',True,'conforms to FITS standard'),format_card('BITPIX',8),
+                          format_card('NAXIS',0),format_card('EXTEND',True)])
+    head=primary+header_bytes(table_cards(h,names,stop-start,row_size,heap_size))
+    nbytes=(stop-start)*row_size+heap_size
+    chunks=table_chunks(table,start,stop,names,filename,h.data_offset+heap_start,heap_size)
+    return Cut(chain(head,chunks,nbytes,'\0'),len(head)+padded(nbytes))
+
+def chain(head,chunks,nbytes,pad):
+
+    yield head
+    for chunk in chunks: yield chunk
+    yield pad*(padded(nbytes)-nbytes)
+
+def image_chunks(part):
+
+    import numpy
+    if part.ndim == 0 or part.size == 0: return
+    rows=max(1,CHUNK//max(1,part[0].size*part.itemsize)) if part.ndim > 1 else max(1,CHUNK//part.itemsize)
+    for i in range(0,len(part),rows):
+        yield numpy.ascontiguousarray(part[i:i+rows]).tobytes()
+
+def table_chunks(table,start,stop,names,filename,heap_offset,heap_size):
+
+    rows=max(1,CHUNK//table.dtype.itemsize)
+    for i in range(start,stop,rows):
+        yield pack(table[i:min(i+rows,stop)],table.dtype,names).tobytes()
+    if heap_size:
+        with open(filename,'rb') as f:
+            f.seek(heap_offset)
+            left=heap_size
+            while left > 0:
+                data=f.read(min(CHUNK,left))
+                if not data: raise FITSError('File truncated.')
+                left -= len(data)
+                yield data
+
+##############################################################################
+# selection as numpy array, and header cards of the HDU it is from
+
+def array(filename,hdu=0,rows=None,between=None,columns=None,section=None):
+
+    import numpy
+    hdus=read_hdus(filename)
+    h=find_hdu(hdus,hdu)
+    if h.kind in ('PRIMARY','IMAGE'):
+        if rows or between or columns: raise FITSError('rows, between and columns apply to tables.')
+        slices=image_section(h,section)
+        return (numpy.array(image_map(filename,h)[tuple(slices)]),image_cards(h,slices))
+    if section: raise FITSError('section applies to images.')
+    table=table_map(filename,h)
+    start,stop=table_rows(table,rows,between)
+    names=table_columns(table.dtype,columns)
+    return (pack(table[start:stop],table.dtype,names),list(h.cards))
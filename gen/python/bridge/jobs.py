@@ -0,0 +1,168 @@
+
+# Jobs for the Python-IDL bridge server
+
+# Long-running IDL commands (e.g. prep_file) are submitted as jobs and run
+# in the background, so the client need not hold a connection open while
+# they run. Submitting returns a job id at once. The client can then ask
+# for the job's status, wait for it (the reply is sent as soon as the job
+# finishes, or when the wait times out) and fetch its result. Files in the
+# job's directory when it finishes are listed as its outputs.
+
+# Jobs are run by the server's executor (workers.py) rather than by IDL's
+# thread procedure: a command started with thread runs in a child IDL
+# process that does not report back to the session that started it, so the
+# server would have to poll for its outputs, while a job run as a command
+# calls back as soon as it finishes. With size 0 jobs share the server's
+# IDL sessions, taking no extra licence: they wait behind other commands,
+# and while one runs it holds a session other requests could use (with a
+# single IDL thread, all of them). With size > 0 they get their own pool
+# of that many worker processes, started on the first submit, or at once
+# if warm is set. server.start uses size 0 only when it has worker
+# processes, unless job_workers is given.
+
+# Finished jobs are kept for ttl seconds. If metrics is set, the run
+# time of each job is recorded in it. If scratch is set (see scratch.py),
+# the job's directory is held there until the job is forgotten, and
+# sessions its commands name until it finishes.
+
+# Example:
+# >>> import client
+# >>> job=client.submit('prep_file,"'+file+'",out_dir="'+tdir+'"',job_dir=tdir)
+# >>> status=client.wait(job,timeout=600)
+# >>> status['outputs']
+
+WAIT_MAX=300.          # longest time in seconds a wait request is held
+
+class Job(object):
+
+    def __init__(self,id,task,job_dir=None):
+
+        import time
+        self.id=id
+        self.task=task                # IDL job run by worker (see server.run_job)
+        self.job_dir=job_dir
+        self.state='running'          # running, done or failed
+        self.reply=None
+        self.error=''
+        self.outputs=[]
+        self.submitted=time.time()
+        self.finished=None
+        self.waiters=[]
+
+    def status(self):
+
+        return {'job':self.id,'state':self.state,'error':self.error,
+                'outputs':self.outputs,'submitted':self.submitted,
+                'finished':self.finished}
+
+##############################################################################
+
+class JobManager(object):
+
+    def __init__(self,loop,size=0,queue_size=100,ttl=3600,warm=False,backend=None,executor=None):
+
+        self.loop=loop
+        self.size=size
+        self.queue_size=queue_size
+        self.ttl=ttl
+        self.warm=warm
+        self.backend=backend
+        self.pool=None
+        self.shared=None
+        if size <= 0: self.shared=executor
+        self.jobs={}
+        self.metrics=None
+        self.scratch=None
+        loop.call_later(60.,self.purge)
+        if warm: self.start()
+
+    def start(self):
+
+        import workers
+        if self.pool is None:
+            self.pool=self.shared or workers.WorkerPool(max(self.size,1),self.loop,queue_size=self.queue_size,warm=self.warm,backend=self.backend)
+
+# number of jobs that can run at once
+
+    def workers(self):
+
+        if self.shared: return self.shared.sessions()[1]
+        return max(self.size,1)
+
+###############################################################################
+# start IDL job. Returns Job, or None if the job queue is full.
+
+    def submit(self,task,job_dir=None):
+
+        import uuid
+        self.start()
+        job=Job(uuid.uuid4().hex,task,job_dir)
+        task['stateless']=1           # not tied to a client's session
+        held=[]
+        if self.scratch: held=self.scratch.hold_job(task)
+        def done(reply):
+            for session in held: self.scratch.release(session)
+            self.done(job,reply)
+        if not self.pool.submit(task,done,owner=job):
+            for session in held: self.scratch.release(session)
+            return None
+        self.jobs[job.id]=job
+        if self.scratch and job_dir: self.scratch.hold(job_dir)
+        print("Started job "+job.id)
+        return job
+
+    def get(self,id):
+
+        return self.jobs.get(id)
+
+    def running(self):
+
+        return len([job for job in self.jobs.values() if not job.finished])
+
+    def done(self,job,reply):
+
+        import os,time
+        job.reply=reply
+        job.error=reply[1]
+        job.state='failed' if job.error else 'done'
+        job.finished=time.time()
+        if self.metrics: self.metrics.observe('job',job.finished-job.submitted)
+        if job.job_dir and os.path.isdir(job.job_dir):
+            names=sorted(os.listdir(job.job_dir))
+            job.outputs=[os.path.join(job.job_dir,n) for n in names if os.path.isfile(os.path.join(job.job_dir,n))]
+        print("Job "+job.id+" "+job.state)
+        waiters,job.waiters=job.waiters,[]
+        for callback in waiters: callback(job)
+
+###############################################################################
+# call callback(job) when job finishes, or after timeout seconds
+
+    def wait(self,job,callback,timeout=WAIT_MAX):
+
+        if job.finished:
+            callback(job)
+            return
+        job.waiters.append(callback)
+        def expire():
+            if callback in job.waiters:
+                job.waiters.remove(callback)
+                callback(job)
+        self.loop.call_later(min(timeout,WAIT_MAX),expire)
+
+###############################################################################
+# forget jobs finished more than ttl seconds ago
+
+    def purge(self):
+
+        import time
+        now=time.time()
+        for id,job in list(self.jobs.items()):
+            if job.finished and now-job.finished > self.ttl: 
+                del self.jobs[id]
+                if self.scratch and job.job_dir: self.scratch.release(job.job_dir)
+        self.loop.call_later(60.,self.purge)
+
+    def close(self):
+
+        if self.pool and self.pool is not self.shared: self.pool.close()
+        self.pool=None
@@ -0,0 +1,137 @@
+
+# Result cache for idempotent IDL commands of the Python-IDL bridge
+
+# Lookups such as pyidl_path("rhessi_event_list") return the same result
+# every time, so their results are kept and returned without running IDL.
+# Commands are cached if the client marks them idempotent or they match one
+# of the allow patterns. Entries expire after ttl seconds, the least
+# recently used are dropped beyond max_entries, and the server cache is
+# cleared when the contents of the registered programs directory
+# ($PYIDL_REGISTERED) change. Only results without errors are kept.
+
+# The client keeps its own cache (client_cache) with the same keys. A
+# cache may be used from several threads at once.
+
+# Example:
+# >>> client.run('result=pyidl_path("rhessi_event_list")',is_function=1)
+# >>> client.run('result=my_config()',is_function=1,idempotent=True)
+
+import collections,threading
+
+ALLOW=[r'^\s*result\s*=\s*pyidl_path\s*\(']
+CHECK_INTERVAL=1.      # seconds between checks of registered directory
+MISSING=object()
+
+class MemoCache(object):
+
+    def __init__(self,max_entries=1000,ttl=300.,allow=ALLOW,watch=None):
+
+        import re
+        self.max_entries=max_entries
+        self.ttl=ttl
+        self.allow=[re.compile(p) for p in allow]
+        self.watch=watch              # directory whose changes clear cache
+        self.entries=collections.OrderedDict()     # key -> (expires,value)
+        self.lock=threading.Lock()    # entries, signature and counts
+        self.signature=None
+        self.checked=0.
+        self.hits=0
+        self.misses=0
+
+###############################################################################
+# True if result of command may be cached
+
+    def cacheable(self,cmd,idempotent=False):
+
+        if self.max_entries <= 0: return False
+        if idempotent: return True
+        for pattern in self.allow:
+            if pattern.search(cmd): return True
+        return False
+
+###############################################################################
+# return cached value for key, or MISSING
+
+    def get(self,key):
+
+        import time
+        now=time.time()
+        with self.lock:
+            self.check(now)
+            entry=self.entries.pop(key,None)
+            if entry is None or entry[0] < now:
+                self.misses += 1
+                return MISSING
+            self.entries[key]=entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self,key,value):
+
+        import time
+        with self.lock:
+            self.entries.pop(key,None)
+            self.entries[key]=(time.time()+self.ttl,value)
+            while len(self.entries) > self.max_entries: self.entries.popitem(last=False)
+
+    def clear(self):
+
+        with self.lock:
+            self.entries.clear()
+
+###############################################################################
+# clear cache if watched directory has changed since last check (called
+# with lock held)
+
+    def check(self,now):
+
+        if not self.watch or now-self.checked < CHECK_INTERVAL: return
+        self.checked=now
+        signature=dir_signature(self.watch)
+        if self.signature is not None and signature != self.signature:
+            print("Registered programs changed. Clearing result cache.")
+            self.entries.clear()
+        self.signature=signature
+
+##############################################################################
+# cache key for command with keywords
+
+def key(cmd,is_function,keywords):
+
+    import json
+    is_function=1 if str(is_function) in ('1','True') else 0
+    return json.dumps([cmd,is_function,keywords or {}],sort_keys=True)
+
+##############################################################################
+# directory of registered programs
+
+def registered_dir():
+
+    import os
+    rdir=os.environ.get('PYIDL_REGISTERED')
+    if rdir: return rdir
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)),'registered')
+
+##############################################################################
+# names, sizes and modification times of files in directory
+
+def dir_signature(path):
+
+    import os
+    try:
+        names=sorted(os.listdir(path))
+    except OSError:
+        return None
+    signature=[]
+    for name in names:
+        try:
+            st=os.stat(os.path.join(path,name))
+        except OSError:
+            continue
+        signature.append((name,st.st_size,st.st_mtime))
+    return signature
+
+##############################################################################
+# cache of results on client, keyed by server address and command key
+
+client_cache=MemoCache(max_entries=256,ttl=60.)
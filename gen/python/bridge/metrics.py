@@ -0,0 +1,175 @@
+
+# Metrics for the Python-IDL bridge server
+
+# The server keeps a Metrics registry of requests handled, per action:
+# count, errors, bytes received and sent, and a histogram of latency (from
+# the request arriving until its response has been sent). Named timers
+# split that time up:
+
+# queue    - wait for a free IDL session
+# idl      - IDL execution (execute, batch and get requests)
+# transfer - receiving uploads and sending responses, including files
+# job      - submitted jobs, from submit until finished
+
+# so a slow request can be put down to queueing, IDL or the network.
+# Metrics are returned by the stats action (client.stats()) together with
+# gauges of the server's current state, and can be written to a file at
+# intervals (server.start(stats_file=...)).
+
+# Example:
+# >>> stats=client.stats()
+# >>> stats['actions']['execute']['latency']['p90']
+# >>> print(metrics.report(stats))
+
+import collections
+
+BUCKETS=(0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.,2.5,5.,10.,30.,60.,300.)
+
+class Histogram(object):
+
+    def __init__(self,buckets=BUCKETS):
+
+        self.buckets=buckets          # upper bounds in seconds
+        self.counts=[0]*(len(buckets)+1)
+        self.count=0
+        self.total=0.
+        self.min=None
+        self.max=None
+
+    def observe(self,value):
+
+        import bisect
+        self.counts[bisect.bisect_left(self.buckets,value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min: self.min=value
+        if self.max is None or value > self.max: self.max=value
+
+###############################################################################
+# upper bound of bucket holding fraction q of values (largest value if
+# beyond the last bucket)
+
+    def quantile(self,q):
+
+        if not self.count: return None
+        rank=q*self.count
+        seen=0
+        for i,n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                if i >= len(self.buckets): return self.max
+                return min(self.buckets[i],self.max)
+        return self.max
+
+    def snapshot(self):
+
+        mean=None
+        if self.count: mean=self.total/self.count
+        bounds=[str(b) for b in self.buckets]+['inf']
+        return {'count':self.count,'sum':self.total,'mean':mean,'min':self.min,
+                'max':self.max,'p50':self.quantile(.5),'p90':self.quantile(.9),
+                'p99':self.quantile(.99),'buckets':[list(b) for b in zip(bounds,self.counts) if b[1]]}
+
+##############################################################################
+# registry of counts and timings. Timers may be observed from any thread
+# (e.g. the IDL thread).
+
+class Metrics(object):
+
+    def __init__(self):
+
+        import threading
+        self.lock=threading.Lock()
+        self.reset()
+
+    def reset(self):
+
+        import time
+        with self.lock:
+            self.tstart=time.time()
+            self.actions={}           # action -> counts and latency histogram
+            self.timers={}            # name -> Histogram
+            self.counters=collections.defaultdict(int)
+
+    def count(self,name,n=1):
+
+        with self.lock:
+            self.counters[name] += n
+
+    def observe(self,name,seconds):
+
+        with self.lock:
+            timer=self.timers.get(name)
+            if timer is None: timer=self.timers[name]=Histogram()
+            timer.observe(seconds)
+
+###############################################################################
+# record request for action that took seconds and transferred bytes
+
+    def request(self,action,seconds,error=False,bytes_in=0,bytes_out=0):
+
+        with self.lock:
+            stats=self.actions.get(action)
+            if stats is None:
+                stats=self.actions[action]={'count':0,'errors':0,'bytes_in':0,'bytes_out':0,'latency':Histogram()}
+            stats['count'] += 1
+            if error: stats['errors'] += 1
+            stats['bytes_in'] += bytes_in
+            stats['bytes_out'] += bytes_out
+            stats['latency'].observe(seconds)
+            self.counters['bytes_in'] += bytes_in
+            self.counters['bytes_out'] += bytes_out
+
+###############################################################################
+# metrics as dict (for JSON), with gauges of current state added
+
+    def snapshot(self,gauges=None):
+
+        import time
+        with self.lock:
+            actions={}
+            for action,stats in self.actions.items():
+                entry=dict(stats)
+                entry['error_rate']=float(stats['errors'])/stats['count']
+                entry['latency']=stats['latency'].snapshot()
+                actions[action]=entry
+            timers=dict([(name,timer.snapshot()) for name,timer in self.timers.items()])
+            counters=dict(self.counters)
+            period=time.time()-self.tstart
+        return {'time':time.time(),'period':period,'actions':actions,'timers':timers,
+                'counters':counters,'gauges':gauges or {}}
+
+##############################################################################
+# write snapshot to file as JSON, replacing file in one step
+
+def dump(stats,filename):
+
+    import json,os
+    temp=filename+'.'+str(os.getpid())
+    try:
+        with open(temp,'w') as f: json.dump(stats,f,indent=1,sort_keys=True)
+        os.rename(temp,filename)
+    except (IOError,OSError) as e:
+        print("Error writing stats: "+str(e))
+
+##############################################################################
+# stats as text table
+
+def report(stats):
+
+    def ms(value):
+        if value is None: return '-'
+        return '%.1f' % (value*1000.)
+
+    lines=['%-10s %7s %6s %10s %10s %8s %8s %8s %8s' % ('action','count','errors','bytes_in','bytes_out','mean_ms','p50_ms','p90_ms','max_ms')]
+    for action in sorted(stats['actions']):
+        a=stats['actions'][action]
+        l=a['latency']
+        lines.append('%-10s %7d %6d %10d %10d %8s %8s %8s %8s' % (action,a['count'],a['errors'],a['bytes_in'],a['bytes_out'],
+                     ms(l['mean']),ms(l['p50']),ms(l['p90']),ms(l['max'])))
+    for name in sorted(stats['timers']):
+        t=stats['timers'][name]
+        lines.append('%-10s %7d %6s %10s %10s %8s %8s %8s %8s' % (name,t['count'],'','','',ms(t['mean']),ms(t['p50']),ms(t['p90']),ms(t['max'])))
+    gauges=stats.get('gauges',{})
+    if gauges: lines.append(' '.join(['%s=%s' % (k,gauges[k]) for k in sorted(gauges)]))
+    return '\n'.join(lines)
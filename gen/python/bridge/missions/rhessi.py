@@ -4,7 +4,7 @@
 
 def tevent_list(*args,**kwargs):
 
-    import client,os,tools,time
+    import client,os,tools
 
     thread=False
     if 'thread' in kwargs: thread=kwargs['thread']
@@ -22,48 +22,48 @@ def tevent_list(*args,**kwargs):
         print("No write access to: "+ldir)
         return None
 	
-# check if program is registered
+# check if program is registered and determine temp directory on server
+# where to save result
 
+    options,keywords=client.split_kwargs(kwargs)
+    keywords.pop('thread',None)
     rfile='rhessi_event_list'
-    cmd='result=pyidl_path("'+rfile+'",err=err)'
-    rdir=client.run(cmd)
+    cmds=['result=pyidl_path("'+rfile+'",err=err)','result=session_dir()']
+    results=client.run_batch(cmds,**options)
+    if not results: return None
+    rdir=results[0][0]
     if not rdir:
         print("Unregistered program: "+rfile)
         return None
-    
-# determine temp directory on server where to save result
-
-    tdir=client.run('result=session_dir()')
+    tdir=results[1][0]
     if not tdir: return None
    
-# run program in registered directory
+# run program in registered directory, as a server job in thread mode
 
     lname=os.path.basename(lfile)
     tfile=os.path.join(tdir,lname)
-    cmd='cd,'+'"'+rdir+'"'
-    client.run(cmd)
     cmd=rfile+','+'"'+tfile+'"'
-    if thread: cmd=cmd+',/thread'
-    client.run(cmd,**kwargs)
+    cmds=['cd,'+'"'+rdir+'"',{'command':cmd,'keywords':keywords}]
+    if thread:
+        job=client.submit(cmds,stop_on_error=True,job_dir=tdir,**options)
+        if not job: return None
+        print("Waiting for results...")
+        wopts=options.copy()
+        wopts.pop('timeout',None)
+        if not client.wait(job,timeout=timeout,**wopts):
+            print("Server timed out.")
+            return
+    else:
+        client.run_batch(cmds,stop_on_error=True,**options)
 
 # download output file
 
-    print("Waiting for results...")
-    if thread:
-        tstart=time.time()
-        while True:    
-            f=client.download(tfile,**kwargs)
-            elapsed=time.time()-tstart
-            if f or elapsed > timeout: break
-            time.sleep(3)
-            print("Waiting for results...")
-    else:
-        f=client.download(tfile,**kwargs)
+    f=client.download(tfile,**kwargs)
     
     if f: 
         print("Results downloaded in file: "+f)
     else:
-        print("Server timed out.")
+        print("Event list failed.")
     return
 
 
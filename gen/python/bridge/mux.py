@@ -0,0 +1,417 @@
+
+# Multiplexed client connection to the Python-IDL bridge server
+
+# A Channel is one connection using protocol version 2 (see tools.VERSION),
+# on which any number of requests may be in flight at once, from one thread
+# or several. Each request is tagged with an id; a reader thread matches
+# responses to their requests as they arrive, in whatever order the server
+# finishes them. Uploads are sent as DATA frames, so a large upload from
+# one thread does not hold up a short command from another.
+
+# Calls return as the functions of client.py do: run returns the result
+# (None on error, which is printed), run_batch a list of (result,error).
+
+# Example:
+# >>> import mux
+# >>> channel=mux.connect('localhost',10000)
+# >>> channel.run('a=findgen(10)')
+# >>> a=channel.get('a')
+# >>> location=channel.upload(file)
+# >>> channel.download(location,outdir='/tmp')
+# >>> channel.close()
+
+import threading
+
+##############################################################################
+# request in flight: response header and payloads (arrays or file) as they
+# arrive. event is set once the response is complete, and callbacks added
+# by add_callback are then called (in the reader thread) with the Call.
+
+class Call(object):
+
+    def __init__(self,outfile=None):
+
+        self.event=threading.Event()
+        self.header=None
+        self.error=''
+        self.outfile=outfile          # download: file to write to
+        self.file=None
+        self.sizes=[]                 # bytes expected in each payload
+        self.payloads=[]
+        self.received=0
+        self.callbacks=[]
+        self.lock=threading.Lock()
+
+    def expect(self,header):
+
+        self.header=header
+        if header.get('error'): return
+        if header.get('path') or header.get('shm'):
+            pass
+        elif header.get('action') == 'download' or (header.get('action') == 'fits' and header.get('type') != 'array'):
+            self.sizes=[long(header['size'])]
+            if self.outfile: self.file=open(self.outfile,'wb')
+        elif header.get('action') == 'batch':
+            self.sizes=[long(r['size']) for r in header['results'] if r.get('type') == 'array' and not r.get('shm')]
+        elif header.get('type') == 'array':
+            self.sizes=[long(header['size'])]
+        self.payloads=[bytearray() for size in self.sizes]
+
+# add DATA frame body to payloads. Returns True once all have arrived.
+
+    def feed(self,body):
+
+        self.received += len(body)
+        if self.file:
+            self.file.write(body)
+        else:
+            for i,size in enumerate(self.sizes):
+                n=min(len(body),size-len(self.payloads[i]))
+                if n <= 0: continue
+                self.payloads[i].extend(body[:n])
+                body=body[n:]
+        return self.complete()
+
+    def complete(self):
+
+        return self.received >= sum(self.sizes)
+
+    def finish(self,error=''):
+
+        with self.lock:
+            if self.event.is_set(): return
+            if self.file: self.file.close()
+            self.file=None
+            if error and not self.error: self.error=error
+            self.event.set()
+            callbacks,self.callbacks=self.callbacks,[]
+        for callback in callbacks: callback(self)
+
+    def add_callback(self,callback):
+
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+##############################################################################
+
+class Channel(object):
+
+    def __init__(self,sock,codec='',verbose=False):
+
+        import itertools
+        self.sock=sock
+        self.codec=codec
+        self.verbose=verbose
+        self.calls={}                 # request id -> Call
+        self.lock=threading.Lock()    # calls and request ids
+        self.send_lock=threading.Lock()
+        self.ids=itertools.count(1)
+        self.closed=False
+        self.reader=threading.Thread(target=self.read)
+        self.reader.daemon=True
+        self.reader.start()
+
+# read frames until the connection closes, completing calls. A response
+# that cannot be read (a malformed header, or a file that cannot be
+# written) fails its call only; calls still waiting when the reader stops
+# fail with 'Server not responding.'
+
+    def read(self):
+
+        import json,socket
+        import tools
+        try:
+            while True:
+                try:
+                    frame=tools.read_frame(self.sock,self.codec)
+                except (socket.error,IOError,ValueError) as e:
+                    if self.verbose: print("Socket error: "+str(e))
+                    frame=None
+                if frame is None: break
+                rid,ftype,body=frame
+                with self.lock:
+                    call=self.calls.get(rid)
+                if call is None: continue
+                try:
+                    if ftype == tools.HEADER:
+                        call.expect(json.loads(body))
+                        done=call.complete()
+                    else:
+                        done=call.feed(body)
+                except Exception as e:
+                    call.error=str(e) or e.__class__.__name__
+                    done=True
+                if done:
+                    with self.lock:
+                        self.calls.pop(rid,None)
+                    call.finish()
+        finally:
+            self.closed=True
+            with self.lock:
+                calls,self.calls=self.calls,{}
+            for call in calls.values(): call.finish('Server not responding.')
+
+    def send(self,rid,ftype,body,codec=None):
+
+        import tools
+        frame=tools.pack_frame(rid,ftype,body,codec)
+        with self.send_lock:
+            self.sock.sendall(frame)
+
+###############################################################################
+# send request tdict, then DATA frames of file if given. Returns Call.
+
+    def begin(self,tdict,outfile=None,upload=None):
+
+        import json,socket
+        import tools
+        call=Call(outfile)
+        with self.lock:
+            rid=next(self.ids)
+            self.calls[rid]=call
+        try:
+            if self.closed: raise socket.error('Connection closed.')
+            self.send(rid,tools.HEADER,json.dumps(tdict),self.codec)
+            if upload:
+                codec=None
+                if self.codec and tools.compressible(upload,tdict['size']): codec=self.codec
+                with open(upload,'rb') as f:
+                    while True:
+                        data=f.read(tools.DATA_CHUNK)
+                        if not data: break
+                        self.send(rid,tools.DATA,data,codec)
+        except (socket.error,IOError) as e:
+            with self.lock:
+                self.calls.pop(rid,None)
+            call.finish(str(e))
+        return call
+
+# send request and wait for its response. Returns Call, with error set if
+# the request failed.
+
+    def call(self,tdict,timeout=None,outfile=None,upload=None):
+
+        call=self.begin(tdict,outfile,upload)
+        if not call.event.wait(timeout): self.forget(call,'Timed out.')
+        if not call.error and call.header: call.error=str(call.header.get('error',''))
+        return call
+
+# stop waiting for call, finishing it with error. A late response to it is
+# discarded.
+
+    def forget(self,call,error):
+
+        if call.event.is_set(): return
+        with self.lock:
+            self.calls=dict([(k,c) for k,c in self.calls.items() if c is not call])
+        call.finish(error)
+
+###############################################################################
+
+    def run(self,cmd,is_function=0,timeout=None,**keywords):
+
+        tdict={'action':'execute','command':cmd,'is_function':int(bool(is_function)),'keywords':keywords}
+        call=self.call(tdict,timeout)
+        if call.error:
+            print("Error: "+call.error)
+            return None
+        return self.result(call.header,call.payloads)
+
+    def run_batch(self,commands,stop_on_error=0,timeout=None):
+
+        import client
+        items=client.batch_items(commands)
+        if items is None: return None
+        tdict={'action':'batch','commands':items,'stop_on_error':int(bool(stop_on_error))}
+        call=self.call(tdict,timeout)
+        if call.header is None:
+            print("Error: "+call.error)
+            return None
+        payloads=list(call.payloads)
+        response=[]
+        for header in call.header['results']:
+            if header.get('type') == 'array' and not header.get('shm'):
+                response.append((self.result(header,[payloads.pop(0)]),str(header['error'])))
+            else:
+                response.append((self.result(header,[]),str(header['error'])))
+        return response
+
+    def get(self,name,timeout=None):
+
+        call=self.call({'action':'get','name':name},timeout)
+        if call.error:
+            print("Error: "+call.error)
+            return None
+        return self.result(call.header,call.payloads)
+
+    def ping(self,wait=0,timeout=None):
+
+        call=self.call({'action':'ping','wait':wait},timeout)
+        if call.header is None: return None
+        return call.header
+
+# upload file. Returns its location on the server, or None. Over a Unix
+# socket the server takes the file by path instead.
+
+    def upload(self,filename,timeout=None):
+
+        import os
+        import tools
+        filename=tools.expand_name(filename)
+        if not os.path.isfile(filename):
+            print("Non-existent file: "+filename)
+            return None
+        if tools.is_unix(self.sock):
+            call=self.call({'action':'link','filename':os.path.abspath(filename)},timeout)
+            if not call.error: return str(call.header['filename'])
+        tdict={'action':'upload','filename':os.path.basename(filename),'size':os.path.getsize(filename)}
+        call=self.call(tdict,timeout,upload=filename)
+        if call.error:
+            print("Error: "+call.error)
+            return None
+        return str(call.header['filename'])
+
+# download file from server to outdir (current directory by default). The
+# file is written under a temporary name and renamed once complete, or
+# over a Unix socket linked from where the server has it. Returns local 
+# file name, or None.
+
+    def download(self,filename,outdir=None,timeout=None):
+
+        import os
+        import tools
+        if outdir is None: outdir=os.getcwd()
+        if not make_dir(outdir): return None
+        local=os.path.join(outdir,os.path.basename(filename))
+        part=local+'.part'
+        tdict={'action':'download','filename':filename}
+        if tools.is_unix(self.sock): tdict['link']=1
+        call=self.call(tdict,timeout,outfile=part)
+        local,error=finish_download(call,local,outdir,filename)
+        if error: print("Error: "+error)
+        return local
+
+# part of FITS file on server, as client.fits. Returns local file name or
+# array, or None.
+
+    def fits(self,filename,format='fits',outdir=None,timeout=None,**options):
+
+        import os
+        tdict={'action':'fits','filename':filename,'format':format}
+        tdict.update(options)
+        if format == 'array':
+            call=self.call(tdict,timeout)
+            if call.error:
+                print("Error: "+call.error)
+                return None
+            return self.result(call.header,call.payloads)
+        if outdir is None: outdir=os.getcwd()
+        if not make_dir(outdir): return None
+        local=os.path.join(outdir,'cut_'+os.path.basename(filename))
+        part=local+'.part'
+        call=self.call(tdict,timeout,outfile=part)
+        local,error=finish_download(call,local,outdir)
+        if error: print("Error: "+error)
+        return local
+
+###############################################################################
+# result of execute or get from response header and array payload
+
+    def result(self,header,payloads):
+
+        import tools
+        if header.get('type') != 'array': return str(header['result'])
+        return tools.make_array(header,payloads[0] if payloads else b'')
+
+    def close(self):
+
+        import socket
+        self.closed=True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+##############################################################################
+# make directory outdir for downloads if it does not exist. Returns False
+# if it cannot be made.
+
+def make_dir(outdir):
+
+    import os
+    try:
+        if not os.path.isdir(outdir): os.makedirs(outdir)
+    except OSError as e:
+        print("Error: "+str(e))
+        return False
+    return True
+
+# complete download call written to local+'.part' (or, over a Unix 
+# socket, link file the server gave by path into outdir, if it is
+# requested). Returns (local file name,'') or (None,error).
+
+def finish_download(call,local,outdir,requested=None):
+
+    import os
+    import tools
+    part=local+'.part'
+    if not call.error and call.header.get('path'):
+        return tools.link_file(str(call.header['path']),requested,outdir=outdir)
+    if not call.error and not call.complete(): call.error='Download incomplete.'
+    if call.error:
+        if os.path.isfile(part): os.remove(part)
+        return (None,call.error)
+    if not os.path.isfile(part): open(part,'wb').close()
+    if os.path.isfile(local): os.remove(local)
+    os.rename(part,local)
+    return (local,'')
+
+##############################################################################
+# open Channel to server. Returns None if the server cannot be reached or
+# does not support protocol version 2. Large frames are compressed if
+# compress is set (by default, for remote servers).
+
+def connect(ip='localhost',port=10000,timeout=60,compress=None,verbose=False):
+
+    try:
+        return open_channel(ip,port,timeout,compress,verbose)
+    except IOError as e:
+        print(str(e))
+        return None
+
+# as connect, but raises IOError (socket.error for connection failures)
+# with the reason the channel cannot be opened
+
+def open_channel(ip='localhost',port=10000,timeout=60,compress=None,verbose=False):
+
+    import json,socket
+    import tools
+    if compress is None: compress=not tools.is_local(ip)
+    try:
+        if verbose: print('Connecting to server: %s on port: %s' % (ip,port))
+        sock=tools.connect(ip,port,timeout)
+        tools.tune_socket(sock)
+        codecs=[]
+        if compress: codecs=tools.CODECS
+        tools.send_data(sock,json.dumps({'action':'hello','codecs':codecs,'version':tools.VERSION}))
+        data=tools.recv_data(sock)
+    except socket.error as msg:
+        if verbose: print(str(msg))
+        raise socket.error("Failed to connect to server. Check if server is running on port: "+str(port))
+    reason=tools.refusal(data)
+    if reason:
+        sock.close()
+        raise IOError(reason)
+    tdict=None
+    if data: tdict=json.loads(data)
+    if not tdict or tdict.get('version',1) < tools.VERSION:
+        sock.close()
+        raise IOError("Server does not support protocol version "+str(tools.VERSION)+".")
+    sock.settimeout(None)
+    codec=str(tdict.get('codec') or '')
+    if verbose: print("Compression: "+(codec or 'none'))
+    return Channel(sock,codec,verbose)
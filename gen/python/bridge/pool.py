@@ -0,0 +1,165 @@
+
+# Connection pool for clients of the Python-IDL bridge server
+
+# Sockets are keyed by server address (ip,port) and returned to the pool
+# after each request so that the next client.run can reuse them instead of
+# opening a new TCP connection. New connections to a local server use its
+# Unix socket (see tools.connect).
+
+# Example:
+# >>> import pool
+# >>> sock,reused=pool.get('localhost',10000)
+# >>> ... send request, read response ...
+# >>> pool.release('localhost',10000,sock)
+
+import threading
+
+IDLE_TIMEOUT=60.     # seconds an unused connection is kept open
+MAX_IDLE=8           # maximum number of idle connections kept per server
+
+class ConnectionPool(object):
+
+    def __init__(self,idle_timeout=IDLE_TIMEOUT,max_idle=MAX_IDLE):
+        self.idle_timeout=idle_timeout
+        self.max_idle=max_idle
+        self.lock=threading.Lock()
+        self.idle={}
+        self.codecs={}                # socket -> negotiated compression codec
+        self.legacy=set()             # servers without compression support
+
+###############################################################################
+# return (socket,reused) for server at (ip,port)
+
+    def get(self,ip,port,timeout=None,verbose=False):
+
+        import tools
+        key=(ip,port)
+        self.evict()
+        while True:
+            with self.lock:
+                conns=self.idle.get(key)
+                if not conns: break
+                sock,last=conns.pop()
+            if healthy(sock):
+                if verbose: print('Reusing connection to server: %s on port: %s' % key)
+                sock.settimeout(timeout)
+                return (sock,True)
+            close(sock)
+
+        if verbose: print('Connecting to server: %s on port: %s' % key)
+        sock=tools.connect(ip,port,timeout)
+        tools.tune_socket(sock)
+        sock.settimeout(timeout)
+        return (sock,False)
+
+###############################################################################
+# return socket to pool after a completed request
+
+    def release(self,ip,port,sock):
+
+        import time
+        key=(ip,port)
+        with self.lock:
+            conns=self.idle.setdefault(key,[])
+            if len(conns) < self.max_idle:
+                conns.append((sock,time.time()))
+                return
+        close(sock)
+
+###############################################################################
+# close idle connections older than idle_timeout
+
+    def evict(self):
+
+        import time
+        now=time.time()
+        stale=[]
+        with self.lock:
+            for key,conns in self.idle.items():
+                keep=[]
+                for sock,last in conns:
+                    if now-last > self.idle_timeout:
+                        stale.append(sock)
+                    else:
+                        keep.append((sock,last))
+                self.idle[key]=keep
+        for sock in stale: close(sock)
+
+###############################################################################
+# close all idle connections (to one server if ip/port given)
+
+    def clear(self,ip=None,port=None):
+
+        with self.lock:
+            if ip is None:
+                keys=list(self.idle.keys())
+            else:
+                keys=[(ip,port)]
+            socks=[]
+            for key in keys:
+                socks.extend([c[0] for c in self.idle.pop(key,[])])
+        for sock in socks: close(sock)
+
+###############################################################################
+# compression codec negotiated on socket ('' if none)
+
+    def get_codec(self,sock):
+
+        return self.codecs.get(sock) or ''
+
+    def set_codec(self,sock,codec):
+
+        with self.lock:
+            self.codecs[sock]=codec
+
+    def forget(self,sock):
+
+        with self.lock:
+            self.codecs.pop(sock,None)
+
+##############################################################################
+# check that idle socket is still connected. A connection with nothing to
+# read is healthy; a readable one has either been closed by the server or
+# holds stale data, so is not reusable.
+
+def healthy(sock):
+
+    import select,socket
+    try:
+        readable,writable,errored=select.select([sock],[],[sock],0)
+    except (socket.error,select.error,ValueError):
+        return False
+    return not readable and not errored
+
+##############################################################################
+
+def close(sock):
+
+    import socket
+    default.forget(sock)
+    try:
+        sock.close()
+    except socket.error:
+        pass
+
+##############################################################################
+# shared pool used by client module
+
+default=ConnectionPool()
+
+def get(ip,port,**kwargs):
+    return default.get(ip,port,**kwargs)
+
+def release(ip,port,sock):
+    return default.release(ip,port,sock)
+
+def clear(ip=None,port=None):
+    return default.clear(ip=ip,port=port)
+
+def get_codec(sock):
+    return default.get_codec(sock)
+
+def set_codec(sock,codec):
+    return default.set_codec(sock,codec)
+
+legacy=default.legacy
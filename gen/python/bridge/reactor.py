@@ -0,0 +1,218 @@
+
+# Event loop for the Python-IDL bridge server
+
+# Sockets are registered with handlers whose on_readable/on_writable
+# methods are called when the socket is ready, so no single client can
+# block the others. Work that must not run on the loop (IDL commands)
+# is done in other threads, which hand results back with
+# call_soon_threadsafe. stop() may be called from any thread and wakes
+# the loop immediately.
+
+# Example:
+# >>> loop=reactor.Reactor()
+# >>> loop.register(sock,handler)
+# >>> loop.call_later(1.,check)
+# >>> loop.run()
+
+import collections
+
+class Reactor(object):
+
+    def __init__(self):
+
+        import threading
+        self.handlers={}              # fd -> handler
+        self.masks={}                 # fd -> (read,write)
+        self.timers=[]                # heap of (when,seq,callback,args)
+        self.seq=0
+        self.callbacks=collections.deque()
+        self.lock=threading.Lock()
+        self.running=False
+        self.poller=Poller()
+        self.wake_r,self.wake_w=wake_pair()
+        self.register(self.wake_r,self,read=True)
+
+###############################################################################
+# watch socket (or object with fileno) for reading and/or writing
+
+    def register(self,sock,handler,read=True,write=False):
+
+        fd=sock.fileno()
+        self.handlers[fd]=handler
+        self.masks[fd]=(read,write)
+        self.poller.register(fd,read,write)
+
+    def modify(self,sock,read=True,write=False):
+
+        fd=sock.fileno()
+        if self.masks.get(fd) == (read,write): return
+        self.masks[fd]=(read,write)
+        self.poller.modify(fd,read,write)
+
+    def unregister(self,sock):
+
+        try:
+            fd=sock.fileno()
+        except Exception:
+            return
+        if fd not in self.handlers: return
+        del self.handlers[fd]
+        del self.masks[fd]
+        self.poller.unregister(fd)
+
+###############################################################################
+# schedule callback on the loop
+
+    def call_later(self,delay,callback,*args):
+
+        import heapq,time
+        self.seq += 1
+        heapq.heappush(self.timers,(time.time()+delay,self.seq,callback,args))
+
+    def call_soon_threadsafe(self,callback,*args):
+
+        with self.lock:
+            self.callbacks.append((callback,args))
+        self.wake()
+
+    def wake(self):
+
+        import socket
+        try:
+            self.wake_w.send(b'x')
+        except socket.error:
+            pass
+
+    def on_readable(self):
+
+        import socket
+        try:
+            self.wake_r.recv(4096)
+        except socket.error:
+            pass
+
+###############################################################################
+# run loop until stop() is called
+
+    def run(self):
+
+        import heapq,time
+        self.running=True
+        while self.running:
+            timeout=1.
+            if self.timers:
+                timeout=max(0.,min(timeout,self.timers[0][0]-time.time()))
+            if self.callbacks: timeout=0.
+            for fd,readable,writable in self.poller.poll(timeout):
+                handler=self.handlers.get(fd)
+                if handler and readable: handler.on_readable()
+                handler=self.handlers.get(fd)
+                if handler and writable: handler.on_writable()
+            with self.lock:
+                callbacks=self.callbacks
+                self.callbacks=collections.deque()
+            for callback,args in callbacks: callback(*args)
+            now=time.time()
+            while self.timers and self.timers[0][0] <= now:
+                when,seq,callback,args=heapq.heappop(self.timers)
+                callback(*args)
+
+    def stop(self):
+
+        self.call_soon_threadsafe(self.halt)
+
+    def halt(self):
+
+        self.running=False
+
+    def close(self):
+
+        self.unregister(self.wake_r)
+        self.wake_r.close()
+        self.wake_w.close()
+
+##############################################################################
+# poll() where available, select() otherwise (e.g. Windows). Returns list
+# of (fd,readable,writable). Hangups and errors are reported as readable
+# so the handler sees the failed recv.
+
+class Poller(object):
+
+    def __init__(self):
+
+        import select
+        self.fds={}
+        self.poll_obj=None
+        if hasattr(select,'poll'): self.poll_obj=select.poll()
+
+    def mask(self,read,write):
+
+        import select
+        mask=0
+        if read: mask |= select.POLLIN
+        if write: mask |= select.POLLOUT
+        return mask
+
+    def register(self,fd,read,write):
+
+        self.fds[fd]=(read,write)
+        if self.poll_obj: self.poll_obj.register(fd,self.mask(read,write))
+
+    def modify(self,fd,read,write):
+
+        self.fds[fd]=(read,write)
+        if self.poll_obj: self.poll_obj.modify(fd,self.mask(read,write))
+
+    def unregister(self,fd):
+
+        del self.fds[fd]
+        if self.poll_obj: self.poll_obj.unregister(fd)
+
+    def poll(self,timeout):
+
+        import select,errno
+        try:
+            if self.poll_obj:
+                events=[]
+                for fd,event in self.poll_obj.poll(timeout*1000.):
+                    readable=bool(event & (select.POLLIN|select.POLLHUP|select.POLLERR|select.POLLNVAL))
+                    writable=bool(event & select.POLLOUT)
+                    events.append((fd,readable,writable))
+                return events
+            rlist=[fd for fd,m in self.fds.items() if m[0]]
+            wlist=[fd for fd,m in self.fds.items() if m[1]]
+            rlist,wlist,xlist=select.select(rlist,wlist,[],timeout)
+        except (select.error,IOError,OSError) as e:
+            if e.args[0] == errno.EINTR: return []
+            raise
+        events={}
+        for fd in rlist: events[fd]=(True,False)
+        for fd in wlist: events[fd]=(events.get(fd,(False,False))[0],True)
+        return [(fd,r,w) for fd,(r,w) in events.items()]
+
+##############################################################################
+# connected pair of sockets used to wake the loop from other threads
+
+def wake_pair():
+
+    import socket
+    if hasattr(socket,'socketpair'):
+        r,w=socket.socketpair()
+    else:
+        lsock=socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        lsock.bind(('127.0.0.1',0))
+        lsock.listen(1)
+        w=socket.create_connection(lsock.getsockname())
+        r,addr=lsock.accept()
+        lsock.close()
+    r.setblocking(0)
+    w.setblocking(0)
+    return (r,w)
+
+##############################################################################
+# True if socket error means "try again later" on a non-blocking socket
+
+def would_block(e):
+
+    import errno
+    return e.args and e.args[0] in (errno.EAGAIN,errno.EWOULDBLOCK,errno.EINTR)
@@ -0,0 +1,252 @@
+
+# Managed scratch space for the Python-IDL bridge server
+
+# Uploaded files, copies handed out by the upload and URL caches, and the
+# directories tprep preps into are all session directories under one root,
+# instead of new directories in the system temp directory that are never
+# removed. Session ids are random UUIDs, so they cannot collide.
+
+# The IDL sessions are given the root as USER_TMPDIR, so directories made
+# by session_dir in IDL (root/<name>/<id>) are managed too.
+
+# A collector thread removes sessions unused for ttl seconds, and, while
+# the space used is over max_bytes, the least recently used ones. Sessions
+# used in the last MIN_AGE seconds are never removed, nor are sessions held
+# by jobs (see jobs.py) until the job is forgotten. Uploads larger than
+# session_bytes, or that would take the space used over max_bytes, are
+# refused. Sessions whose paths are quoted in an IDL command (such as the
+# input file and output directory of prep_file) are held while the command
+# runs (see hold_job).
+
+# The space used is counted by the collector and kept as a running total,
+# to which reserved bytes are added, so reserve does not walk the tree on
+# the server's event loop. When a reservation does not fit, the collector
+# is woken to free space, and the upload is refused (the client may try
+# again once it has run).
+
+# Example:
+# >>> store=scratch.ScratchStore('/tmp/bridge_scratch',max_bytes=50*1024**3)
+# >>> tdir=store.new_session('prep')
+# >>> store.hold(tdir) ... store.release(tdir)
+
+import re,threading
+
+TTL=86400.            # seconds an unused session is kept
+MIN_AGE=60.           # seconds a session is kept after it was last used
+GC_INTERVAL=60.       # seconds between collections
+QUOTED=re.compile(r'"([^"]+)"|\'([^\']+)\'')
+
+class ScratchStore(object):
+
+    def __init__(self,root,max_bytes,session_bytes=0,ttl=TTL):
+
+        import os
+        self.root=os.path.abspath(root)
+        self.max_bytes=max_bytes
+        self.session_bytes=session_bytes
+        self.ttl=ttl
+        self.lock=threading.Lock()
+        self.used={}                  # session -> time last used
+        self.held={}                  # session -> number of holds
+        self.total=0                  # bytes used at last collection, plus reserved since
+        self.sessions=0
+        self.removed=0
+        self.stopped=threading.Event()
+        self.wake=threading.Event()   # set to collect before GC_INTERVAL is up
+        self.collector=None
+        if not os.path.isdir(self.root): os.makedirs(self.root)
+        self.collect()
+
+    def start(self):
+
+        self.collector=threading.Thread(target=self.run)
+        self.collector.daemon=True
+        self.collector.start()
+        return self.collector
+
+    def run(self):
+
+        while not self.stopped.is_set():
+            self.wake.wait(GC_INTERVAL)
+            self.wake.clear()
+            if self.stopped.is_set(): break
+            try:
+                self.collect()
+            except Exception as e:
+                print("Scratch collection failed: "+str(e))
+
+    def stop(self):
+
+        self.stopped.set()
+        self.wake.set()
+
+###############################################################################
+# new session directory, in group directory name if given
+
+    def new_session(self,name=''):
+
+        import os,time,uuid
+        top=self.root
+        if name: top=os.path.join(top,os.path.basename(name))
+        path=os.path.join(top,'s'+uuid.uuid4().hex)
+        os.makedirs(path)
+        with self.lock:
+            self.used[path]=time.time()
+        return path
+
+# session directory holding path, or None if not under root
+
+    def session(self,path):
+
+        import os
+        path=os.path.abspath(path)
+        if not path.startswith(self.root+os.sep): return None
+        parts=os.path.relpath(path,self.root).split(os.sep)
+        if is_session(parts[0]): return os.path.join(self.root,parts[0])
+        if len(parts) < 2: return None
+        return os.path.join(self.root,parts[0],parts[1])
+
+    def touch(self,path):
+
+        import time
+        session=self.session(path)
+        if session is None: return
+        with self.lock:
+            self.used[session]=time.time()
+
+# keep session holding path until released
+
+    def hold(self,path):
+
+        session=self.session(path)
+        if session is None: return
+        with self.lock:
+            self.held[session]=self.held.get(session,0)+1
+
+    def release(self,path):
+
+        session=self.session(path)
+        if session is None: return
+        with self.lock:
+            count=self.held.get(session,0)-1
+            if count > 0:
+                self.held[session]=count
+            else:
+                self.held.pop(session,None)
+        self.touch(path)
+
+# hold sessions of paths quoted in the commands of IDL job (execute or
+# batch). Returns the sessions held, to be released when the job is done.
+
+    def hold_job(self,job):
+
+        commands=[job.get('command','')]+[item.get('command','') for item in job.get('commands',[])]
+        held=[]
+        for cmd in commands:
+            for quoted in QUOTED.findall(str(cmd)):
+                session=self.session(quoted[0] or quoted[1])
+                if session and session not in held: held.append(session)
+        for session in held: self.hold(session)
+        return held
+
+###############################################################################
+# reserve space for nbytes. Returns '' or reason it cannot be given. If
+# there is no room, the collector thread is woken (or, if it is not 
+# running, space is collected at once).
+
+    def reserve(self,nbytes):
+
+        if self.session_bytes and nbytes > self.session_bytes:
+            return 'File exceeds session quota of %d bytes.' % self.session_bytes
+        if self.total+nbytes > self.max_bytes:
+            if self.collector and self.collector.is_alive():
+                self.wake.set()
+            else:
+                self.collect()
+        with self.lock:
+            if self.total+nbytes > self.max_bytes: return 'Server scratch space full. Try again later.'
+            self.total += nbytes
+        return ''
+
+###############################################################################
+# remove expired sessions, then least recently used ones until within
+# max_bytes
+
+    def collect(self):
+
+        import time
+        sessions=self.scan()
+        now=time.time()
+        with self.lock:
+            for session in list(self.used):
+                if session not in sessions: del self.used[session]
+            for session,(nbytes,mtime) in sessions.items():
+                sessions[session]=(nbytes,max(mtime,self.used.get(session,0)))
+            held=set(self.held)
+        total=sum([size for size,used in sessions.values()])
+        removable=[(used,session) for session,(size,used) in sessions.items()
+                   if session not in held and now-used > MIN_AGE]
+        for used,session in sorted(removable):
+            if now-used <= self.ttl and total <= self.max_bytes: continue
+            if self.remove(session):
+                total -= sessions.pop(session)[0]
+        with self.lock:
+            self.total=total
+            self.sessions=len(sessions)
+
+    def remove(self,session):
+
+        import os,shutil
+        try:
+            if os.path.isdir(session): 
+                shutil.rmtree(session,True)
+            else:
+                os.remove(session)
+        except OSError:
+            pass
+        if os.path.exists(session): return False
+        with self.lock:
+            self.used.pop(session,None)
+        self.removed += 1
+        return True
+
+# sessions on disk as session -> (bytes,last modified). Files linked from
+# the upload cache are counted there, not here.
+
+    def scan(self):
+
+        import os
+        sessions={}
+        for name in os.listdir(self.root):
+            path=os.path.join(self.root,name)
+            if is_session(name):
+                sessions[path]=usage(path)
+            elif os.path.isdir(path):
+                for sub in os.listdir(path):
+                    sessions[os.path.join(path,sub)]=usage(os.path.join(path,sub))
+        return sessions
+
+##############################################################################
+
+def is_session(name):
+
+    return len(name) == 33 and name[0] == 's'
+
+# (bytes,last modified) of file or directory tree
+
+def usage(path):
+
+    import os
+    size=0 ; mtime=0.
+    paths=[path]
+    if os.path.isdir(path):
+        for dirpath,dirnames,filenames in os.walk(path):
+            paths.extend([os.path.join(dirpath,n) for n in dirnames+filenames])
+    for name in paths:
+        try:
+            st=os.lstat(name)
+        except OSError:
+            continue
+        mtime=max(mtime,st.st_mtime)
+        if st.st_nlink == 1 and not os.path.isdir(name): size += st.st_size
+    return (size,mtime)
@@ -4,7 +4,60 @@
 
 # >>> import server
 # >>> server.start()
+# >>> server.start(workers=4)     run IDL commands in 4 worker processes
+# >>> server.start(cache_size=0)  do not keep uploaded files for reuse
+# >>> server.start(url_cache_size=0)  do not keep files fetched from URLs
+# >>> server.start(scratch_size=10*1024**3)   limit scratch space (see scratch.py)
+# >>> server.start(max_connections=100,max_per_client=8)   refuse connections beyond these
+# >>> server.start(max_upload=10*1024**3)   refuse larger uploads
+# >>> server.start(job_workers=2) run submitted jobs in 2 worker processes of
+#                                  their own (default: in the server's worker
+#                                  processes, or 1 of their own without workers)
+# >>> server.start(memo_size=0)   do not cache results of idempotent commands
+# >>> server.start(warm=True)     restore saved SSW state instead of ssw_load
+# >>> server.start(stats_file='/tmp/bridge_stats.json')   write metrics every minute
+# >>> server.start(verbose=True)   print each request
+# >>> server.start(unix_socket=False)   do not listen for local clients
+# >>> server.start(backend='fakeidl',backend_options={'delay':0.01})
+#                                  run without IDL (see fakeidl.py, bench.py)
+# >>> server.start(lean=False)     reset IDL and print keywords before each command
 
+# The port is bound and served at once while IDL sessions start. Requests
+# wait for a session; client.ping() reports whether the server is ready
+# and the time taken by each startup phase.
+
+# The server runs an event loop (reactor.py) over non-blocking sockets.
+# Each client connection reads requests and sends responses as its socket
+# becomes ready, and IDL commands run in an IDL thread or worker processes
+# (workers.py), so a slow transfer or long IDL command does not hold up
+# other clients.
+
+# Limits keep one client from exhausting the server: frames over max_frame
+# bytes close the connection, and uploads over max_upload are refused. A
+# connection stops being read while its receive buffer is full or it has
+# max_inflight requests outstanding. Connections beyond max_connections
+# (or max_per_client from one address) get a 'busy' reply and are closed,
+# as are clients that stop reading responses, or stop partway through a
+# request, for stall_timeout seconds.
+
+# Request counts, latencies and bytes transferred are kept per action (see
+# metrics.py) and returned by client.stats().
+
+# The 'fits' action (client.fits) sends only part of a FITS file on the
+# server: one HDU, rows or columns of a table, or a section of an image
+# (see fitscut.py), as a FITS file or an array.
+
+# Clients on the same host connect through a Unix domain socket (see
+# tools.local_path), in a directory only the server's user may use. On these local
+# connections array results of SHM_MIN bytes or more are passed in shared
+# memory files, and files are handed over by path ('link', and download
+# with link set) instead of being copied through the socket.
+
+# Clients that agree protocol version 2 in 'hello' (see tools.VERSION and
+# mux.py) may send further requests before earlier ones are answered;
+# responses are sent as they complete, each tagged with its request id.
+
+import collections,threading
 
 def start(thread=True,**kwargs):
 
@@ -19,6 +72,7 @@ def start(thread=True,**kwargs):
         except:
             print("Failed to start Python thread server.")
             return None
+        return t
     else:
         startup(**kwargs)
 
@@ -26,22 +80,118 @@ def start(thread=True,**kwargs):
 
 def startup(**kwargs):
   
-    import socket,select,tempfile,os,sys,json
-    import tools,config,bridge
+    import socket,os,sys,tempfile,time
+    import config,workers,reactor,tools,blobs,jobs,memo,metrics,urlcache,scratch
+    tstart=time.time()
     if sys.platform != 'win32': 
         base=os.nice(1)-1
         new=os.nice(base+9)
 
-# Create a TCP/IP socket
+# Create a TCP/IP socket. Allow rebinding port still held by connections 
+# of a previous server (not on Windows, where this allows two servers on 
+# one port).
 
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-#    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if sys.platform != 'win32':
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
     ip=""
     if 'ip' in kwargs: ip=kwargs['ip']
     port=10000
     if 'port' in kwargs: port=kwargs['port']
-    config.stop_server=False
+    idle_timeout=600
+    if 'idle_timeout' in kwargs: idle_timeout=kwargs['idle_timeout']
+    nworkers=0
+    if 'workers' in kwargs: nworkers=kwargs['workers']
+    queue_size=100
+    if 'queue' in kwargs: queue_size=kwargs['queue']
+    recv_buffer=tools.DEF_RECV_BUFFER
+    if 'recv_buffer' in kwargs: recv_buffer=kwargs['recv_buffer']
+    codecs=tools.CODECS
+    if 'compress' in kwargs and not kwargs['compress']: codecs=[]
+    unix_path=tools.local_path(port)
+    if 'unix_socket' in kwargs: unix_path=kwargs['unix_socket']
+
+# Store of uploaded files, keyed by content hash, that clients can reuse 
+# instead of uploading the same file again
+
+    cache_dir=os.path.join(tempfile.gettempdir(),'bridge_blobs')
+    if 'cache_dir' in kwargs: cache_dir=kwargs['cache_dir']
+    cache_size=CACHE_SIZE
+    if 'cache_size' in kwargs: cache_size=kwargs['cache_size']
+    job_workers=0 if nworkers > 0 else 1
+    if 'job_workers' in kwargs: job_workers=kwargs['job_workers']
+    job_ttl=3600
+    if 'job_ttl' in kwargs: job_ttl=kwargs['job_ttl']
+    warm=False
+    if 'warm' in kwargs: warm=kwargs['warm']
+    verbose=False
+    if 'verbose' in kwargs: verbose=kwargs['verbose']
+    stats_file=None
+    if 'stats_file' in kwargs: stats_file=kwargs['stats_file']
+    stats_interval=60.
+    if 'stats_interval' in kwargs: stats_interval=kwargs['stats_interval']
+    lean=True
+    if 'lean' in kwargs: lean=kwargs['lean']
+    limits={}
+    for name in LIMITS:
+        if name in kwargs: limits[name]=kwargs[name]
+    backend=None
+    if 'backend' in kwargs: 
+        backend=(kwargs['backend'],{})
+        if 'backend_options' in kwargs: backend=(kwargs['backend'],kwargs['backend_options'])
+
+# Cache of results of idempotent commands (see memo.py)
+
+    memo_size=1000
+    if 'memo_size' in kwargs: memo_size=kwargs['memo_size']
+    memo_ttl=300.
+    if 'memo_ttl' in kwargs: memo_ttl=kwargs['memo_ttl']
+    memo_allow=memo.ALLOW
+    if 'memo_allow' in kwargs: memo_allow=kwargs['memo_allow']
+    results=memo.MemoCache(memo_size,memo_ttl,allow=memo_allow,watch=memo.registered_dir())
+
+    store=None
+    if cache_size > 0:
+        try:
+            store=blobs.BlobStore(cache_dir,cache_size)
+        except (IOError,OSError) as e:
+            print("Upload cache disabled: "+str(e))
+
+# Cache of files fetched from URLs for tprep (see urlcache.py)
+
+    url_cache_dir=os.path.join(tempfile.gettempdir(),'bridge_urls')
+    if 'url_cache_dir' in kwargs: url_cache_dir=kwargs['url_cache_dir']
+    url_cache_size=URL_CACHE_SIZE
+    if 'url_cache_size' in kwargs: url_cache_size=kwargs['url_cache_size']
+    url_fresh=urlcache.FRESH
+    if 'url_fresh' in kwargs: url_fresh=kwargs['url_fresh']
+    urls=None
+    if url_cache_size > 0:
+        try:
+            urls=urlcache.URLCache(url_cache_dir,url_cache_size,fresh=url_fresh)
+        except (IOError,OSError) as e:
+            print("URL cache disabled: "+str(e))
+
+# Scratch space for uploads and prep sessions, cleaned up as it ages or
+# fills (see scratch.py). IDL sessions started below make their session
+# directories under it too.
+
+    scratch_dir=os.path.join(tempfile.gettempdir(),'bridge_scratch')
+    if 'scratch_dir' in kwargs: scratch_dir=kwargs['scratch_dir']
+    scratch_size=SCRATCH_SIZE
+    if 'scratch_size' in kwargs: scratch_size=kwargs['scratch_size']
+    session_size=0
+    if 'session_size' in kwargs: session_size=kwargs['session_size']
+    scratch_ttl=scratch.TTL
+    if 'scratch_ttl' in kwargs: scratch_ttl=kwargs['scratch_ttl']
+    space=None
+    if scratch_size > 0:
+        try:
+            space=scratch.ScratchStore(scratch_dir,scratch_size,session_bytes=session_size,ttl=scratch_ttl)
+            os.environ['USER_TMPDIR']=space.root
+        except (IOError,OSError) as e:
+            print("Scratch store disabled: "+str(e))
 
 # Bind the socket to the port
 
@@ -53,133 +203,1445 @@ def startup(**kwargs):
         print('Could not start server. Check if already running on port: '+str(port))
         return None
 
-# Listen for incoming connections
+# Listen for local clients too. A socket file left by a server that was
+# not stopped cleanly is replaced; one in use would have kept the port.
+# If the local socket cannot be set up, the server listens by TCP only.
+
+    local_socket=None
+    if unix_path and hasattr(socket,'AF_UNIX'):
+        try:
+            local_socket=bind_local(unix_path)
+        except (socket.error,OSError) as e:
+            print("Local socket disabled: "+str(e))
+
+# Start IDL session in a thread, or a pool of IDL worker processes
+
+    timings=[('bind',time.time()-tstart)]
+    loop=reactor.Reactor()
+    if nworkers > 0:
+        executor=workers.WorkerPool(nworkers,loop,queue_size=queue_size,warm=warm,backend=backend)
+    else:
+        executor=workers.IDLThread(loop,queue_size=queue_size,warm=warm,backend=backend)
+    if job_workers <= 0 and nworkers <= 0:
+        print("Jobs share the IDL thread; other requests wait while one runs.")
+    manager=jobs.JobManager(loop,size=job_workers,queue_size=queue_size,ttl=job_ttl,warm=warm,backend=backend,executor=executor)
+    timings.append(('executor',time.time()-tstart-timings[0][1]))
+
+# Listen for incoming connections and serve them until stopped
 
-    IDL=bridge.startup()
     print('Starting Python-IDL server on %s port %s' % server_address)
-    server_socket.listen(10)
-    CONNECTION_LIST = []             # list of socket clients
-    RECV_BUFFER = 4096      
-    CONNECTION_LIST.append(server_socket)
-
-    while 1:
-        if config.stop_server and config.port == port:
-          #  server_socket.shutdown(socket.SHUT_RDWR)
-            server_socket.close()
-            config.stop_server=False
-            print("Stopping server on port: "+str(port))
-            IDL.run(".reset")
+    server_socket.listen(128)
+    server=Server(server_socket,loop,executor,idle_timeout=idle_timeout,recv_buffer=recv_buffer,codecs=codecs,store=store,jobs=manager,memo=results,urls=urls,scratch=space)
+    server.tstart=tstart
+    server.timings=timings
+    server.verbose=verbose
+    server.lean=lean
+    for name in limits: setattr(server,name,limits[name])
+    if local_socket: server.listeners.append(Listener(server,local_socket))
+    if stats_file: server.dump_stats(stats_file,stats_interval)
+    config.servers[port]=server
+    if space:
+        config.scratch=space
+        space.start()
+    try:
+        loop.run()
+    finally:
+        if config.servers.get(port) is server: del config.servers[port]
+        if space: 
+            space.stop()
+            if config.scratch is space: config.scratch=None
+        if stats_file: metrics.dump(server.stats(),stats_file)
+        server.close()
+        if local_socket:
+            try:
+                os.remove(unix_path)
+            except OSError:
+                pass
+        executor.close()
+        manager.close()
+        loop.close()
+        print("Stopping server on port: "+str(port))
+
+CACHE_SIZE=20*1024**3     # default size limit in bytes of upload cache
+URL_CACHE_SIZE=5*1024**3  # default size limit in bytes of URL cache
+SCRATCH_SIZE=50*1024**3   # default size limit in bytes of scratch space
+LIMITS=('max_connections','max_per_client','max_inflight','max_frame','max_upload','stall_timeout')
+
+# Unix domain socket at path, for clients of the server's user only
+
+def bind_local(path):
+
+    import os,socket
+    import tools
+    tools.private_dir(os.path.dirname(os.path.abspath(path)))
+    if os.path.lexists(path): os.remove(path)
+    sock=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    umask=os.umask(0o077)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(umask)
+    sock.listen(128)
+    return sock
+
+##################################################################################################
+# Listening socket: accepts clients and closes connections idle for 
+# idle_timeout seconds. Connections are kept open across requests
+# until the client closes them. All connections receive into one
+# preallocated buffer, as the loop handles one socket at a time.
+
+class Server(object):
+
+    def __init__(self,sock,loop,executor,idle_timeout=600,recv_buffer=1048576,codecs=[],store=None,jobs=None,memo=None,urls=None,scratch=None):
+
+        import time
+        import metrics,tools
+        self.sock=sock
+        self.codecs=codecs
+        self.store=store
+        self.jobs=jobs
+        self.memo=memo
+        self.urls=urls
+        self.scratch=scratch
+        self.tstart=time.time()
+        self.timings=[]               # server startup phase timings
+        self.ready_time=None
+        self.ready_waiters=[]
+        self.verbose=False            # print each request
+        self.lean=True                # lean IDL execution (see execute)
+        self.max_connections=1024
+        self.max_per_client=64        # connections from one address
+        self.max_inflight=32          # version 2 requests outstanding per connection
+        self.max_frame=tools.MAX_FRAME
+        self.max_upload=0             # bytes, 0 for no limit
+        self.stall_timeout=120.
+        self.metrics=metrics.Metrics()
+        executor.on_ready=self.session_ready
+        executor.metrics=self.metrics
+        if jobs: 
+            jobs.metrics=self.metrics
+            jobs.scratch=scratch
+        self.loop=loop
+        self.executor=executor
+        self.idle_timeout=idle_timeout
+        self.connections=set()
+        self.listeners=[]             # further listening sockets (see Listener)
+        self.buf=memoryview(bytearray(recv_buffer))
+        sock.setblocking(0)
+        loop.register(sock,self)
+        loop.call_later(1.,self.check_idle)
+
+    def on_readable(self):
+
+        self.accept(self.sock)
+
+# accept connections waiting on listening socket sock. Connections to the
+# Unix socket are local.
+
+    def accept(self,sock,local=False):
+
+        import socket
+        import reactor,tools
+        while True:
+            try:
+                sockfd, addr = sock.accept()
+            except socket.error as e:
+                if reactor.would_block(e): return
+                print("Accept failed: "+str(e))
+                return
+            if local: addr=('localhost','unix')
+            reason=self.admit(addr)
+            if reason:
+                print "Client (%s, %s) refused: " % addr + reason
+                self.metrics.count('refused')
+                refuse(sockfd,reason)
+                continue
+            tools.tune_socket(sockfd)
+            print "Client (%s, %s) connected:" % addr
+            self.metrics.count('connections')
+            self.connections.add(Connection(self,sockfd,addr,local))
+
+# reason to refuse connection from addr, or ''
+
+    def admit(self,addr):
+
+        if len(self.connections) >= self.max_connections: return 'Server busy. Try again later.'
+        count=len([c for c in self.connections if c.addr[0] == addr[0]])
+        if count >= self.max_per_client: return 'Too many connections from '+str(addr[0])+'.'
+        return ''
+
+    def check_idle(self):
+
+        import time
+        now=time.time()
+        for conn in list(self.connections):
+            if not conn.busy and now-conn.last_used > self.idle_timeout:
+                print "Client (%s, %s) idle, disconnecting:" % conn.addr
+                conn.close()
+            elif conn.stalled(now,self.stall_timeout):
+                print "Client (%s, %s) stalled, disconnecting:" % conn.addr
+                self.metrics.count('stalled')
+                conn.close()
+        self.loop.call_later(1.,self.check_idle)
+
+# readiness: ready once an IDL session has started
+
+    def ready(self):
+
+        return self.executor.sessions()[0] > 0
+
+    def session_ready(self):
+
+        import time
+        if not self.ready() or self.ready_time: return
+        self.ready_time=time.time()
+        print("Server ready in %.2f s" % (self.ready_time-self.tstart))
+        waiters,self.ready_waiters=self.ready_waiters,[]
+        for callback in waiters: callback()
+
+# call callback when server is ready, or after timeout seconds
+
+    def when_ready(self,callback,timeout):
+
+        if self.ready():
+            callback()
+            return
+        self.ready_waiters.append(callback)
+        def expire():
+            if callback in self.ready_waiters:
+                self.ready_waiters.remove(callback)
+                callback()
+        self.loop.call_later(timeout,expire)
+
+    def health(self):
+
+        import time
+        ready,total=self.executor.sessions()
+        startup=None
+        if self.ready_time: startup=self.ready_time-self.tstart
+        status={'action':'ping','ready':ready > 0,'sessions':ready,'total':total,
+                'startup':startup,'uptime':time.time()-self.tstart,
+                'timings':{'server':self.timings,'idl':self.executor.timings},'error':''}
+        if self.jobs: status['job_workers']=self.jobs.workers()
+        return status
+
+# metrics with gauges of current state
+
+    def stats(self):
+
+        queued,running=self.executor.pending()
+        ready,total=self.executor.sessions()
+        gauges={'connections':len(self.connections),
+                'busy':len([c for c in self.connections if c.busy]),
+                'queued':queued,'running':running,'sessions':ready,'total':total}
+        if self.jobs: gauges['jobs']=self.jobs.running()
+        if self.memo:
+            gauges['memo_hits']=self.memo.hits
+            gauges['memo_misses']=self.memo.misses
+        if self.store:
+            gauges['store_files']=len(self.store.entries)
+            gauges['store_bytes']=self.store.total
+        if self.urls:
+            gauges['url_hits']=self.urls.hits
+            gauges['url_misses']=self.urls.misses
+            gauges['url_files']=len(self.urls.entries)
+            gauges['url_bytes']=self.urls.total
+        if self.scratch:
+            gauges['scratch_sessions']=self.scratch.sessions
+            gauges['scratch_bytes']=self.scratch.total
+            gauges['scratch_removed']=self.scratch.removed
+        return self.metrics.snapshot(gauges)
+
+# write metrics to file every interval seconds
+
+    def dump_stats(self,filename,interval):
+
+        import metrics
+        metrics.dump(self.stats(),filename)
+        self.loop.call_later(interval,self.dump_stats,filename,interval)
+
+    def stop(self):
+
+        self.loop.stop()
+
+    def close(self):
+
+        for conn in list(self.connections): conn.close()
+        for listener in self.listeners: listener.close()
+        self.loop.unregister(self.sock)
+        self.sock.close()
+
+##################################################################################################
+# further listening socket of server (the Unix socket for local clients)
+
+class Listener(object):
+
+    def __init__(self,server,sock):
+
+        self.server=server
+        self.sock=sock
+        sock.setblocking(0)
+        server.loop.register(sock,self)
+
+    def on_readable(self):
+
+        self.server.accept(self.sock,local=True)
+
+    def close(self):
+
+        self.server.loop.unregister(self.sock)
+        self.sock.close()
+
+##################################################################################################
+# Client connection. Requests are length-prefixed JSON frames (see 
+# tools.send_data): execute is followed by a frame of keywords, and upload 
+# by the raw file bytes. One request is handled at a time; the next one is
+# read once the response has been sent.
+
+# After 'hello' with version=2 the connection uses tools.pack_frame frames
+# instead: requests are handled as they arrive, and responses are queued
+# as Streams that are sent a frame at a time in turn, so a large download
+# does not hold up the reply to a short command.
+
+class Connection(object):
+
+    SEND_BUDGET=4194304
+
+    def __init__(self,server,sock,addr,local=False):
+
+        import collections,time
+        self.server=server
+        self.loop=server.loop
+        self.sock=sock
+        self.addr=addr
+        self.local=local              # Unix socket client (see start)
+        self.shm=[]                   # shared memory files sent, until client removes them
+        self.rbuf=bytearray()
+        self.output=collections.deque()
+        self.request=None             # execute request waiting for keywords
+        self.upload=None              # upload in progress
+        self.busy=False               # request being handled
+        self.codec=''                 # compression codec agreed with client
+        self.version=1                # protocol version agreed with client
+        self.pending={}               # version 2: request id -> action, start time, bytes in
+        self.uploads={}               # version 2: request id -> upload in progress
+        self.closed=False
+        self.closing=False            # close once output is sent
+        self.paused=False             # not reading (see update_events)
+        self.last_used=time.time()
+        self.last_sent=time.time()
+        self.action=None              # request being handled, for metrics
+        self.clear_stats()
+        sock.setblocking(0)
+        self.loop.register(sock,self)
+
+# receive into the server buffer. Upload data is written to file straight
+# from it; anything else is appended to the connection receive buffer.
+
+    def on_readable(self):
+
+        import socket,time
+        import reactor
+        try:
+            nbytes=self.sock.recv_into(self.server.buf)
+        except socket.error as e:
+            if reactor.would_block(e): return
+            nbytes=0
+        if not nbytes:
+            print "Client (%s, %s) disconnected:" % self.addr
+            self.close()
+            return
+        self.last_used=time.time()
+        self.nin += nbytes
+        data=self.server.buf[:nbytes]
+        if self.upload and not self.rbuf:
+            try:
+                data=data[self.upload.feed(data):]
+            except ValueError as e:
+                print e
+                print "Client (%s, %s) disconnected:" % self.addr
+                self.close()
+                return
+        if len(data): self.rbuf.extend(data)
+        self.process()
+        if not self.closed and self.overloaded() != self.paused: self.update_events()
+
+# send queued output until the socket would block. Return to the loop after
+# SEND_BUDGET bytes so that one fast download does not starve other clients.
+
+    def on_writable(self):
+
+        import socket,time
+        import reactor
+        sent=0
+        try:
+            while self.output:
+                producer=self.output[0]
+                while not producer.done:
+                    if sent >= self.SEND_BUDGET: return
+                    sent += producer.send(self.sock)
+                    if getattr(producer,'boundary',False) and not producer.done and len(self.output) > 1: break
+                if not producer.done:
+                    self.output.rotate(-1)
+                    continue
+                self.output.popleft()
+                producer.close()
+                if isinstance(producer,Stream): self.record_stream(producer)
+        except socket.error as e:
+            if reactor.would_block(e): return
+            print e
+            print "Client (%s, %s) disconnected:" % self.addr
+            self.close()
+            return
+        finally:
+            self.nout += sent
+            if sent: self.last_sent=time.time()
+        if self.closing:
+            self.close()
             return
-      
-# Wait for a connection
-
-        read_sockets,write_sockets,error_sockets = select.select(CONNECTION_LIST,[],[])
-        
-        for sock in read_sockets:
-            if sock == server_socket:
-                sockfd, addr = server_socket.accept()
-                CONNECTION_LIST.append(sockfd)
-                print "Client (%s, %s) connected:" % addr
-            else:	
-                try:
-                    data=tools.recv_data(sock)
-                    if data: 
-                        if type(data) == str: 
-                            print(data)
-                            tdict=json.loads(data)
-                            if 'action' in tdict:
-                                action=str(tdict['action'])
+        self.busy=bool(self.pending)
+        self.record()
+        self.process()
+        if not self.closed: self.update_events()
+
+# poll for reading unless overloaded, and for writing while there is output
+
+    def update_events(self):
+
+        self.paused=self.overloaded()
+        self.loop.modify(self.sock,read=not self.paused,write=bool(self.output))
+
+# receive buffer holds more than a full frame (so complete requests are
+# waiting), or too many version 2 requests are outstanding. Uploads, which
+# need more input to finish, are not counted.
+
+    def overloaded(self):
+
+        import tools
+        if len(self.rbuf) > self.server.max_frame+tools.FRAME_HEADER: return True
+        return self.inflight() >= self.server.max_inflight
+
+    def inflight(self):
+
+        return len(self.pending)-len(self.uploads)
+
+# client has not read its responses, or sent more of a request it started,
+# for timeout seconds
+
+    def stalled(self,now,timeout):
+
+        if self.output and now-self.last_sent > timeout: return True
+        receiving=self.upload or self.uploads or (self.rbuf and not self.busy)
+        return bool(receiving) and now-self.last_used > timeout
+
+# handle complete requests in receive buffer
+
+    def process(self):
+
+        import json,sys,time
+        try:
+            if self.version == 2:
+                self.process_frames()
+                return
+            while not self.busy and not self.closed:
+                if self.upload:
+                    nbytes=self.upload.feed(self.rbuf)
+                    del self.rbuf[:nbytes]
+                    if not self.upload.done: return
+                    upload,self.upload=self.upload,None
+                    self.treceive=time.time()-upload.tstart
+                    self.finish_upload(upload)
+                    continue
+                data=next_frame(self.rbuf,self.codec,self.server.max_frame)
+                if data is None: return
+                data=str(data)
+                if self.request:
+                    tdict,self.request=self.request,None
+                    tdict['keywords']=json.loads(data)
+                    self.submit(tdict)
+                    continue
+                if self.server.verbose: print(data)
+                tdict=json.loads(data)
+                if type(tdict) != dict:
+                    print("Unrecognized client data input.")
+                elif 'action' not in tdict:
+                    print("No client action specified.")
+                else:
+                    self.handle(tdict)
+        except Exception as e:
+            print e
+            print "Unexpected error:", sys.exc_info()[0]
+            print "Client (%s, %s) disconnected:" % self.addr
+            self.close()
+
+# version 2: handle each complete frame in receive buffer. Requests are 
+# handled at once, whatever is still outstanding; DATA frames go to the
+# upload of their request.
+
+    def process_frames(self):
+
+        import json,time
+        import tools
+        while not self.closed:
+            if len(self.rbuf) > 8 and self.rbuf[8] == tools.HEADER and self.inflight() >= self.server.max_inflight: return
+            frame=tools.parse_frame(self.rbuf,self.codec,self.server.max_frame)
+            if frame is None: return
+            rid,ftype,body=frame
+            nbytes=tools.FRAME_HEADER+len(body)
+            if ftype == tools.DATA:
+                upload=self.uploads.get(rid)
+                if upload is None: continue
+                self.pending[rid]['nin'] += nbytes
+                upload.feed(body)
+                if upload.done:
+                    del self.uploads[rid]
+                    self.finish_upload(upload,rid)
+                continue
+            if self.server.verbose: print(body)
+            tdict=json.loads(body)
+            if type(tdict) != dict or 'action' not in tdict:
+                print("Unrecognized client data input.")
+                self.pending[rid]={'action':'unknown','tstart':time.time(),'nin':nbytes}
+                self.reply({'action':'','error':'Unrecognized client request.'},rid=rid)
+                continue
+            self.pending[rid]={'action':str(tdict['action']),'tstart':time.time(),'nin':nbytes}
+            self.busy=True
+            self.handle(tdict,rid)
+
+# write upload to store and reply with its location
+
+    def finish_upload(self,upload,rid=None):
+
+        import time
+        import tools
+        upload.close()
+        if upload.result: 
+            print(tools.throughput(upload.size-upload.offset,time.time()-upload.tstart))
+            if upload.digest and self.server.store: 
+                self.server.store.add(upload.digest,upload.result)
+        self.reply({'action':'upload','filename':upload.result,'error':upload.error},rid=rid)
+
+# handle request. rid is the request id on version 2 connections, whose
+# requests are tracked in pending (see process_frames) rather than here.
+
+    def handle(self,tdict,rid=None):
+
+        import os,time
+        import tools,jobs
+        action=str(tdict['action'])
+        if rid is None:
+            self.action=action
+            self.tstart=time.time()
 
 # Save uploaded file to temporary directory
                            
-                                if action == 'upload':
-                                    filename=os.path.basename(str(tdict['filename']))
-                                    filename=tools.expand_name(filename)
-                                    dsize=long(str(tdict['size'])) 
-                                    outdir=tools.get_temp_dir()
-                                    result,error = tools.rdwrt(sock,filename,dsize,outdir=outdir,RECV_BUFFER=RECV_BUFFER)
-                                    tdict={'action':'upload','filename':result,'error':error}
-                                    sdict=json.dumps(tdict)
-                                    tools.send_data(sock,sdict)
-
-# Send file to client
-
-                                elif action == 'download':
-                                    filename=str(tdict['filename'])
-                                    filename=tools.expand_name(filename)
-                                    if os.path.isfile(filename):
-                                        dsize=os.path.getsize(filename)
-                                        tdict={'action':'download','filename':filename,'size':dsize,'error':''}
-                                        sdict=json.dumps(tdict)
-                                        tools.send_data(sock,sdict)
-                                        with open(filename,'rb') as file:
-                                            sdata=file.read()
-                                            print("Server sending file: "+filename)
-                                            print "# of bytes: ",str(dsize)
-                                            sock.sendall(sdata)
-                                    else:
-                                        tdict={'action':'download','filename':filename,'size':0L,'error':'File not found.'}
-                                        sdict=json.dumps(tdict)
-                                        tools.send_data(sock,sdict)     
-# Execute IDL command  
-                           
-                                elif action == 'execute':							
-                                    cmd=str(tdict['command'])
-                                    is_function=str(tdict['is_function'])
-                                    result=''
-                                    error=''		
-                                    edata=tools.recv_data(sock)
-                                    edict=json.loads(edata)    
-                                    IDL.run('retall ; message,/reset ; catch,/cancel')
-                                    IDL.result=result
-                                    IDL.err=error
-                                    IDL.extra_keywords=''
-                                    try:
-                                        if edict: 
-                                            IDL.extra_keywords=edict
-                                            IDL.run("extra=hash2struct(extra_keywords)",stdout=True)
-                                            IDL.run("help,extra",stdout=True)
-                                            if is_function == "1":
-                                                cmd=cmd.replace( ')' , ',_extra=extra)' )
-                                            else:
-                                                cmd=cmd+',_extra=extra'
-                                        print("Executing: "+cmd)
-                                        IDL.run(cmd,stdout=True)           
-                                    except IDLError as e:
-                                        print('Caught IDL error: ' + str(e))
-                                        error=str(e)
-                                    else:
-                                        if type(IDL.result) == str: result=IDL.result
-                                        if type(IDL.err) == str: error=IDL.err
-                                    tdict={'action':'execute','result':result,'error':error}
-                                    sdict=json.dumps(tdict)
-                                    tools.send_data(sock,sdict)
-
-                                else: print("No client action specified.")
-                            else: print("Unsupported client action.")
-                        else: print("Unrecognized client data input.")
-                    
-                except Exception as e: 
-                    print e
-                    print "Unexpected error:", sys.exc_info()[0]
-                    print "Client (%s, %s) disconnected:" % addr
-                    sock.close()
-                    CONNECTION_LIST.remove(sock)
-                    continue
-         
-    server_socket.close()
+        if action == 'upload':
+            filename=os.path.basename(str(tdict['filename']))
+            filename=tools.expand_name(filename)
+            dsize=long(str(tdict['size'])) 
+            offset=long(str(tdict.get('offset',0)))
+            encoding=tdict.get('encoding')
+            if encoding: encoding=str(encoding)
+            digest=None
+            if self.server.store and tdict.get('hash'): digest=str(tdict['hash'])
+            options={'digest':digest,'store':self.server.store,'offset':offset,'scratch':self.server.scratch,'limit':self.server.max_upload}
+            if rid is None:
+                self.upload=Upload(filename,dsize,encoding=encoding,**options)
+            else:
+                upload=Upload(filename,dsize,**options)
+                if upload.done: 
+                    self.finish_upload(upload,rid)
+                else:
+                    self.uploads[rid]=upload
+
+# Return path of copy of previously uploaded file with same contents, 
+# or '' and number of bytes received if a partial upload can be resumed.
+# A partial file whose hash is not known (e.g. after a restart) is hashed
+# in a thread before replying, so the upload can resume from it.
+
+        elif action == 'have':
+            import blobs
+            filename=os.path.basename(str(tdict['filename']))
+            digest=str(tdict['hash'])
+            path='' ; offset=0
+            store=self.server.store
+            if store: 
+                path=store.checkout(digest,filename)
+                if not path: offset=store.part_size(digest)
+            if path: print("Server reusing uploaded file: "+path)
+            rdict={'action':'have','filename':path,'offset':offset,'error':''}
+            if offset and not store.part_hash(digest,offset):
+                part=store.path(digest)+'.part'
+                key=blobs.file_key(part)
+                def done(result):
+                    if result: store.keep_hash(digest,key,result)
+                    else: rdict['offset']=0
+                    self.reply(rdict,rid=rid)
+                self.checksum(part,0,offset,done)
+                return
+            self.reply(rdict,rid=rid)
+
+# Send file (or length bytes of it from offset) to client. If checksum is
+# given, the reply includes the hash of the file from byte checksum up to
+# the end of the bytes sent (checksum=0 covers a resumed file).
+
+        elif action == 'download':
+            import blobs
+            filename=str(tdict['filename'])
+            filename=tools.expand_name(filename)
+            offset=long(str(tdict.get('offset',0)))
+            length=tdict.get('length')
+            if self.server.scratch: self.server.scratch.touch(filename)
+            if os.path.isfile(filename):
+                total=os.path.getsize(filename)
+                dsize=total-offset
+                if length is not None: dsize=min(dsize,long(str(length)))
+                if offset < 0 or dsize < 0:
+                    tdict={'action':'download','filename':filename,'size':0L,'total':total,'error':'Invalid offset.'}
+                    self.reply(tdict,rid=rid)
+                    return
+                rdict={'action':'download','filename':filename,'size':dsize,'offset':offset,'total':total,'error':''}
+                if tdict.get('link') and self.local and offset == 0 and dsize == total:
+                    rdict['path']=filename
+                    self.reply(rdict,rid=rid)
+                    return
+                if tdict.get('checksum') is not None:
+                    start=min(long(str(tdict['checksum'])),offset)
+                    digest=None
+                    whole=start == 0 and dsize == total
+                    if whole: digest=blobs.known_hash(filename)
+                    if digest is None:
+                        key=blobs.file_key(filename)
+                        def done(result):
+                            if result: 
+                                rdict['hash']=result.hexdigest()
+                                if whole: blobs.remember_hash(filename,rdict['hash'],key)
+                                self.send_file(rdict,rid)
+                            else:
+                                rdict.update({'size':0L,'error':'Error reading file.'})
+                                self.reply(rdict,rid=rid)
+                        self.checksum(filename,start,offset+dsize-start,done)
+                        return
+                    rdict['hash']=digest
+                self.send_file(rdict,rid)
+            else:
+                tdict={'action':'download','filename':filename,'size':0L,'error':'File not found.'}
+                self.reply(tdict,rid=rid)
+
+# Send HDU, table rows and columns, or image section of FITS file, as a
+# FITS file (sent as download) or an array (as get)
+
+        elif action == 'fits':
+            filename=tools.expand_name(str(tdict['filename']))
+            if self.server.scratch: self.server.scratch.touch(filename)
+            self.cut_fits(filename,tdict,rid)
+
+# Take file of local client by path: link (or copy) it to a new temporary
+# directory, as if uploaded
+
+        elif action == 'link':
+            filename=str(tdict['filename'])
+            rdict={'action':'upload','filename':'','error':''}
+            if not self.local:
+                rdict['error']='Not a local connection.'
+            elif not os.path.isabs(filename) or not os.path.isfile(filename):
+                rdict['error']='File not found.'
+            elif self.server.max_upload and os.path.getsize(filename) > self.server.max_upload:
+                rdict['error']='File exceeds upload limit of %d bytes.' % self.server.max_upload
+            if rdict['error']:
+                self.reply(rdict,rid=rid)
+            else:
+                self.link_file(filename,rdict,rid)
+
+# Create new session directory in scratch space (in group directory name,
+# as session_dir in IDL)
+
+        elif action == 'session':
+            if self.server.scratch is None:
+                self.reply({'action':'session','dir':'','error':'Scratch store disabled.'},rid=rid)
+            else:
+                path=self.server.scratch.new_session(str(tdict.get('name','')))
+                self.reply({'action':'session','dir':path,'error':''},rid=rid)
+
+# Fetch file at URL into the URL cache and return the path of a copy, and
+# its name from the remote server
+
+        elif action == 'url':
+            if self.server.urls is None:
+                self.reply({'action':'url','filename':'','name':'','error':'URL cache disabled.'},rid=rid)
+            else:
+                self.fetch_url(str(tdict['url']),rid)
+
+# Execute IDL command (after reading its keywords), list of commands, or
+# return value of IDL variable
+
+        elif action == 'execute':
+            if rid is None:
+                self.request=tdict
+            else:
+                tdict.setdefault('keywords',{})
+                self.submit(tdict,rid)
+
+        elif action in ('batch','get'):
+            self.submit(tdict,rid)
+
+# Jobs: start IDL command (or list of commands) in job worker, and report
+# status, wait for it to finish or return its result
+
+        elif action == 'submit':
+            self.submit_job(tdict,rid)
+
+        elif action in ('status','wait','fetch'):
+            job=self.server.jobs.get(str(tdict.get('job')))
+            if job is None:
+                self.reply({'action':action,'error':'Unknown job: '+str(tdict.get('job'))},rid=rid)
+            elif action == 'status':
+                self.reply(job_reply(action,job),rid=rid)
+            elif action == 'wait':
+                self.busy=True
+                def done(job):
+                    if not self.closed: self.reply(job_reply(action,job),rid=rid)
+                self.server.jobs.wait(job,done,timeout=float(tdict.get('timeout',jobs.WAIT_MAX)))
+            elif not job.finished:
+                self.reply({'action':action,'error':'Job not finished: '+job.id},rid=rid)
+            else:
+                rdict,payloads=format_reply(job.task,job.reply)
+                rdict.update(job_reply(action,job))
+                self.reply(rdict,payloads,rid=rid)
+
+# Report readiness and startup timings, waiting up to wait seconds for
+# the server to be ready
+
+        elif action == 'ping':
+            wait=float(tdict.get('wait',0))
+            if wait > 0 and not self.server.ready():
+                self.busy=True
+                def ready():
+                    if not self.closed: self.reply(self.server.health(),rid=rid)
+                self.server.when_ready(ready,min(wait,jobs.WAIT_MAX))
+            else:
+                self.reply(self.server.health(),rid=rid)
+
+# Return server metrics (see metrics.py), starting them again if reset is set
+
+        elif action == 'stats':
+            rdict=self.server.stats()
+            if tdict.get('reset'): self.server.metrics.reset()
+            rdict.update({'action':'stats','error':''})
+            self.reply(rdict,rid=rid)
+
+# Agree on compression codec (first of client's codecs that server allows)
+# and protocol version (the lower of the client's and the server's).
+# The reply is sent in the old framing, and frames after it in the new.
+
+        elif action == 'hello':
+            codecs=[str(c) for c in tdict.get('codecs',[]) if c in self.server.codecs]
+            if codecs: self.codec=codecs[0]
+            version=min(int(tdict.get('version',1)),tools.VERSION)
+            if rid is not None: version=self.version
+            self.reply({'action':'hello','codec':self.codec,'version':version,'error':''},compress=False,rid=rid)
+            self.version=version
+
+        else: 
+            print("Unsupported client action.")
+            self.reply({'action':action,'error':'Unsupported client action: '+action},rid=rid)
+
+# hand IDL job to executor and send reply when done. Results of idempotent
+# commands are returned from, or saved in, the result cache. Idempotent
+# commands do not depend on the session's variables, so may run in any
+# worker; others run in the worker the connection is pinned to (see
+# workers.py).
+
+    def submit(self,job,rid=None):
+
+        import workers,memo
+        key=None
+        cache=self.server.memo
+        if cache and job['action'] == 'execute' and cache.cacheable(job['command'],job.get('idempotent')):
+            key=memo.key(job['command'],job['is_function'],job['keywords'])
+            value=cache.get(key)
+            if value is not memo.MISSING:
+                self.reply(*format_reply(job,(value,'')),rid=rid)
+                return
+            job['stateless']=1
+        job['lean']=self.server.lean
+        space=self.server.scratch
+        held=[]
+        if space: held=space.hold_job(job)
+        def done(reply):
+            for session in held: space.release(session)
+            if key and not reply[1]: cache.put(key,reply[0])
+            if not self.closed: self.reply(*format_reply(job,reply),rid=rid)
+        self.busy=True
+        if not self.server.executor.submit(job,done,owner=self):
+            for session in held: space.release(session)
+            self.server.metrics.count('rejected')
+            self.busy=bool(self.pending)
+            self.reply(*format_reply(job,workers.failed(job,'Server busy. Try again later.')),rid=rid)
+
+# send length bytes of file from offset, as described by download reply
+# rdict
+
+    def send_file(self,rdict,rid=None):
+
+        import tools
+        filename,offset,dsize=rdict['filename'],rdict['offset'],rdict['size']
+        print("Server sending file: "+filename)
+        print "# of bytes: ",str(dsize)
+        if rid is not None:
+            codec=None
+            if self.codec and tools.compressible(filename,dsize): codec=self.codec
+            self.reply(rdict,[tools.DataFrames(tools.FileSource(filename,offset,dsize),rid,codec)],rid=rid)
+        elif self.codec and tools.compressible(filename,dsize):
+            rdict['encoding']=self.codec
+            self.reply(rdict,[tools.CompressedFileSender(filename,self.codec,offset=offset,size=dsize)])
+        else:
+            self.reply(rdict,[tools.FileSender(filename,offset=offset,size=dsize)])
+
+# hash length bytes of file from offset in a thread, as reading a large
+# file would hold up other clients, and call done with the hash object 
+# (None if the file cannot be read)
+
+    def checksum(self,filename,offset,length,done):
+
+        import threading
+        import blobs
+        def run():
+            try:
+                result=blobs.hash_file(filename,offset,length)
+            except (IOError,OSError) as e:
+                print("Error hashing file: "+str(e))
+                result=None
+            self.loop.call_soon_threadsafe(finish,result)
+        def finish(result):
+            if not self.closed: done(result)
+        self.busy=True
+        thread=threading.Thread(target=run)
+        thread.daemon=True
+        thread.start()
+
+# hard-link file of local client into a new temporary directory and reply
+# with rdict. A file on another file system is copied instead, in a thread
+# as a large copy would hold up other clients, once scratch space for it
+# is reserved.
+
+    def link_file(self,filename,rdict,rid=None):
+
+        import os,shutil,threading
+        import tools
+        target=os.path.join(tools.get_temp_dir(),os.path.basename(filename))
+        try:
+            os.link(filename,target)
+        except (AttributeError,OSError):
+            pass
+        else:
+            rdict['filename']=target
+            print("Server linked file: "+target)
+            self.reply(rdict,rid=rid)
+            return
+        if self.server.scratch: rdict['error']=self.server.scratch.reserve(os.path.getsize(filename))
+        if rdict['error']:
+            self.reply(rdict,rid=rid)
+            return
+        def run():
+            try:
+                shutil.copyfile(filename,target)
+                rdict['filename']=target
+                print("Server copied file: "+target)
+            except (IOError,OSError) as e:
+                rdict['error']='Error linking file: '+str(e)
+            self.loop.call_soon_threadsafe(done)
+        def done():
+            if not self.closed: self.reply(rdict,rid=rid)
+        self.busy=True
+        thread=threading.Thread(target=run)
+        thread.daemon=True
+        thread.start()
+
+# cut part of FITS file (see fitscut.py) in a thread, as reading its
+# headers, and an array's data, would hold up other clients. The reply is
+# sent when the part is ready, and a FITS cut is then streamed from it.
+
+    def cut_fits(self,filename,tdict,rid=None):
+
+        import os,threading
+        import fitscut,tools
+        options={}
+        for key in ('hdu','rows','between','columns','section'):
+            if tdict.get(key) is not None: options[key]=tdict[key]
+        if type(options.get('hdu')) == unicode: options['hdu']=str(options['hdu'])
+        rdict={'action':'fits','filename':'cut_'+os.path.basename(filename),'error':''}
+        def run():
+            data=source=None
+            try:
+                if not os.path.isfile(filename): raise fitscut.FITSError('File not found.')
+                if tdict.get('format') == 'array':
+                    value,cards=fitscut.array(filename,**options)
+                    rdict.update(tools.result_header(value))
+                    rdict['cards']=cards
+                    data=tools.array_bytes(value)
+                else:
+                    source=fitscut.cut(filename,**options)
+                    rdict['size']=source.size
+            except Exception as e:
+                rdict.update({'size':0L,'error':str(e)})
+            self.loop.call_soon_threadsafe(done,data,source)
+        def done(data,source):
+            if self.closed:
+                if source: source.close()
+                return
+            if rdict['error']:
+                self.reply(rdict,rid=rid)
+                return
+            if data is not None:
+                payloads=[BytesProducer(data)]
+            elif rid is not None:
+                codec=None
+                if self.codec and source.size >= tools.COMPRESS_MIN: codec=self.codec
+                payloads=[tools.DataFrames(source,rid,codec)]
+            else:
+                payloads=[tools.SourceSender(source)]
+            print("Server sending part of file: "+filename)
+            self.reply(rdict,payloads,rid=rid)
+        self.busy=True
+        thread=threading.Thread(target=run)
+        thread.daemon=True
+        thread.start()
+
+# fetch URL in a thread (see urlcache.py) and reply when done
+
+    def fetch_url(self,url,rid=None):
+
+        import threading
+        def done(result):
+            path,name,error=result
+            if not self.closed: self.reply({'action':'url','filename':path or '','name':name,'error':error},rid=rid)
+        def run():
+            result=self.server.urls.fetch(url)
+            self.loop.call_soon_threadsafe(done,result)
+        self.busy=True
+        thread=threading.Thread(target=run)
+        thread.daemon=True
+        thread.start()
+
+# start job for command, or list of commands, in request
+
+    def submit_job(self,tdict,rid=None):
+
+        if 'commands' in tdict:
+            task={'action':'batch','commands':tdict['commands'],'stop_on_error':tdict.get('stop_on_error',0)}
+        else:
+            task={'action':'execute','command':tdict['command'],
+                  'is_function':tdict.get('is_function',0),'keywords':tdict.get('keywords',{})}
+        task['lean']=self.server.lean
+        job_dir=tdict.get('job_dir')
+        if job_dir: job_dir=str(job_dir)
+        job=self.server.jobs.submit(task,job_dir=job_dir)
+        if job is None:
+            self.reply({'action':'submit','job':'','error':'Server busy. Try again later.'},rid=rid)
+        else:
+            self.reply({'action':'submit','job':job.id,'error':''},rid=rid)
+
+# queue response frame and payloads to send. On version 2 connections
+# the response to request rid is queued as a Stream of frames.
+
+    def reply(self,tdict,payloads=[],compress=True,rid=None):
+
+        import json,struct,time
+        import tools
+        if self.local and payloads: payloads=self.share(tdict,payloads)
+        if rid is not None:
+            self.reply_frames(tdict,payloads,rid)
+            return
+        if self.treply is None:
+            self.treply=time.time()
+            self.failed=bool(tdict.get('error'))
+        sdict=json.dumps(tdict)
+        length=len(sdict)
+        if compress and self.codec and length >= tools.COMPRESS_MIN:
+            sdict=tools.compress(self.codec,sdict)
+            length=len(sdict) | tools.COMPRESSED
+        if not self.output: self.last_sent=time.time()
+        self.output.append(BytesProducer(struct.pack('!I',length)+sdict))
+        self.output.extend(payloads)
+        self.busy=True
+        self.update_events()
+
+# local connection: write array payloads of SHM_MIN bytes or more to shared
+# memory files, given as shm in their result headers. Returns the payloads
+# still to be sent.
+
+    def share(self,tdict,payloads):
+
+        import os
+        import tools
+        headers=tdict.get('results',[tdict]) if tdict.get('action') == 'batch' else [tdict]
+        headers=[h for h in headers if h.get('type') == 'array']
+        if len(headers) != len(payloads): return payloads
+        self.shm=[path for path in self.shm if os.path.exists(path)]
+        kept=[]
+        for header,payload in zip(headers,payloads):
+            path=None
+            if isinstance(payload,BytesProducer) and header['size'] >= tools.SHM_MIN: path=tools.write_shm(payload.view)
+            if path:
+                header['shm']=path
+                self.shm.append(path)
+                payload.close()
+            else:
+                kept.append(payload)
+        return kept
+
+# version 2: header frame, then DATA frames for each payload. Arrays are
+# sent as they are, files compressed if so given (see handle).
+
+    def reply_frames(self,tdict,payloads,rid):
+
+        import json,time
+        import tools
+        request=self.pending.pop(rid,{'action':tdict.get('action'),'tstart':None,'nin':0})
+        producers=[BytesProducer(tools.pack_frame(rid,tools.HEADER,json.dumps(tdict),self.codec))]
+        for payload in payloads:
+            if isinstance(payload,BytesProducer): payload=tools.DataFrames(tools.BytesSource(payload.view),rid)
+            if payload.done:
+                payload.close()
+            else:
+                producers.append(payload)
+        if not self.output: self.last_sent=time.time()
+        self.output.append(Stream(rid,producers,request,bool(tdict.get('error'))))
+        self.busy=True
+        self.update_events()
+        if self.rbuf: self.loop.call_later(0.,self.process)
+
+# record metrics of request once its response has been sent. Bytes received
+# since the last response are counted towards the request.
+
+    def record(self):
+
+        import time
+        if self.action:
+            now=time.time()
+            transfer=self.treceive
+            if self.treply: transfer += now-self.treply
+            metrics=self.server.metrics
+            metrics.request(self.action,now-self.tstart,self.failed,self.nin,self.nout)
+            metrics.observe('transfer',transfer)
+        self.action=None
+        self.clear_stats()
+
+    def record_stream(self,stream):
+
+        import time
+        request=stream.request
+        if not request.get('tstart'): return
+        self.server.metrics.request(request['action'],time.time()-request['tstart'],stream.failed,request['nin'],stream.nbytes)
+
+    def clear_stats(self):
+
+        self.tstart=None
+        self.treply=None
+        self.treceive=0.
+        self.failed=False
+        self.nin=0
+        self.nout=0
+
+    def close(self):
+
+        import os,socket
+        if self.closed: return
+        self.closed=True
+        self.loop.unregister(self.sock)
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+        self.server.connections.discard(self)
+        self.server.executor.cancel(self)
+        if self.upload: self.upload.close()
+        for upload in self.uploads.values(): upload.close()
+        self.uploads.clear()
+        for producer in self.output: producer.close()
+        self.output.clear()
+        for path in self.shm:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.shm=[]
+
+##################################################################################################
+# return next length-prefixed frame in buffer (removing it), or None if
+# the frame is not complete. Compressed frames are decompressed with codec.
+# Frames over max_size (before or after decompression) raise ValueError.
+
+def next_frame(buf,codec='',max_size=None):
+
+    import struct
+    import tools
+    if max_size is None: max_size=tools.MAX_FRAME
+    if len(buf) < 4: return None
+    length, = struct.unpack('!I',bytes(buf[:4]))
+    compressed=length & tools.COMPRESSED
+    length &= ~tools.COMPRESSED
+    if length > max_size: raise ValueError('Frame of %d bytes exceeds limit.' % length)
+    if len(buf) < 4+length: return None
+    data=buf[4:4+length]
+    del buf[:4+length]
+    if compressed: data=tools.decompress(codec,bytes(data),max_size)
+    return data
+
+##################################################################################################
+# tell client why its connection is refused (if its socket has room) and 
+# close it
+
+def refuse(sock,reason):
+
+    import json,socket,struct
+    data=json.dumps({'action':'busy','error':reason})
+    try:
+        sock.setblocking(0)
+        sock.send(struct.pack('!I',len(data))+data)
+    except socket.error:
+        pass
+    sock.close()
+
+##################################################################################################
+# Producers write a response to a non-blocking socket a piece at a time.
+# send(sock) makes one send call, returns the number of bytes sent and sets
+# done when finished. Files are sent by tools.FileSender.
+
+class BytesProducer(object):
+
+    def __init__(self,data):
+        self.view=memoryview(data)
+        self.pos=0
+        self.done=len(self.view) == 0
+
+    def send(self,sock):
+        nbytes=sock.send(self.view[self.pos:])
+        self.pos += nbytes
+        self.done=self.pos >= len(self.view)
+        return nbytes
+
+    def close(self):
+        self.view=None
+
+# version 2 response to request rid: producers of its frames, sent in 
+# order. boundary is set between frames, where the connection may turn 
+# to another stream.
+
+class Stream(object):
+
+    def __init__(self,rid,producers,request,failed=False):
+        self.rid=rid
+        self.producers=collections.deque(producers)
+        self.request=request          # action, start time and bytes received
+        self.failed=failed
+        self.nbytes=0
+        self.boundary=True
+        self.done=not self.producers
+
+    def send(self,sock):
+        producer=self.producers[0]
+        nbytes=producer.send(sock)
+        self.nbytes += nbytes
+        self.boundary=producer.done or getattr(producer,'boundary',False)
+        if producer.done:
+            self.producers.popleft()
+            producer.close()
+        self.done=not self.producers
+        return nbytes
+
+    def close(self):
+        for producer in self.producers: producer.close()
+        self.producers.clear()
+
+##################################################################################################
+# upload in progress: file bytes are written as they arrive. If the file 
+# cannot be written the bytes are still read (and discarded) to keep the
+# connection in step. Compressed uploads (encoding set) are decoded by 
+# tools.FrameDecoder. 
+
+# If digest is given, the contents are hashed as they are written. With a
+# store (blobs.BlobStore), the file is written to the store's partial file 
+# for digest, resuming at offset, and kept if the upload is interrupted. 
+# Otherwise it is written to a new temporary directory (in scratch, if
+# given, which must have room for it) and digest is cleared if the 
+# contents do not match it. Files over limit bytes are not written.
+
+# Resuming needs the hash of the bytes already received, which the store
+# keeps in memory (see blobs.BlobStore.part_hash), so that the partial
+# file is not read again here.
+
+class Upload(object):
+
+    def __init__(self,filename,size,encoding=None,digest=None,store=None,offset=0,scratch=None,limit=0):
+        import os,time
+        import tools,blobs
+        self.size=size
+        self.tstart=time.time()
+        self.offset=offset
+        self.remaining=size-offset
+        self.result=None
+        self.error=''
+        self.file=None
+        self.decoder=None
+        self.done=self.remaining <= 0 and not encoding
+        self.digest=digest
+        self.store=None
+        self.name=filename
+        part=None
+        prefix=None
+        oversize=limit and size > limit
+        if store and digest and not oversize: part=store.begin(digest)
+        if oversize:
+            self.error='File exceeds upload limit of %d bytes.' % limit
+        elif part:
+            self.store=store
+            self.filename=part
+            exists=os.path.isfile(part)
+            if offset: prefix=store.part_hash(digest,offset)
+            if offset and (not exists or prefix is None):
+                self.error='Partial upload not found: '+filename
+            else:
+                self.file=open(part,'r+b' if exists else 'wb')
+                self.file.seek(offset)
+                self.file.truncate()
+        elif offset:
+            self.error='Partial upload not found: '+filename
+        else:
+            if scratch: self.error=scratch.reserve(size)
+            if not self.error:
+                tdir=tools.get_temp_dir()
+                self.filename=os.path.join(tdir,filename)
+                if not os.access(tdir,os.W_OK):
+                    self.error='No write access to: '+tdir
+                else:
+                    self.file=open(self.filename,'wb')
+        self.out=self.file
+        if digest and self.file:
+            self.out=blobs.HashWriter(self.file,prefix)
+        if encoding: self.decoder=tools.FrameDecoder(self.out,encoding,max_size=self.remaining)
+
+    def feed(self,buf):
+        if self.decoder:
+            nbytes=self.decoder.feed(buf)
+            self.done=self.decoder.done
+            if self.done: self.remaining=self.size-self.offset-self.decoder.size
+            return nbytes
+        nbytes=min(len(buf),self.remaining)
+        if self.out: self.out.write(buf[:nbytes])
+        self.remaining -= nbytes
+        self.done=self.remaining == 0
+        return nbytes
+
+    def close(self):
+        if not self.file: 
+            if self.store: self.store.end(self.digest,keep=True)
+            return
+        self.file.close()
+        self.file=None
+        complete=self.done and self.remaining == 0
+        if self.store:
+            if not complete:
+                self.store.end(self.digest,keep=True,hash=self.out.hash)
+                self.error='Error writing '+self.name
+            elif self.digest != self.out.hexdigest():
+                self.store.end(self.digest)
+                self.error='Checksum mismatch: '+self.name
+            else:
+                self.result=self.store.commit(self.digest,self.name)
+                self.digest=None
+        elif complete:
+            self.result=self.filename
+            if self.digest and self.digest != self.out.hexdigest(): self.digest=None
+        else:
+            self.error='Error writing '+self.filename
+
+##################################################################################################
+# run IDL job (execute, batch or get request) in IDL session and return reply.
+# execute and get reply with (result,error); batch with (list of (result,error),error)
+
+def run_job(IDL,job):
+
+    session.overhead=0.
+    action=job['action']
+    lean=job.get('lean',True)
+    if action == 'execute':
+        return execute(IDL,str(job['command']),str(job['is_function']),job['keywords'],lean)
+
+    if action == 'get':
+        return fetch(IDL,str(job['name']))
+
+    stop_on_error=job.get('stop_on_error',0)
+    results=[]
+    for item in job['commands']:
+        cmd=str(item['command'])
+        is_function=str(item.get('is_function',0))
+        edict=item.get('keywords',{})
+        result,error=execute(IDL,cmd,is_function,edict,lean)
+        results.append((result,error))
+        if error and stop_on_error: break
+    return (results,'')
+
+##################################################################################################
+# format reply to IDL job as (response,payloads). Array results follow the
+# JSON response in binary.
+
+def format_reply(job,reply):
+
+    import tools
+    action=job['action']
+    if action == 'batch':
+        results,error=reply
+        headers=[]
+        for result,rerror in results:
+            header=tools.result_header(result)
+            header['error']=rerror
+            headers.append(header)
+        tdict={'action':'batch','results':headers,'error':error}
+    else:
+        result,error=reply
+        results=[reply]
+        tdict={'action':action,'error':error}
+        tdict.update(tools.result_header(result))
+    payloads=[]
+    for result,rerror in results:
+        if tools.is_array(result): payloads.append(BytesProducer(tools.array_bytes(result)))
+    return (tdict,payloads)
+
+##################################################################################################
+# status of job as reply to action. The job's own error is sent as 
+# job_error, so error is left for errors in the request itself.
+
+def job_reply(action,job):
+
+    tdict=job.status()
+    tdict['action']=action
+    tdict['job_error']=tdict.pop('error')
+    tdict['error']=''
+    return tdict
+
+##################################################################################################
+# execute IDL command with optional keywords (passed via _extra)
+# return (result,error) strings
+
+# In lean mode the IDL session is only reset (retall, message/reset) after
+# a command fails, and keywords are not printed with help. Otherwise each
+# command is run after a reset, as before. Time spent in IDL statements 
+# other than the command itself is added to the overhead of the current
+# job (see last_overhead).
+
+# The statements of RESET are joined with '&'. They used to be joined 
+# with ';', which IDL takes as the start of a comment, so only retall ran 
+# and an error state (!error_state, catch handlers) carried over to the
+# next command; now message,/reset and catch,/cancel run as well.
+
+RESET='retall & message,/reset & catch,/cancel'
+needs_reset=set()                 # sessions (by id) to reset before next command
+
+# Each IDL session runs its jobs in one thread (an IDL thread, or a worker
+# process), so the overhead of the job being run is kept per thread.
+
+session=threading.local()
+
+def last_overhead():
+
+    return getattr(session,'overhead',0.)
+
+def execute(IDL,cmd,is_function,edict,lean=True):
+
+    import time
+    import tools
+    result=''
+    error=''		
+    tstart=time.time()
+    if not lean or id(IDL) in needs_reset:
+        IDL.run(RESET)
+        needs_reset.discard(id(IDL))
+    IDL.result=result
+    IDL.err=error
+    if not lean: IDL.extra_keywords=''
+    elapsed=0.
+    try:
+        if edict: 
+            IDL.extra_keywords=edict
+            IDL.run("extra=hash2struct(extra_keywords)",stdout=not lean)
+            if not lean: IDL.run("help,extra",stdout=True)
+            cmd=extra_command(cmd,is_function)
+        print("Executing: "+cmd)
+        tcmd=time.time()
+        try:
+            IDL.run(cmd,stdout=True)           
+        finally:
+            elapsed=time.time()-tcmd
+    except Exception as e:
+        print('Caught IDL error: ' + str(e))
+        error=str(e)
+    else:
+        if type(IDL.result) == str or tools.is_array(IDL.result): result=IDL.result
+        if type(IDL.err) == str: error=IDL.err
+    if error: needs_reset.add(id(IDL))
+    session.overhead=last_overhead()+time.time()-tstart-elapsed
+    return (result,error)
+
+##################################################################################################
+# command with keywords passed via _extra: inserted before the closing 
+# parenthesis of a function call (the last in the command, so that of the
+# outer call in f(g(x))), or appended to a procedure call. Commands are
+# kept in templates, so repeated commands are not rebuilt.
+
+templates=collections.OrderedDict()
+templates_lock=threading.Lock()
+MAX_TEMPLATES=256
+
+def extra_command(cmd,is_function):
+
+    key=(cmd,is_function)
+    with templates_lock:
+        template=templates.get(key)
+    if template is None:
+        close=cmd.rfind(')')
+        if is_function != "1":
+            template=cmd+',_extra=extra'
+        elif close >= 0:
+            sep=','
+            if cmd[:close].rstrip().endswith('('): sep=''
+            template=cmd[:close]+sep+'_extra=extra'+cmd[close:]
+        else:
+            template=cmd
+        with templates_lock:
+            templates[key]=template
+            if len(templates) > MAX_TEMPLATES: templates.popitem(last=False)
+    return template
+
+##################################################################################################
+# return (value,error) of IDL variable. Numeric values are returned as numpy
+# arrays (scalars as 0-d arrays) to be sent in binary.
+
+def fetch(IDL,name):
+
+    import tools
+    try:
+        value=getattr(IDL,name)
+    except Exception as e:
+        return ('',str(e))
+    if value is None: return ('','Undefined variable: '+name)
+    if type(value) == str or tools.is_array(value): return (value,'')
+    try:
+        import numpy
+        return (numpy.asarray(value),'')
+    except Exception as e:
+        return ('',str(e))
 
 ##################################################################################################
 # stop Python-IDL server
 
 def stop(port=10000):
     import config
-    config.stop_server=True
-    config.port=port
+    server=config.servers.get(port)
+    if server: server.stop()
 
 ##################################################################################################
 	
 if __name__ == "__main__":
     start(thread=0)
-	    
-			
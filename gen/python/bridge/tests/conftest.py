@@ -0,0 +1,44 @@
+
+# Tests of the Python-IDL bridge, run with pytest from gen/python/bridge:
+#   python -m pytest tests
+# Servers are started with the stand-in IDL backend (fakeidl.py), so IDL is
+# not needed.
+
+import os,sys,tempfile
+import pytest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# temporary files (sessions, uploads) go under the test's directory
+
+@pytest.fixture
+def tmp(tmpdir,monkeypatch):
+
+    monkeypatch.setattr(tempfile,'tempdir',str(tmpdir))
+    return str(tmpdir)
+
+# start_server(**options) starts a bridge server (see bench.start_server)
+# and returns its port. Servers are stopped after the test.
+
+@pytest.fixture
+def start_server(tmp):
+
+    import bench
+    servers=[]
+    def start(**kwargs):
+        port,thread=bench.start_server(**kwargs)
+        servers.append((port,thread))
+        return port
+    yield start
+    for port,thread in servers: bench.stop_server(port,thread)
+
+# file of n random bytes in the test's directory
+
+@pytest.fixture
+def make_file(tmp):
+
+    def make(name,n):
+        path=os.path.join(tmp,name)
+        with open(path,'wb') as f: f.write(os.urandom(n))
+        return path
+    return make
@@ -0,0 +1,136 @@
+
+# Asynchronous client (aclient.py): futures, timeouts and the limit on
+# requests in flight
+
+import os,threading
+import pytest
+import aclient
+
+@pytest.fixture
+def connect(start_server):
+
+    clients=[]
+    def make(**kwargs):
+        server={'workers':kwargs.pop('workers',2)}
+        if not kwargs.pop('local',True): server['unix_socket']=False
+        bridge=aclient.AsyncClient('localhost',start_server(**server),**kwargs)
+        clients.append(bridge)
+        return bridge
+    yield make
+    for bridge in clients: bridge.close()
+
+@pytest.mark.parametrize('local',[True,False])
+def test_many_calls(connect,local):
+
+    bridge=connect(connections=2,local=local)
+    futures=[bridge.run("result='r%d'" % i) for i in range(500)]
+    done=list(aclient.as_completed(futures,60))
+    assert len(done) == 500
+    assert [future.result() for future in futures] == ['r%d' % i for i in range(500)]
+    assert len(bridge.channels) <= 2
+
+def test_results_and_errors(connect):
+
+    bridge=connect()
+    assert len(bridge.run('result=fake_array(300000)').result(10)) == 300000
+    results=bridge.run_batch(["result=fake_array(3)","result='x'","message,'bad'"]).result(10)
+    assert list(results[0][0]) == [0.,1.,2.]
+    assert results[1] == ('x','')
+    assert results[2][1]
+    with pytest.raises(aclient.BridgeError):
+        bridge.run("message,'boom'").result(10)
+    assert bridge.ping().result(10)['ready'] is not None
+
+# futures that time out or are cancelled give up their place, so later
+# calls are not held behind max_inflight
+
+def test_timeouts_free_inflight(connect):
+
+    bridge=connect(connections=1,max_inflight=2)
+    slow=[bridge.run('wait,2',timeout=0.3) for i in range(2)]
+    for future in slow:
+        with pytest.raises(aclient.Timeout):
+            future.result(10)
+    future=bridge.run("result='next'")
+    assert list(bridge.inflight.values()) == [1]
+    assert future.result(10) == 'next'
+
+def test_cancel(connect):
+
+    bridge=connect(connections=1,max_inflight=1)
+    slow=bridge.run('wait,2')
+    queued=bridge.run("result='queued'")
+    assert len(bridge.queue) == 1
+    assert queued.cancel()
+    assert slow.cancel()
+    assert isinstance(slow.exception(),aclient.Cancelled)
+    assert bridge.run("result='after'").result(10) == 'after'
+    assert len(bridge.queue) == 0
+
+@pytest.mark.parametrize('local',[True,False])
+def test_files(tmp,connect,make_file,local):
+
+    bridge=connect(connections=1,max_inflight=2,local=local)
+    name=make_file('in.fits',1048576)
+    uploads=[bridge.upload(name) for i in range(5)]
+    locations=[future.result(30) for future in uploads]
+    assert all(open(location,'rb').read() == open(name,'rb').read() for location in locations)
+    path=bridge.download(locations[0],outdir=os.path.join(tmp,'out')).result(30)
+    assert open(path,'rb').read() == open(name,'rb').read()
+    with pytest.raises(aclient.BridgeError):
+        bridge.download('/nonexistent',outdir=tmp).result(10)
+    with pytest.raises(aclient.BridgeError):
+        bridge.upload(os.path.join(tmp,'missing')).result(10)
+    prepped=[bridge.prep(name,outdir=os.path.join(tmp,'prep')) for i in range(3)]
+    assert [os.path.basename(future.result(30)) for future in prepped] == ['prepped_in.fits']*3
+
+# uploads wait for room on a connection as other calls do
+
+def test_upload_queued(connect,make_file):
+
+    bridge=connect(connections=1,max_inflight=1,local=False)
+    name=make_file('in.fits',1048576)
+    slow=bridge.run('wait,1')
+    upload=bridge.upload(name)
+    assert len(bridge.queue) == 1 and not upload.done()
+    slow.result(10)
+    assert open(upload.result(10),'rb').read() == open(name,'rb').read()
+
+# calls from several threads open no more than connections channels
+
+def test_threads(connect):
+
+    bridge=connect(connections=3)
+    futures=[]
+    def work():
+        for i in range(50): futures.append(bridge.run("result='%d'" % i))
+    threads=[threading.Thread(target=work) for i in range(8)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert len(aclient.wait(futures,30)) == 400
+    assert len(bridge.channels) <= 3
+
+def test_closed_and_unreachable(connect):
+
+    bridge=connect()
+    bridge.close()
+    with pytest.raises(aclient.BridgeError):
+        bridge.run("result='x'").result(1)
+    bridge=aclient.AsyncClient('localhost',1)
+    with pytest.raises(aclient.BridgeError):
+        bridge.run("result='x'").result(5)
+
+# closing the client fails calls still queued, and those in flight
+
+def test_close_with_queued_calls(connect):
+
+    bridge=connect(connections=1,max_inflight=1)
+    running=bridge.run('wait,2')
+    queued=[bridge.run("result='q%d'" % i) for i in range(3)]
+    assert len(bridge.queue) == 3
+    bridge.close()
+    for future in queued:
+        error=future.exception(1)
+        assert isinstance(error,aclient.BridgeError) and str(error) == 'Client closed.'
+    assert isinstance(running.exception(5),aclient.BridgeError)
+    assert bridge.channels == [] and len(bridge.queue) == 0
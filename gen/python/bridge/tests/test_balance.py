@@ -0,0 +1,130 @@
+
+# Client-side load balancing (balance.py): policies, pinning and ejection
+# of servers that cannot be reached
+
+import time
+import pytest
+import balance,client
+
+SERVERS=[('host%d' % i,10000) for i in range(3)]
+
+@pytest.fixture(autouse=True)
+def health(monkeypatch):
+
+    monkeypatch.setattr(balance,'health',{})
+    monkeypatch.setattr(balance,'balancers',{})
+    return balance.health
+
+def test_least_outstanding():
+
+    balancer=balance.Balancer(SERVERS)
+    balancer.begin(SERVERS[0])
+    balancer.begin(SERVERS[1])
+    assert set([balancer.choose() for i in range(5)]) == set([SERVERS[2]])
+    balancer.begin(SERVERS[2])
+    assert set([balancer.choose() for i in range(6)]) == set(SERVERS)
+    balancer.end(SERVERS[1])
+    assert balancer.choose() == SERVERS[1]
+    assert balancer.choose(exclude=[SERVERS[1]]) in (SERVERS[0],SERVERS[2])
+
+# a key keeps to one server, and only keys on a server that goes down move
+
+def test_hash_ring():
+
+    balancer=balance.Balancer(['host%d:10000' % i for i in range(3)],policy='hash')
+    keys=['file%d.fits' % i for i in range(300)]
+    chosen=dict([(key,balancer.choose(key)) for key in keys])
+    assert chosen == dict([(key,balancer.choose(key)) for key in keys])
+    counts=[chosen.values().count(s) for s in SERVERS]
+    assert min(counts) > 50
+    balance.mark_down(SERVERS[0])
+    for key in keys:
+        if chosen[key] != SERVERS[0]: assert balancer.choose(key) == chosen[key]
+        else: assert balancer.choose(key) != SERVERS[0]
+
+def test_pin():
+
+    balancer=balance.Balancer(SERVERS)
+    key=balance.Pin('session1')
+    assert len(set([balancer.choose(key) for i in range(10)])) == 1
+    assert balancer.choose(key) == balance.Balancer(SERVERS,policy='hash').choose('session1')
+
+def test_unicode_keys():
+
+    balancer=balance.Balancer(SERVERS,policy='hash')
+    assert balance.hash_key(u'caf\xe9.fits') == balance.hash_key(u'caf\xe9.fits'.encode('utf-8'))
+    assert balance.hash_key(u'a.fits') == balance.hash_key('a.fits')
+    assert balancer.choose(u'caf\xe9.fits') in SERVERS
+    calls=[]
+    def func(**kwargs):
+        calls.append((kwargs['ip'],kwargs['port']))
+        return 'ok'
+    servers=['host%d:10000' % i for i in range(3)]
+    assert balance.call(func,(),{'servers':servers,'pin':u'\u65e5\u672c'}) == 'ok'
+    assert balance.call(func,(),{'servers':servers,'pin':u'\u65e5\u672c'}) == 'ok'
+    assert calls[0] == calls[1]
+
+def test_pins_bounded(monkeypatch):
+
+    monkeypatch.setattr(balance,'MAX_PINS',3)
+    balancer=balance.Balancer(SERVERS)
+    for i in range(5): balancer.pin('dir%d' % i,SERVERS[i % 3])
+    assert balancer.pinned('dir0') is None
+    assert balancer.pinned('dir4') == SERVERS[1]
+
+###############################################################################
+# servers that cannot be reached are ejected, for longer after each failure
+
+def test_ejection_backoff(health):
+
+    server=SERVERS[0]
+    balance.mark_down(server)
+    assert balance.is_down(server)
+    first=health[server][0]-time.time()
+    balance.mark_down(server)
+    second=health[server][0]-time.time()
+    assert abs(first-balance.EJECT_TIME) < 1 and abs(second-2*balance.EJECT_TIME) < 1
+    for i in range(20): balance.mark_down(server)
+    assert health[server][0]-time.time() <= balance.EJECT_MAX
+    balance.mark_up(server)
+    assert not balance.is_down(server)
+    health[server]=(time.time()-1,3)
+    assert not balance.is_down(server)
+
+def test_call_tries_other_servers():
+
+    tried=[]
+    def func(**kwargs):
+        server=(kwargs['ip'],kwargs['port'])
+        tried.append(server)
+        if server != SERVERS[2]:
+            balance.mark_down(server)
+            return None
+        return 'dir/file'
+    servers=['host%d:10000' % i for i in range(3)]
+    record=lambda result: 'dir'
+    assert balance.call(func,(),{'servers':servers},record=record) == 'dir/file'
+    assert tried[-1] == SERVERS[2] and len(tried) == len(set(tried))
+    assert balance.get(servers).pinned('dir') == SERVERS[2]
+    balance.mark_down(SERVERS[2])
+    assert balance.call(func,(),{'servers':servers}) is None
+
+# data left on a server is fetched from it, even if others are less busy
+
+def test_pinned_location():
+
+    def func(**kwargs):
+        return (kwargs['ip'],kwargs['port'])
+    servers=['host%d:10000' % i for i in range(3)]
+    balance.get(servers).pin('dir',SERVERS[1])
+    for i in range(3): assert balance.call(func,(),{'servers':servers},location='dir') == SERVERS[1]
+
+def test_servers(start_server):
+
+    ports=[start_server(unix_socket=False) for i in range(2)]
+    servers=['localhost:%d' % port for port in ports]+['localhost:1']
+    for i in range(6): assert client.run("result='ok'",servers=servers) == 'ok'
+    assert balance.is_down(('localhost',1))
+    job=client.submit("result='done'",servers=servers)
+    assert client.wait(job,timeout=10,servers=servers)['state'] == 'done'
+    assert client.fetch(job,servers=servers) == 'done'
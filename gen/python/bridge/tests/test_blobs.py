@@ -0,0 +1,91 @@
+
+# Content-addressed upload store (blobs.py): dedupe and resumed uploads
+
+import hashlib,os
+import blobs,client,server
+
+def actions(port):
+
+    return client.stats(port=port)['actions']
+
+def read(path):
+
+    with open(path,'rb') as f: return f.read()
+
+def test_upload_dedupe(tmp,start_server,make_file):
+
+    port=start_server(cache_dir=os.path.join(tmp,'blobs'),unix_socket=False)
+    name=make_file('in.dat',1000000)
+    first=client.upload(name,port=port)
+    second=client.upload(name,port=port)
+    assert first != second
+    assert read(first) == read(second) == read(name)
+    counts=actions(port)
+    assert counts['upload']['count'] == 1
+    assert counts['have']['count'] == 2
+    client.upload(name,port=port,cache=False)
+    assert actions(port)['upload']['count'] == 2
+
+# the bytes of an upload interrupted before a restart are kept, and only
+# the rest of the file is sent
+
+def test_resume_upload(tmp,start_server,make_file):
+
+    root=os.path.join(tmp,'blobs')
+    name=make_file('in.dat',4*1048576)
+    data=read(name)
+    os.makedirs(root)
+    with open(os.path.join(root,blobs.file_hash(name)+'.part'),'wb') as f: f.write(data[:3*1048576])
+    port=start_server(cache_dir=root,unix_socket=False)
+    location=client.upload(name,port=port)
+    assert read(location) == data
+    assert actions(port)['upload']['bytes_in'] < 2*1048576
+    assert not [n for n in os.listdir(root) if n.endswith('.part')]
+
+def test_resume_checks_hash(tmp):
+
+    store=blobs.BlobStore(os.path.join(tmp,'blobs'),1<<30)
+    data=os.urandom(3000000)
+    digest=hashlib.sha1(data).hexdigest()
+    upload=server.Upload('x.dat',len(data),digest=digest,store=store)
+    upload.feed(data[:1000000])
+    upload.close()
+    assert upload.error
+    assert store.part_size(digest) == 1000000
+    assert store.part_hash(digest,1000000) is not None
+    upload=server.Upload('x.dat',len(data),digest=digest,store=store,offset=1000000)
+    upload.feed(data[1000000:])
+    upload.close()
+    assert upload.error == ''
+    assert read(upload.result) == data
+
+# a resumed upload whose bytes do not match the hash is not stored
+
+def test_resume_corrupt(tmp):
+
+    store=blobs.BlobStore(os.path.join(tmp,'blobs'),1<<30)
+    data=os.urandom(3000000)
+    digest=hashlib.sha1(data).hexdigest()
+    upload=server.Upload('x.dat',len(data),digest=digest,store=store)
+    upload.feed(data[:1000000])
+    upload.close()
+    upload=server.Upload('x.dat',len(data),digest=digest,store=store,offset=1000000)
+    upload.feed('\0'*2000000)
+    upload.close()
+    assert upload.error.startswith('Checksum mismatch')
+    assert store.checkout(digest,'x.dat') == ''
+
+def test_resume_unknown_partial(tmp):
+
+    store=blobs.BlobStore(os.path.join(tmp,'blobs'),1<<30)
+    upload=server.Upload('y.dat',10,digest='a'*40,store=store,offset=5)
+    assert upload.error.startswith('Partial upload not found')
+
+def test_download_verify(tmp,start_server,make_file):
+
+    port=start_server(unix_socket=False)
+    name=make_file('in.dat',2*1048576)
+    location=client.upload(name,port=port)
+    for outdir in ('out1','out2'):
+        path=client.download(location,port=port,outdir=os.path.join(tmp,outdir),verify=True)
+        assert read(path) == read(name)
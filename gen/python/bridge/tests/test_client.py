@@ -0,0 +1,161 @@
+
+# Blocking client (client.py): pooled connections, retries and batches
+
+import socket,time
+import pytest
+import client,pool,tools
+
+def connections(port):
+
+    return client.stats(port=port)['counters']['connections']
+
+def idle(port):
+
+    return len(pool.default.idle.get(('localhost',port),[]))
+
+def test_pool_reuse(start_server):
+
+    port=start_server(unix_socket=False)
+    for i in range(5): assert client.run("result='r%d'" % i,port=port) == 'r%d' % i
+    assert connections(port) == 1
+    assert idle(port) == 1
+
+def test_persist_false_closes(start_server):
+
+    port=start_server(unix_socket=False)
+    before=idle(port)
+    assert client.run("result='a'",port=port,persist=False) == 'a'
+    assert idle(port) == before
+
+# connection dropped by the server while idle in the pool is replaced
+
+def test_stale_connection_retried(start_server):
+
+    port=start_server(idle_timeout=1)
+    assert client.run("result='a'",port=port) == 'a'
+    time.sleep(2.5)
+    assert client.run("result='b'",port=port) == 'b'
+
+# a request that timed out may still be running, so it is not sent again
+
+def test_timeout_not_retried(start_server):
+
+    port=start_server(unix_socket=False)
+    before=connections(port)
+    assert client.run("wait,1.5 & result='c'",port=port,timeout=0.5) is None
+    assert idle(port) == 0
+    assert connections(port) == before+1
+
+# a server that does not accept the connection fails the call within
+# the connect timeout, rather than the system's
+
+@pytest.fixture
+def unresponsive():
+
+    listener=socket.socket()
+    listener.bind(('127.0.0.1',0))
+    listener.listen(0)
+    port=listener.getsockname()[1]
+    waiting=[socket.create_connection(('127.0.0.1',port))]
+    yield port
+    for sock in waiting+[listener]: sock.close()
+
+def test_connect_timeout(unresponsive,monkeypatch):
+
+    monkeypatch.setattr(tools,'CONNECT_TIMEOUT',0.5)
+    for persist in (True,False):
+        start=time.time()
+        assert client.run("result='a'",ip='127.0.0.1',port=unresponsive,persist=persist) is None
+        assert time.time()-start < 5
+    with pytest.raises(socket.timeout):
+        tools.connect('127.0.0.1',unresponsive)
+
+def test_connected_socket_blocking(start_server):
+
+    port=start_server(unix_socket=False)
+    sock=tools.connect('localhost',port)
+    try:
+        assert sock.gettimeout() is None
+    finally:
+        sock.close()
+    sock=tools.connect('localhost',port,timeout=30)
+    try:
+        assert sock.gettimeout() == 30
+    finally:
+        sock.close()
+
+###############################################################################
+# batches
+
+def test_batch(start_server):
+
+    port=start_server(unix_socket=False)
+    results=client.run_batch(["a='x'","result=a","message,'bad'","result='after'"],port=port)
+    assert results[1] == ('x','')
+    assert results[2][0] == '' and results[2][1]
+    assert results[3] == ('after','')
+    results=client.run_batch(["message,'bad'","result='skipped'"],port=port,stop_on_error=True)
+    assert len(results) == 1 and results[0][1]
+    assert client.run_batch([],port=port) is None
+
+# array results, alone and in batches, come back as numpy arrays
+
+def test_array_results(start_server):
+
+    port=start_server(unix_socket=False)
+    array=client.run('result=fake_array(100000)',port=port)
+    assert array.dtype == 'float32' and len(array) == 100000 and array[-1] == 99999.
+    assert client.run('a=fake_array(5)',port=port) == ''
+    assert list(client.get('a',port=port)) == [0.,1.,2.,3.,4.]
+    results=client.run_batch(["result=fake_array(3)","result='x'","result=fake_array(2)"],port=port)
+    assert list(results[0][0]) == [0.,1.,2.]
+    assert results[1] == ('x','')
+    assert list(results[2][0]) == [0.,1.]
+
+# a batch whose results cannot all be read leaves the connection out of
+# step, so it is not returned to the pool
+
+def test_batch_desync_not_pooled(start_server,monkeypatch):
+
+    port=start_server(unix_socket=False)
+    recv_result=tools.recv_result
+    calls=[]
+    def flaky(sock,header):
+        calls.append(header)
+        if len(calls) == 1: return None
+        return recv_result(sock,header)
+    monkeypatch.setattr(tools,'recv_result',flaky)
+    assert client.run_batch(["result=fake_array(1000)","result=fake_array(1000)"],port=port) is None
+    monkeypatch.setattr(tools,'recv_result',recv_result)
+    assert idle(port) == 0
+    assert client.run("result='next'",port=port) == 'next'
+    assert list(client.run("result=fake_array(2)",port=port)) == [0.,1.]
+
+###############################################################################
+# prep_many retries transient failures only, waiting longer before each
+# further try
+
+def test_prep_many_retries(monkeypatch):
+
+    calls=[]
+    def prep_file(file,**kwargs):
+        calls.append(file)
+        if file == 'busy' and calls.count(file) < 3: return (None,'Failed to submit prep job.')
+        if file == 'socket' and calls.count(file) == 1: raise socket.timeout('timed out')
+        if file == 'missing': return (None,'Failed to upload: missing')
+        if file == 'idl': return (None,'Prep failed: % Syntax error.')
+        return ('out_'+file,'')
+    waits=[]
+    monkeypatch.setattr(client,'prep_file',prep_file)
+    monkeypatch.setattr(time,'sleep',waits.append)
+    results=sorted(client.prep_many(['busy','socket','missing','idl','ok'],max_workers=2,retries=2))
+    assert [r[1] for r in results] == ['out_busy',None,None,'out_ok','out_socket']
+    assert dict((f,calls.count(f)) for f in set(calls)) == {'busy':3,'socket':2,'missing':1,'idl':1,'ok':1}
+    assert sorted(waits) == [client.RETRY_WAIT]*2+[2*client.RETRY_WAIT]
+    del calls[:]
+    results=list(client.prep_many(['busy'],max_workers=1,retries=1))
+    assert results == [('busy',None,'Failed to submit prep job.')] and len(calls) == 2
+
+def test_prep_many_workers():
+
+    assert client.prep_many(['a'],max_workers=0) is None
@@ -0,0 +1,76 @@
+
+# Lean execute path (server.execute): reset only after errors, keywords
+# passed via _extra
+
+import pytest
+import client,server
+
+# IDL session that records the statements run, failing those that call
+# message
+
+class IDL(object):
+
+    def __init__(self):
+        self.__dict__['commands']=[]
+
+    def run(self,cmd,stdout=False):
+        self.commands.append(cmd)
+        if cmd.startswith('message,') and cmd != server.RESET.split(' & ')[1]:
+            raise Exception('% '+cmd)
+
+@pytest.fixture
+def idl():
+
+    IDL_=IDL()
+    yield IDL_
+    server.needs_reset.discard(id(IDL_))
+
+def test_reset_after_error(idl):
+
+    assert server.execute(idl,"a=1",'0',{}) == ('','')
+    assert server.RESET not in idl.commands
+    result,error=server.execute(idl,"message,'bad'",'0',{})
+    assert error and id(idl) in server.needs_reset
+    del idl.commands[:]
+    server.execute(idl,"a=2",'0',{})
+    assert idl.commands == [server.RESET,'a=2']
+    del idl.commands[:]
+    server.execute(idl,"a=3",'0',{})
+    assert idl.commands == ['a=3']
+
+def test_not_lean(idl):
+
+    server.execute(idl,"a=1",'0',{'k':1},lean=False)
+    server.execute(idl,"a=2",'0',{},lean=False)
+    assert idl.commands == [server.RESET,'extra=hash2struct(extra_keywords)','help,extra','a=1,_extra=extra',
+                            server.RESET,'a=2']
+
+# RESET is run as one line, so its statements are joined with '&': after
+# ';' IDL would take the rest of the line as a comment
+
+def test_reset_statements():
+
+    assert ';' not in server.RESET
+    assert server.RESET.split(' & ') == ['retall','message,/reset','catch,/cancel']
+
+def test_extra_command():
+
+    assert server.extra_command('result=f(g(x))','1') == 'result=f(g(x),_extra=extra)'
+    assert server.extra_command('result=f(g(x),h(y))','1') == 'result=f(g(x),h(y),_extra=extra)'
+    assert server.extra_command('result=f()','1') == 'result=f(_extra=extra)'
+    assert server.extra_command('result=f( )','1') == 'result=f( _extra=extra)'
+    assert server.extra_command('p,g(x)','0') == 'p,g(x),_extra=extra'
+    assert server.extra_command('result=f','1') == 'result=f'
+    for i in range(server.MAX_TEMPLATES+10): server.extra_command('p%d' % i,'0')
+    assert len(server.templates) == server.MAX_TEMPLATES
+
+###############################################################################
+# an error does not leave the session in a state that affects the next
+# command, and keywords reach the command
+
+def test_execute_after_error(start_server):
+
+    port=start_server(unix_socket=False)
+    results=client.run_batch(["message,'bad'","result='ok'"],port=port)
+    assert results[0][1] and results[1] == ('ok','')
+    assert client.run("result='kw'",port=port,k=1) == 'kw'
@@ -0,0 +1,140 @@
+
+# Cuts of FITS files (fitscut.py), locally and through the server
+
+import os
+import numpy
+import pytest
+import client,fitscut,mux
+
+ROWS=10000
+IMAGE=(numpy.arange(80*100) % 30000).astype('>i2').reshape(80,100)
+EVENTS=numpy.dtype([('TIME','>f8'),('ENERGY','>f4'),('DET','>i2'),('NAME','S8'),('VEC','>f4',(3,))])
+
+def padded(data):
+
+    return data+'\0'*(fitscut.padded(len(data))-len(data))
+
+def cards(*pairs):
+
+    return fitscut.header_bytes([fitscut.format_card(key,value) for key,value in pairs])
+
+def events():
+
+    table=numpy.zeros(ROWS,dtype=EVENTS)
+    table['TIME']=numpy.arange(ROWS)*0.01
+    table['ENERGY']=numpy.arange(ROWS) % 100
+    table['DET']=numpy.arange(ROWS) % 9
+    table['NAME']='ev'
+    table['VEC']=numpy.arange(3*ROWS).reshape(ROWS,3)
+    return table
+
+# image in the primary HDU and an event table in the first extension
+
+@pytest.fixture
+def fits_file(tmp):
+
+    primary=cards(('SIMPLE',True),('BITPIX',16),('NAXIS',2),('NAXIS1',100),('NAXIS2',80),('EXTEND',True),
+                  ('CRPIX1',50.5),('CRPIX2',40.5),('OBJECT',"it's sun"))
+    table=cards(('XTENSION','BINTABLE'),('BITPIX',8),('NAXIS',2),('NAXIS1',EVENTS.itemsize),('NAXIS2',ROWS),
+                ('PCOUNT',0),('GCOUNT',1),('TFIELDS',5),
+                ('TTYPE1','TIME'),('TFORM1','1D'),('TUNIT1','s'),('TTYPE2','ENERGY'),('TFORM2','E'),('TUNIT2','keV'),
+                ('TTYPE3','DET'),('TFORM3','I'),('TTYPE4','NAME'),('TFORM4','8A'),('TTYPE5','VEC'),('TFORM5','3E'),
+                ('EXTNAME','EVENTS'))
+    path=os.path.join(tmp,'src.fits')
+    with open(path,'wb') as f: f.write(primary+padded(IMAGE.tobytes())+table+padded(events().tobytes()))
+    return path
+
+# write cut to path, checking it is whole FITS blocks, and read it back
+
+def write(source,path):
+
+    data=source.read(10**9)
+    assert len(data) == source.size and len(data) % fitscut.BLOCK == 0
+    with open(path,'wb') as f: f.write(data)
+    return fitscut.read_hdus(path)
+
+def test_read_hdus(fits_file):
+
+    hdus=fitscut.read_hdus(fits_file)
+    assert [(hdu.kind,hdu.name()) for hdu in hdus] == [('PRIMARY',''),('BINTABLE','EVENTS')]
+
+def test_image_section(tmp,fits_file):
+
+    array,header=fitscut.array(fits_file,section=[[10,20],[5,15]])
+    assert (array == IMAGE[10:20,5:15]).all()
+    hdus=write(fitscut.cut(fits_file,section=[[10,20],[5,15]]),os.path.join(tmp,'img.fits'))
+    assert hdus[0].axes == [10,10]
+    assert (hdus[0].get('CRPIX1'),hdus[0].get('CRPIX2')) == (45.5,30.5)
+    assert hdus[0].get('OBJECT') == "it's sun"
+    assert (fitscut.array(os.path.join(tmp,'img.fits'))[0] == IMAGE[10:20,5:15]).all()
+
+def test_table_rows_and_columns(tmp,fits_file):
+
+    table=events()
+    array,header=fitscut.array(fits_file,hdu='events',between=['TIME',10.,20.],columns=['energy','VEC'])
+    assert array.dtype.names == ('ENERGY','VEC')
+    assert (array['ENERGY'] == table['ENERGY'][1000:2001]).all()
+    hdus=write(fitscut.cut(fits_file,hdu=1,rows=[100,200],columns=['VEC','TIME']),os.path.join(tmp,'tab.fits'))
+    assert hdus[1].axes[1] == 100
+    assert (hdus[1].get('TTYPE1'),hdus[1].get('TUNIT1'),hdus[1].get('TTYPE2'),hdus[1].get('TFIELDS')) == ('TIME','s','VEC',2)
+    array,header=fitscut.array(os.path.join(tmp,'tab.fits'),hdu=1)
+    assert (array['TIME'] == table['TIME'][100:200]).all()
+    assert (array['VEC'] == table['VEC'][100:200]).all()
+
+@pytest.mark.parametrize('options',[{'hdu':5},{'hdu':'X'},{'columns':['A']},{'hdu':1,'columns':['NOPE']},{'hdu':1,'section':[[0,1]]}])
+def test_bad_cut(fits_file,options):
+
+    with pytest.raises(fitscut.FITSError):
+        fitscut.cut(fits_file,**options)
+
+###############################################################################
+
+def test_server_cuts(tmp,start_server,fits_file):
+
+    table=events()
+    port=start_server()
+    path=client.fits(fits_file,port=port,hdu='EVENTS',rows=[0,5000],outdir=os.path.join(tmp,'out'))
+    array,header=fitscut.array(path,hdu=1)
+    assert len(array) == 5000 and (array['DET'] == table['DET'][:5000]).all()
+    array=client.fits(fits_file,port=port,hdu='EVENTS',between=['TIME',1.,2.],format='array')
+    assert (array == table[100:201]).all()
+    array,header=client.fits(fits_file,port=port,section=[[0,3],[0,4]],format='array',header=True)
+    assert (array == IMAGE[0:3,0:4]).all()
+    assert client.fits(fits_file,port=port,hdu=3) is None
+    assert client.fits(os.path.join(tmp,'missing.fits'),port=port) is None
+
+def test_mux_cuts(tmp,start_server,fits_file):
+
+    port=start_server(unix_socket=False)
+    channel=mux.connect('localhost',port,compress=True)
+    try:
+        path=channel.fits(fits_file,outdir=os.path.join(tmp,'out'),section=[[0,80],[0,100]])
+        assert (fitscut.array(path)[0] == IMAGE).all()
+        array=channel.fits(fits_file,format='array',hdu=1,rows=[-3,None])
+        assert (array['TIME'] == events()['TIME'][-3:]).all()
+        assert channel.fits(fits_file,hdu=9) is None
+    finally:
+        channel.close()
+
+# a slow cut does not hold up other clients
+
+@pytest.mark.parametrize('format',['fits','array'])
+def test_cut_off_loop(tmp,start_server,fits_file,monkeypatch,format):
+
+    import threading,time
+    port=start_server(unix_socket=False)
+    def slow(func):
+        def run(*args,**kwargs):
+            time.sleep(1.)
+            return func(*args,**kwargs)
+        return run
+    for name in ('cut','array'): monkeypatch.setattr(fitscut,name,slow(getattr(fitscut,name)))
+    results=[]
+    thread=threading.Thread(target=lambda: results.append(client.fits(fits_file,port=port,format=format,outdir=tmp,persist=False)))
+    thread.start()
+    time.sleep(0.3)
+    start=time.time()
+    assert client.ping(port=port,persist=False)['ready']
+    assert time.time()-start < 0.5
+    thread.join(10)
+    assert results[0] is not None
@@ -0,0 +1,63 @@
+
+# Server jobs (jobs.py): submit, status, wait and fetch
+
+import os,time
+import client,config
+
+def test_job_lifecycle(start_server):
+
+    port=start_server(unix_socket=False)
+    job=client.submit("wait,1 & result='done'",port=port)
+    assert job
+    assert client.status(job,port=port)['state'] == 'running'
+    assert client.fetch(job,port=port) is None
+    start=time.time()
+    assert client.run("result='free'",port=port) == 'free'
+    assert time.time()-start < 0.5
+    status=client.wait(job,timeout=10,port=port)
+    assert status['state'] == 'done' and status['finished'] >= status['submitted']
+    assert client.fetch(job,port=port) == 'done'
+
+def test_failed_and_batch_jobs(start_server):
+
+    port=start_server(unix_socket=False)
+    job=client.submit("message,'bad'",port=port)
+    status=client.wait(job,timeout=10,port=port)
+    assert status['state'] == 'failed' and status['job_error']
+    job=client.submit(["result='a'","message,'bad'","result='c'"],port=port)
+    assert client.wait(job,timeout=10,port=port)['state'] == 'done'
+    results=client.fetch(job,port=port)
+    assert results[0] == ('a','') and results[1][1] and results[2] == ('c','')
+    assert client.status('nosuchjob',port=port) is None
+
+def test_wait_times_out(start_server):
+
+    port=start_server(unix_socket=False)
+    job=client.submit('wait,2',port=port)
+    start=time.time()
+    assert client.wait(job,timeout=0.3,port=port) is None
+    assert time.time()-start < 1.5
+    assert client.wait(job,timeout=10,port=port)['state'] == 'done'
+
+def test_job_outputs(tmp,start_server,make_file):
+
+    port=start_server(unix_socket=False)
+    name=make_file('in.fits',1000)
+    outdir=os.path.join(tmp,'out')
+    os.mkdir(outdir)
+    job=client.submit('prep_file,"%s",out_dir="%s"' % (name,outdir),job_dir=outdir,port=port)
+    status=client.wait(job,timeout=10,port=port)
+    assert status['outputs'] == [os.path.join(outdir,'prepped_in.fits')]
+
+###############################################################################
+# without worker processes jobs get a worker of their own by default, as
+# the server's single IDL thread would be held for as long as a job runs
+
+def test_job_workers_default(start_server):
+
+    port=start_server(unix_socket=False)
+    jobs=config.servers[port].jobs
+    assert jobs.size == 1 and jobs.shared is None
+    for options in ({'workers':2},{'job_workers':0}):
+        port=start_server(unix_socket=False,**options)
+        assert config.servers[port].jobs.shared is config.servers[port].executor
@@ -0,0 +1,115 @@
+
+# Server limits (server.LIMITS): connections refused when the server is
+# full, oversized frames and uploads, and clients that stall
+
+import json,socket,struct,time
+import pytest
+import balance,client,pool,tools
+
+@pytest.fixture
+def opened():
+
+    socks=[]
+    yield socks
+    for sock in socks: sock.close()
+
+def connect(port,opened):
+
+    sock=socket.create_connection(('localhost',port),5)
+    opened.append(sock)
+    return sock
+
+# True if the server closes sock within timeout seconds
+
+def closed(sock,timeout=5):
+
+    sock.settimeout(timeout)
+    try:
+        return sock.recv(100) == ''
+    except socket.timeout:
+        return False
+    except socket.error:
+        return True
+
+def test_refusal():
+
+    assert tools.refusal(json.dumps({'action':'busy','error':'Server busy. Try again later.'})) == 'Server busy. Try again later.'
+    reason='Too many connections from '+'x'*100+'.'
+    assert tools.refusal(json.dumps({'error':reason,'action':'busy'})) == reason
+    assert tools.refusal(json.dumps({'action':'execute','result':'"busy"','error':''})) == ''
+    assert tools.refusal('["busy"]') == ''
+    assert tools.refusal('"busy" but not JSON') == ''
+    assert tools.refusal('') == '' and tools.refusal(None) == ''
+
+###############################################################################
+
+@pytest.mark.parametrize('limit,reason',[('max_connections','Server busy. Try again later.'),
+                                         ('max_per_client','Too many connections from 127.0.0.1.')])
+def test_connections_refused(start_server,opened,limit,reason):
+
+    port=start_server(unix_socket=False,**{limit:2})
+    pool.clear()
+    time.sleep(0.2)
+    for i in range(2): connect(port,opened)
+    time.sleep(0.2)
+    sock=connect(port,opened)
+    assert tools.refusal(tools.recv_data(sock)) == reason
+    assert closed(sock)
+    opened.pop(0).close()
+    time.sleep(0.2)
+    assert client.run("result='ok'",port=port,persist=False) == 'ok'
+
+# a client refused by a full server takes it out of use for a while, so
+# other servers are tried first
+
+def test_client_marks_full_server_down(start_server,opened,monkeypatch):
+
+    monkeypatch.setattr(balance,'health',{})
+    port=start_server(max_connections=1,unix_socket=False)
+    pool.clear()
+    time.sleep(0.2)
+    connect(port,opened)
+    time.sleep(0.2)
+    assert client.run("result='ok'",port=port) is None
+    assert balance.is_down(('localhost',port))
+    other=start_server(unix_socket=False)
+    servers=['localhost:%d' % port,'localhost:%d' % other]
+    assert client.run("result='ok'",servers=servers) == 'ok'
+
+###############################################################################
+
+def test_max_frame(start_server,opened):
+
+    port=start_server(max_frame=1048576,unix_socket=False)
+    sock=connect(port,opened)
+    sock.sendall(struct.pack('!I',2*1048576)+'{')
+    assert closed(sock)
+    sock=connect(port,opened)
+    tools.send_data(sock,json.dumps({'action':'ping','x':'.'*100000}))
+    assert json.loads(tools.recv_data(sock))['action'] == 'ping'
+
+def test_max_upload(start_server,make_file):
+
+    port=start_server(max_upload=1000000,unix_socket=False)
+    small=make_file('small.dat',1000000)
+    big=make_file('big.dat',1000001)
+    assert client.upload(small,port=port,cache=False)
+    assert client.upload(big,port=port,cache=False) is None
+    assert client.upload(big,port=port) is None
+    assert client.run("result='ok'",port=port) == 'ok'
+
+# a client that stops partway through a request is disconnected; one that
+# is idle between requests is not
+
+def test_stall_timeout(start_server,opened):
+
+    port=start_server(stall_timeout=0.5,unix_socket=False)
+    idle=connect(port,opened)
+    stalled=connect(port,opened)
+    data=json.dumps({'action':'ping'})
+    stalled.sendall(struct.pack('!I',len(data))+data[:5])
+    start=time.time()
+    assert closed(stalled)
+    assert time.time()-start < 3
+    tools.send_data(idle,data)
+    assert json.loads(tools.recv_data(idle))['action'] == 'ping'
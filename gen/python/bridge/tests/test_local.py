@@ -0,0 +1,134 @@
+
+# Local transport (tools.connect): Unix socket, files passed by path and
+# arrays in shared memory
+
+import os
+import pytest
+import client,mux,tools
+
+def test_private_socket(start_server):
+
+    port=start_server()
+    assert tools.local_server(port)
+    assert os.stat(tools.local_dir()).st_mode & 0o777 == 0o700
+    sock=tools.connect('localhost',port)
+    try:
+        assert tools.is_unix(sock)
+    finally:
+        sock.close()
+    tcp=start_server(unix_socket=False)
+    assert not os.path.exists(tools.local_path(tcp))
+
+def test_files_by_path(tmp,start_server,make_file):
+
+    port=start_server()
+    name=make_file('in.dat',3*1048576)
+    location=client.upload(name,port=port,cache=False)
+    assert os.stat(location).st_ino == os.stat(name).st_ino
+    path=client.download(location,port=port,outdir=os.path.join(tmp,'out'))
+    assert open(path,'rb').read() == open(name,'rb').read()
+    channel=mux.connect('localhost',port)
+    try:
+        assert tools.is_unix(channel.sock)
+        location=channel.upload(name)
+        assert os.stat(location).st_ino == os.stat(name).st_ino
+        path=channel.download(location,outdir=os.path.join(tmp,'mux'))
+        assert os.path.getsize(path) == os.path.getsize(name)
+    finally:
+        channel.close()
+
+def test_arrays_in_shared_memory(start_server,monkeypatch):
+
+    port=start_server()
+    map_shm=tools.map_shm
+    mapped=[]
+    def counted(path):
+        mapped.append(path)
+        return map_shm(path)
+    monkeypatch.setattr(tools,'map_shm',counted)
+    array=client.run('result=fake_array(1048576)',port=port)
+    assert len(array) == 1048576 and array[-1] == 1048575.
+    results=client.run_batch(["result=fake_array(100000)","result='x'","result=fake_array(3)"],port=port)
+    assert len(results[0][0]) == 100000
+    assert results[1] == ('x','')
+    assert list(results[2][0]) == [0.,1.,2.]
+    assert len(mapped) == 2
+    assert not [path for path in mapped if os.path.exists(path)]
+
+# files are only taken by path over the Unix socket
+
+def test_link_refused_over_tcp(start_server,make_file):
+
+    port=start_server(unix_socket=False)
+    name=make_file('in.dat',100)
+    tdict=client.call({'action':'link','filename':name},port=port)
+    assert tdict['error'] == 'Not a local connection.'
+
+###############################################################################
+# the socket directory must be private to the user
+
+def test_open_directory_not_used(start_server):
+
+    port=start_server()
+    os.chmod(tools.local_dir(),0o777)
+    try:
+        assert not tools.local_server(port)
+        sock=tools.connect('localhost',port)
+        assert not tools.is_unix(sock)
+        sock.close()
+    finally:
+        os.chmod(tools.local_dir(),0o700)
+
+def test_server_on_open_directory(start_server):
+
+    os.mkdir(tools.local_dir(),0o755)
+    os.chmod(tools.local_dir(),0o755)
+    port=start_server()
+    assert not os.path.exists(tools.local_path(port))
+    assert client.run("result='ok'",port=port) == 'ok'
+
+def test_shared_memory_files_only(tmp):
+
+    name=os.path.join(tmp,'victim')
+    with open(name,'w') as f: f.write('keep')
+    with pytest.raises(ValueError):
+        tools.map_shm(name)
+    assert os.path.exists(name)
+    path=tools.write_shm('abc')
+    assert len(tools.map_shm(path)) == 3
+    assert not os.path.exists(path)
+
+def test_handed_file_checked(tmp,make_file):
+
+    name=make_file('in.dat',100)
+    path,error=tools.link_file(name,'/data/other.fits',outdir=os.path.join(tmp,'out'))
+    assert path is None and error.startswith('Server gave wrong file')
+    path,error=tools.link_file(name,name,outdir=os.path.join(tmp,'out'))
+    assert error == '' and open(path,'rb').read() == open(name,'rb').read()
+
+# a file on another file system is copied, without holding up other
+# clients while it is
+
+def test_link_copies_off_loop(start_server,make_file,monkeypatch):
+
+    import errno,shutil,threading,time
+    port=start_server()
+    name=make_file('in.dat',1048576)
+    def link(src,dst):
+        raise OSError(errno.EXDEV,'Invalid cross-device link')
+    copyfile=shutil.copyfile
+    def slow(src,dst):
+        time.sleep(1.)
+        copyfile(src,dst)
+    monkeypatch.setattr(os,'link',link)
+    monkeypatch.setattr(shutil,'copyfile',slow)
+    locations=[]
+    thread=threading.Thread(target=lambda: locations.append(client.upload(name,port=port,cache=False,persist=False)))
+    thread.start()
+    time.sleep(0.3)
+    start=time.time()
+    assert client.ping(port=port,persist=False)['ready']
+    assert time.time()-start < 0.5
+    thread.join(10)
+    assert os.stat(locations[0]).st_ino != os.stat(name).st_ino
+    assert open(locations[0],'rb').read() == open(name,'rb').read()
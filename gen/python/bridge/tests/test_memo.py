@@ -0,0 +1,97 @@
+
+# Result cache for idempotent commands (memo.py)
+
+import os,threading,time
+import pytest
+import client,memo
+
+def test_hits_and_lru():
+
+    cache=memo.MemoCache(max_entries=2)
+    assert cache.get('a') is memo.MISSING
+    cache.put('a',1)
+    cache.put('b',2)
+    assert cache.get('a') == 1
+    cache.put('c',3)
+    assert cache.get('b') is memo.MISSING
+    assert (cache.get('a'),cache.get('c')) == (1,3)
+    assert (cache.hits,cache.misses) == (3,2)
+
+def test_ttl_expiry():
+
+    cache=memo.MemoCache(ttl=0.1)
+    cache.put('a',1)
+    assert cache.get('a') == 1
+    time.sleep(0.2)
+    assert cache.get('a') is memo.MISSING
+
+def test_cacheable_and_keys():
+
+    cache=memo.MemoCache()
+    assert cache.cacheable('result=pyidl_path("x")')
+    assert not cache.cacheable('result=my_config()')
+    assert cache.cacheable('result=my_config()',idempotent=True)
+    assert not memo.MemoCache(max_entries=0).cacheable('result=x',idempotent=True)
+    assert memo.key('f',1,{'a':1,'b':2}) == memo.key('f','1',{'b':2,'a':1})
+    assert memo.key('f',0,None) == memo.key('f','0',{})
+    assert memo.key('f',0,{}) != memo.key('f',1,{})
+
+# the cache is cleared when the registered programs directory changes
+
+def test_registered_change(tmp,monkeypatch):
+
+    rdir=os.path.join(tmp,'registered')
+    os.mkdir(rdir)
+    monkeypatch.setenv('PYIDL_REGISTERED',rdir)
+    monkeypatch.setattr(memo,'CHECK_INTERVAL',0.)
+    cache=memo.MemoCache(watch=memo.registered_dir())
+    cache.put('a',1)
+    assert cache.get('a') == 1
+    with open(os.path.join(rdir,'new.pro'),'w') as f: f.write('pro new\nend\n')
+    assert cache.get('a') is memo.MISSING
+    cache.put('a',2)
+    assert cache.get('a') == 2
+
+def test_threads():
+
+    cache=memo.MemoCache(max_entries=10)
+    errors=[]
+    def work(n):
+        try:
+            for i in range(5000):
+                cache.put((n,i%20),i)
+                cache.get((n,(i+7)%20))
+        except Exception as e:
+            errors.append(e)
+    threads=[threading.Thread(target=work,args=(n,)) for n in range(8)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert errors == [] and len(cache.entries) == 10
+
+###############################################################################
+# results are kept by the client, and by the server for other clients
+
+@pytest.fixture
+def client_cache(monkeypatch):
+
+    cache=memo.MemoCache(max_entries=256,ttl=60.)
+    monkeypatch.setattr(memo,'client_cache',cache)
+    return cache
+
+def test_cached_results(start_server,client_cache):
+
+    port=start_server(unix_socket=False)
+    cmd='result=pyidl_path("x")'
+    path=client.run(cmd,is_function=1,port=port)
+    assert path.endswith('x.pro')
+    assert client.run(cmd,is_function=1,port=port) == path
+    assert client_cache.hits == 1
+    client_cache.clear()
+    assert client.run(cmd,is_function=1,port=port) == path
+    gauges=client.stats(port=port)['gauges']
+    assert (gauges['memo_hits'],gauges['memo_misses']) == (1,1)
+    client.run("v='a'",port=port)
+    client.run('result=v',is_function=1,port=port,idempotent=True)
+    client.run("v='b'",port=port)
+    assert client.run('result=v',is_function=1,port=port,idempotent=True) == 'a'
+    assert client.run('result=v',is_function=1,port=port) == 'b'
@@ -0,0 +1,67 @@
+
+# Server metrics (metrics.py) and the stats action
+
+import json,os,time
+import client,metrics
+
+def test_histogram():
+
+    hist=metrics.Histogram()
+    assert hist.quantile(.5) is None
+    for value in [0.002]*80+[0.2]*19+[100.]: hist.observe(value)
+    assert hist.quantile(.5) == 0.0025
+    assert hist.quantile(.9) == 0.25
+    assert hist.quantile(1.) == 100.
+    snap=hist.snapshot()
+    assert snap['count'] == 100 and snap['min'] == 0.002 and snap['max'] == 100.
+    assert snap['buckets'] == [['0.0025',80],['0.25',19],['300.0',1]]
+
+def test_registry():
+
+    registry=metrics.Metrics()
+    registry.request('execute',0.01,bytes_in=10,bytes_out=20)
+    registry.request('execute',0.03,error=True,bytes_in=5)
+    registry.observe('idl',0.02)
+    registry.count('connections')
+    stats=registry.snapshot({'sessions':1})
+    execute=stats['actions']['execute']
+    assert (execute['count'],execute['errors'],execute['error_rate']) == (2,1,0.5)
+    assert (execute['bytes_in'],execute['bytes_out']) == (15,20)
+    assert stats['timers']['idl']['count'] == 1
+    assert stats['counters'] == {'connections':1,'bytes_in':15,'bytes_out':20}
+    text=metrics.report(stats)
+    assert 'execute' in text and 'idl' in text and 'sessions=1' in text
+    registry.reset()
+    assert registry.snapshot()['actions'] == {}
+
+###############################################################################
+# counts, latencies and gauges from a server
+
+def test_stats(start_server):
+
+    port=start_server(delay=0.05,unix_socket=False)
+    client.stats(port=port,reset=True)
+    for i in range(3): client.run("result='x'",port=port)
+    client.run("message,'bad'",port=port)
+    client.run('result=fake_array(1000)',port=port)
+    stats=client.stats(port=port)
+    execute=stats['actions']['execute']
+    assert execute['count'] == 5 and execute['errors'] == 1
+    assert execute['bytes_out'] >= 4000
+    assert 0.05 <= execute['latency']['p50'] <= 0.25
+    assert stats['timers']['idl']['count'] == 5
+    assert 'queue' in stats['timers']
+    assert stats['gauges']['sessions'] == stats['gauges']['total'] == 1
+    assert stats['gauges']['connections'] >= 1
+    assert client.stats(port=port,reset=True)['actions']['execute']['count'] == 5
+    assert 'execute' not in client.stats(port=port)['actions']
+
+def test_stats_file(tmp,start_server):
+
+    name=os.path.join(tmp,'stats.json')
+    port=start_server(stats_file=name,stats_interval=0.2,unix_socket=False)
+    client.run("result='x'",port=port)
+    time.sleep(0.5)
+    with open(name) as f: stats=json.load(f)
+    assert stats['actions']['execute']['count'] >= 1
+    assert 'gauges' in stats
@@ -0,0 +1,135 @@
+
+# Multiplexed connections (mux.py, protocol version 2)
+
+import os,socket,threading,time
+import pytest
+import mux,tools
+
+@pytest.fixture
+def channel(start_server):
+
+    port=start_server(unix_socket=False)
+    channel=mux.connect('localhost',port)
+    yield channel
+    channel.close()
+
+def test_results_matched_across_threads(channel):
+
+    results={}
+    def work(n):
+        for i in range(20):
+            value=channel.run("result='t%d_%d'" % (n,i))
+            results[(n,i)]=value
+            array=channel.run('result=fake_array(%d)' % (1000*n+i+1))
+            assert len(array) == 1000*n+i+1
+    threads=[threading.Thread(target=work,args=(n,)) for n in range(8)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert len(results) == 160
+    assert all(value == 't%d_%d' % key for key,value in results.items())
+
+# a request answered by the server itself is not held up by a slow IDL
+# command sent before it on the same connection
+
+def test_responses_out_of_order(channel):
+
+    slow=channel.begin({'action':'execute','command':'wait,1','is_function':0,'keywords':{}})
+    start=time.time()
+    assert channel.ping()['ready'] is not None
+    assert time.time()-start < 0.5
+    assert not slow.event.is_set()
+    slow.event.wait(10)
+    assert slow.header['error'] == ''
+
+def test_batch_and_errors(channel):
+
+    results=channel.run_batch(["result=fake_array(100000)","result='x'","message,'bad'","result=fake_array(3)"])
+    assert len(results[0][0]) == 100000
+    assert results[1] == ('x','')
+    assert results[2][1]
+    assert list(results[3][0]) == [0.,1.,2.]
+    assert channel.run("message,'boom'") is None
+    assert channel.run("result='after'") == 'after'
+
+# a call that times out is dropped; its late response does not reach the
+# next call
+
+def test_timeout(channel):
+
+    call=channel.call({'action':'execute','command':"wait,1 & result='late'",'is_function':0,'keywords':{}},timeout=0.2)
+    assert call.error == 'Timed out.'
+    assert channel.calls == {}
+    assert channel.run("result='next'") == 'next'
+
+def test_files(tmp,channel,make_file):
+
+    name=make_file('in.dat',3*1048576+17)
+    location=channel.upload(name)
+    path=channel.download(location,outdir=os.path.join(tmp,'out'))
+    assert open(path,'rb').read() == open(name,'rb').read()
+    assert channel.download('/nonexistent',outdir=tmp) is None
+    assert not [n for n in os.listdir(tmp) if n.endswith('.part')]
+
+def test_no_server():
+
+    assert mux.connect('localhost',1) is None
+
+# calls in flight when the channel closes fail, as do later ones
+
+def test_closed_channel(start_server):
+
+    port=start_server(unix_socket=False)
+    channel=mux.connect('localhost',port)
+    slow=channel.begin({'action':'execute','command':'wait,5','is_function':0,'keywords':{}})
+    channel.close()
+    assert slow.event.wait(10)
+    assert slow.error
+    assert channel.run("result='x'") is None
+
+###############################################################################
+# responses the reader cannot handle fail their own call; the reader goes
+# on, and calls left when it stops fail
+
+def execute(command):
+
+    return {'action':'execute','command':command,'is_function':0,'keywords':{}}
+
+@pytest.fixture
+def pair():
+
+    a,b=socket.socketpair()
+    channel=mux.Channel(a)
+    yield channel,b
+    channel.close()
+    b.close()
+
+def test_bad_response(pair):
+
+    channel,server=pair
+    calls=[channel.begin(execute("result='%d'" % i)) for i in range(4)]
+    server.sendall(tools.pack_frame(1,tools.HEADER,'{not json'))
+    server.sendall(tools.pack_frame(2,tools.HEADER,'{"action":"download","error":""}'))
+    server.sendall(tools.pack_frame(3,tools.HEADER,'{"action":"execute","result":"2","error":""}'))
+    for call in calls[:3]: assert call.event.wait(5)
+    assert calls[0].error and calls[1].error == "'size'"
+    assert calls[2].error == '' and channel.result(calls[2].header,calls[2].payloads) == '2'
+    assert not channel.closed and not calls[3].event.is_set()
+    server.shutdown(socket.SHUT_RDWR)
+    assert calls[3].event.wait(5) and calls[3].error == 'Server not responding.'
+    assert channel.closed
+
+def test_reader_fails(monkeypatch):
+
+    def read_frame(sock,codec=None):
+        time.sleep(0.2)
+        raise RuntimeError('bug')
+    monkeypatch.setattr(tools,'read_frame',read_frame)
+    a,b=socket.socketpair()
+    channel=mux.Channel(a)
+    try:
+        call=channel.begin(execute("result='x'"))
+        assert call.event.wait(5) and call.error == 'Server not responding.'
+        assert channel.closed
+    finally:
+        channel.close()
+        b.close()
@@ -0,0 +1,119 @@
+
+# Server event loop (reactor.py) and stopping the server
+
+import socket,threading,time
+import pytest
+import reactor
+
+# loop using poll(), or select() as where poll is not available
+
+@pytest.fixture(params=['poll','select'])
+def loop(request):
+
+    loop=reactor.Reactor()
+    if request.param == 'select': loop.poller.poll_obj=None
+    yield loop
+    loop.close()
+
+def run(loop):
+
+    thread=threading.Thread(target=loop.run)
+    thread.daemon=True
+    thread.start()
+    return thread
+
+def test_timers_in_order(loop):
+
+    fired=[]
+    loop.call_later(0.2,fired.append,3)
+    loop.call_later(0.05,fired.append,1)
+    loop.call_later(0.1,fired.append,2)
+    loop.call_later(0.3,loop.stop)
+    start=time.time()
+    loop.run()
+    assert fired == [1,2,3]
+    assert 0.25 < time.time()-start < 1.
+
+# callbacks from other threads run on the loop's thread, at once
+
+def test_call_soon_threadsafe(loop):
+
+    thread=run(loop)
+    time.sleep(0.1)
+    ran=[]
+    done=threading.Event()
+    def callback(value):
+        ran.append((value,threading.current_thread()))
+        done.set()
+    start=time.time()
+    loop.call_soon_threadsafe(callback,'x')
+    assert done.wait(2) and time.time()-start < 0.5
+    assert ran == [('x',thread)]
+    loop.stop()
+    thread.join(2)
+
+def test_stop_wakes_loop(loop):
+
+    thread=run(loop)
+    time.sleep(0.1)
+    start=time.time()
+    loop.stop()
+    thread.join(2)
+    assert not thread.is_alive()
+    assert time.time()-start < 0.5
+
+class Handler(object):
+
+    def __init__(self,sock):
+        self.sock=sock
+        self.data=[]
+        self.writable=0
+
+    def on_readable(self):
+        self.data.append(self.sock.recv(100))
+
+    def on_writable(self):
+        self.writable += 1
+
+def test_handlers(loop):
+
+    a,b=socket.socketpair()
+    handler=Handler(a)
+    loop.register(a,handler,read=True,write=True)
+    loop.call_later(0.05,loop.modify,a,True,False)
+    loop.call_later(0.1,b.send,'ping')
+    loop.call_later(0.2,loop.stop)
+    loop.run()
+    assert handler.data == ['ping']
+    assert handler.writable >= 1
+    writable=handler.writable
+    loop.unregister(a)
+    b.send('more')
+    loop.call_later(0.1,loop.stop)
+    loop.run()
+    assert handler.data == ['ping'] and handler.writable == writable
+    a.close()
+    b.close()
+
+def test_wake_pair_without_socketpair(monkeypatch):
+
+    monkeypatch.delattr(socket,'socketpair')
+    r,w=reactor.wake_pair()
+    w.send('x')
+    time.sleep(0.05)
+    assert r.recv(10) == 'x'
+    r.close()
+    w.close()
+
+###############################################################################
+
+def test_server_stop(tmp):
+
+    import bench,server
+    port,thread=bench.start_server(unix_socket=False)
+    server.stop(port)
+    thread.join(10)
+    assert not thread.is_alive()
+    with pytest.raises(socket.error):
+        socket.create_connection(('localhost',port),2)
+    server.stop(port)
@@ -0,0 +1,97 @@
+
+# Scratch space (scratch.py): session quotas and collection
+
+import os,time
+import client,scratch
+
+def fill(path,n):
+
+    with open(os.path.join(path,'data'),'wb') as f: f.write('\0'*n)
+
+def test_reserve(tmp):
+
+    store=scratch.ScratchStore(os.path.join(tmp,'scratch'),max_bytes=1000,session_bytes=600)
+    assert store.reserve(601).startswith('File exceeds session quota')
+    assert store.reserve(600) == ''
+    fill(store.new_session(),600)
+    assert store.reserve(300) == ''
+    fill(store.new_session(),300)
+    assert store.reserve(200) == 'Server scratch space full. Try again later.'
+    assert store.total == 900
+    assert store.reserve(100) == ''
+
+# with no collector running, a reservation that does not fit collects at
+# once, removing expired sessions but not held ones
+
+def test_collect(tmp,monkeypatch):
+
+    monkeypatch.setattr(scratch,'MIN_AGE',-1.)
+    store=scratch.ScratchStore(os.path.join(tmp,'scratch'),max_bytes=1000,ttl=0.)
+    old=store.new_session('prep')
+    held=store.new_session()
+    fill(old,400)
+    fill(held,400)
+    store.hold(held)
+    store.collect()
+    assert not os.path.exists(old)
+    assert os.path.exists(held)
+    assert store.total == 400
+    assert store.reserve(600) == ''
+    store.release(held)
+    assert store.reserve(400) == ''
+    assert not os.path.exists(held)
+
+def test_upload_quotas(tmp,start_server,make_file):
+
+    port=start_server(scratch_dir=os.path.join(tmp,'scratch'),scratch_size=4*1048576,session_size=2*1048576,cache_size=0,unix_socket=False)
+    big=make_file('big.dat',3*1048576)
+    assert client.upload(big,port=port,cache=False) is None
+    name=make_file('in.dat',1500000)
+    locations=[client.upload(name,port=port,cache=False) for i in range(3)]
+    assert [bool(location) for location in locations] == [True,True,False]
+    assert open(locations[0],'rb').read() == open(name,'rb').read()
+
+# sessions quoted in a command are held while it runs
+
+def test_hold_job(tmp):
+
+    store=scratch.ScratchStore(os.path.join(tmp,'scratch'),max_bytes=1000)
+    infile=os.path.join(store.new_session(),'in.fits')
+    outdir=store.new_session('prep')
+    job={'action':'execute','command':'prep_file,"%s",out_dir=\'%s\',err=err' % (infile,outdir)}
+    held=store.hold_job(job)
+    assert held == [os.path.dirname(infile),outdir]
+    assert set(store.held) == set(held)
+    for session in held: store.release(session)
+    assert store.held == {}
+    batch={'action':'batch','commands':[{'command':"a='/elsewhere'"},{'command':"b='%s/x'" % outdir}]}
+    assert store.hold_job(batch) == [outdir]
+
+def test_prep_holds_sessions(tmp,start_server,make_file):
+
+    import config,mux
+    port=start_server(scratch_dir=os.path.join(tmp,'scratch'),unix_socket=False)
+    space=config.servers[port].scratch
+    name=make_file('in.fits',1000)
+    for thread in (False,True):
+        outdir=os.path.join(tmp,'out%d' % thread)
+        os.mkdir(outdir)
+        assert client.prep_file(name,outdir=outdir,thread=thread,port=port) == (os.path.join(outdir,'prepped_in.fits'),'')
+    assert len(space.held) == 1       # the prep job's directory
+    before=dict(space.held)
+    session=space.new_session('prep')
+    running=dict(before,**{session:1})
+    channel=mux.connect('localhost',port)
+    try:
+        call=channel.begin({'action':'execute','command':"wait,0.5 & a='%s'" % session,'is_function':0,'keywords':{}})
+        time.sleep(0.2)
+        assert space.held == running
+        assert call.event.wait(10)
+        assert space.held == before
+        job=client.submit("wait,0.5 & a='%s'" % session,port=port)
+        time.sleep(0.2)
+        assert space.held == running
+        client.wait(job,timeout=10,port=port)
+        assert space.held == before
+    finally:
+        channel.close()
@@ -0,0 +1,102 @@
+
+# Server startup: readiness reported by ping while IDL sessions start, and
+# warm start from saved SSW state (bridge.py)
+
+import os,re,socket,sys,time,types
+import pytest
+import bridge,client,config,server
+
+def test_ping_before_ready(tmp):
+
+    sock=socket.socket()
+    sock.bind(('localhost',0))
+    port=sock.getsockname()[1]
+    sock.close()
+    thread=server.start(port=port,unix_socket=False,backend='fakeidl',backend_options={'startup_time':1.})
+    tstart=time.time()
+    while port not in config.servers and time.time()-tstart < 10: time.sleep(0.01)
+    try:
+        status=client.ping(port=port)
+        assert status['ready'] is False and status['startup'] is None
+        assert [phase for phase,secs in status['timings']['server']] == ['bind','executor']
+        result=client.run("result='ok'",port=port,timeout=30)
+        assert result == 'ok'
+        status=client.ping(wait=10,port=port)
+        assert status['ready'] and status['sessions'] == status['total'] == 1
+        assert status['startup'] >= 1.
+        assert status['timings']['idl'][-1][0] == 'total'
+    finally:
+        server.stop(port)
+        thread.join(30)
+
+###############################################################################
+# stand-in for IDL's Python bridge (idlpy) that records commands, sets the
+# session's environment as ssw_load would and writes save files
+
+class IDL(object):
+
+    commands=[]
+    env={}
+
+    @classmethod
+    def run(cls,cmd):
+        cls.commands.append(cmd)
+        if cmd == 'ssw_load': cls.env['SSW_LOADED']='yes'
+        elif cmd == 'ssw_env=getenv(/environment)':
+            env=dict(os.environ,**cls.env)
+            cls.ssw_env=['%s=%s' % item for item in env.items()]
+        else:
+            match=re.match(r"^save,.*file='(.*)'$",cmd)
+            if match: open(match.group(1),'wb').close()
+
+@pytest.fixture
+def idl(tmp,monkeypatch):
+
+    for path in ('idl/lib/bridges','ssw/gen/idl/ssw_system'):
+        os.makedirs(os.path.join(tmp,path))
+    monkeypatch.setenv('IDL_DIR',os.path.join(tmp,'idl'))
+    monkeypatch.setenv('SSW',os.path.join(tmp,'ssw'))
+    monkeypatch.setenv('SSW_INSTR','hessi')
+    monkeypatch.setenv('IDL_STARTUP','')
+    module=types.ModuleType('idlpy')
+    module.IDL=IDL
+    monkeypatch.setitem(sys.modules,'idlpy',module)
+    monkeypatch.setattr(IDL,'commands',[])
+    monkeypatch.setattr(IDL,'env',{})
+    monkeypatch.chdir(tmp)
+    return os.path.join(tmp,'state','ssw_state')
+
+def phases():
+
+    return [phase for phase,secs in bridge.timings]
+
+def test_warm_start(idl):
+
+    bridge.startup(warm=True,state_file=idl)
+    assert 'ssw_load' in IDL.commands and phases()[-2:] == ['save','total']
+    assert os.stat(os.path.dirname(idl)).st_mode & 0o777 == 0o700
+    for name in bridge.state_files(idl): assert os.stat(name).st_mode & 0o777 == 0o600
+    assert bridge.load_state(idl,os.environ['SSW'],'hessi','')['env'] == ['SSW_LOADED=yes']
+    del IDL.commands[:]
+    bridge.startup(warm=True,state_file=idl)
+    assert 'ssw_load' not in IDL.commands and 'restore' in phases()
+    assert IDL.ssw_env == ['SSW_LOADED=yes']
+    assert "restore,'"+idl+".sav'" in IDL.commands
+
+# saved state is not used for another setup, once stale, or if others
+# could have written it
+
+def test_state_checked(idl,monkeypatch):
+
+    bridge.startup(warm=True,state_file=idl)
+    ssw=os.environ['SSW']
+    assert bridge.load_state(idl,ssw,'hessi','')
+    assert bridge.load_state(idl,ssw,'eit','') is None
+    monkeypatch.setattr(bridge,'STATE_TTL',-1)
+    assert bridge.load_state(idl,ssw,'hessi','') is None
+    monkeypatch.setattr(bridge,'STATE_TTL',86400)
+    os.chmod(os.path.dirname(idl),0o777)
+    assert bridge.load_state(idl,ssw,'hessi','') is None
+    os.chmod(os.path.dirname(idl),0o700)
+    os.chmod(idl+'.json',0o666)
+    assert bridge.load_state(idl,ssw,'hessi','') is None
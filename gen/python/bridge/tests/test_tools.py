@@ -0,0 +1,94 @@
+
+# Compressed transfers (tools.py): negotiated codecs and the limit on
+# decompressed frame size
+
+import bz2,json,socket,struct,zlib
+import pytest
+import client,mux,pool,tools
+
+COMPRESSORS={'zlib':lambda data: zlib.compress(data,9),'bz2':bz2.compress}
+
+@pytest.mark.parametrize('codec',tools.CODECS)
+def test_compress_round_trip(codec):
+
+    data='text line\n'*100000
+    packed=tools.compress(codec,data)
+    assert len(packed) < len(data)
+    assert tools.decompress(codec,packed) == data
+    assert tools.decompress(codec,packed,len(data)) == data
+
+@pytest.mark.parametrize('codec',tools.CODECS)
+def test_decompress_limit(codec):
+
+    bomb=COMPRESSORS[codec]('\0'*(64*1048576))
+    with pytest.raises(ValueError):
+        tools.decompress(codec,bomb,1048576)
+
+def test_negotiated_codec(start_server):
+
+    port=start_server(unix_socket=False)
+    sock=tools.connect('localhost',port)
+    try:
+        assert tools.negotiate(sock) == tools.CODECS[0]
+    finally:
+        sock.close()
+    sock=tools.connect('localhost',port)
+    try:
+        assert tools.negotiate(sock,codecs=['lzma']) == ''
+    finally:
+        sock.close()
+
+def test_compressed_results(start_server,make_file):
+
+    port=start_server(unix_socket=False)
+    pool.clear()
+    text=client.run('result=fake_string(3000000)',port=port,compress=True)
+    assert len(text) == 3000000
+    array=client.run('result=fake_array(1000000)',port=port,compress=True)
+    assert len(array) == 1000000 and array[-1] == 999999.
+    assert set(pool.default.codecs.values()) == set([tools.CODECS[0]])
+    name=make_file('in.dat',1000000)
+    location=client.upload(name,port=port,compress=True,cache=False)
+    assert open(location,'rb').read() == open(name,'rb').read()
+
+###############################################################################
+# a frame that inflates past the server's max_frame closes the connection,
+# and the server goes on serving others
+
+def hello(port,codec,version=None):
+
+    sock=socket.create_connection(('localhost',port))
+    tdict={'action':'hello','codecs':[codec]}
+    if version: tdict['version']=version
+    tools.send_data(sock,json.dumps(tdict))
+    assert json.loads(tools.recv_data(sock))['codec'] == codec
+    sock.settimeout(10)
+    return sock
+
+def closed(sock):
+
+    try:
+        return sock.recv(100) == ''
+    except socket.error:
+        return True
+    finally:
+        sock.close()
+
+@pytest.mark.parametrize('codec',tools.CODECS)
+def test_server_rejects_bomb(start_server,codec):
+
+    port=start_server(max_frame=1048576,unix_socket=False)
+    bomb=COMPRESSORS[codec]('{"action":"ping","x":"'+' '*(64*1048576)+'"}')
+    assert len(bomb) < 1048576
+    sock=hello(port,codec)
+    sock.sendall(struct.pack('!I',len(bomb)|tools.COMPRESSED)+bomb)
+    assert closed(sock)
+    sock=hello(port,codec,version=2)
+    sock.sendall(struct.pack('!IIB',len(bomb)|tools.COMPRESSED,1,tools.HEADER)+bomb)
+    assert closed(sock)
+    assert client.run("result='ok'",port=port) == 'ok'
+    channel=mux.connect('localhost',port,compress=True)
+    try:
+        assert len(channel.run('result=fake_string(3000000)')) == 3000000
+    finally:
+        channel.close()
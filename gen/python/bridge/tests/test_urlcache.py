@@ -0,0 +1,133 @@
+
+# URL cache (urlcache.py) against a local HTTP server
+
+import os,threading
+import BaseHTTPServer
+import pytest
+import urlcache
+
+BODY='SIMPLE  =                    T'*100
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+
+        server=self.server
+        server.requests.append(self.path)
+        if self.path == '/missing':
+            self.send_error(404)
+            return
+        if self.path.startswith('/redirect/'):
+            self.send_response(302)
+            self.send_header('Location',self.path[len('/redirect/'):].replace('|','://'))
+            self.end_headers()
+            return
+        if self.headers.getheader('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        server.transfers += 1
+        self.send_response(200)
+        self.send_header('ETag',server.etag)
+        self.send_header('Content-Length',str(len(server.body)))
+        if self.path == '/named': self.send_header('Content-Disposition','attachment; filename="hsi_l0.fits"')
+        self.end_headers()
+        self.wfile.write(server.body)
+
+    def log_message(self,*args):
+        pass
+
+@pytest.fixture
+def http():
+
+    server=BaseHTTPServer.HTTPServer(('localhost',0),Handler)
+    server.requests=[]
+    server.transfers=0
+    server.etag='"v1"'
+    server.body=BODY
+    thread=threading.Thread(target=server.serve_forever)
+    thread.daemon=True
+    thread.start()
+    server.url='http://localhost:%d' % server.server_address[1]
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def read(path):
+
+    with open(path) as f: return f.read()
+
+def test_fetch_then_hit(tmp,http):
+
+    cache=urlcache.URLCache(os.path.join(tmp,'urls'),max_bytes=1<<20)
+    path,name,error=cache.fetch(http.url+'/data/file.fits')
+    assert error == ''
+    assert name == 'file.fits'
+    assert read(path) == BODY
+    path2,name,error=cache.fetch(http.url+'/data/file.fits')
+    assert read(path2) == BODY and path2 != path
+    assert len(http.requests) == 1
+    assert (cache.hits,cache.misses) == (1,1)
+
+def test_content_disposition_name(tmp,http):
+
+    cache=urlcache.URLCache(os.path.join(tmp,'urls'),max_bytes=1<<20)
+    path,name,error=cache.fetch(http.url+'/named')
+    assert name == 'hsi_l0.fits'
+    assert os.path.basename(path) == 'hsi_l0.fits'
+
+def test_revalidate_unchanged_and_changed(tmp,http):
+
+    cache=urlcache.URLCache(os.path.join(tmp,'urls'),max_bytes=1<<20,fresh=0)
+    url=http.url+'/file.fits'
+    cache.fetch(url)
+    path,name,error=cache.fetch(url)
+    assert read(path) == BODY
+    assert len(http.requests) == 2 and http.transfers == 1
+    http.etag='"v2"'
+    http.body='changed'
+    path,name,error=cache.fetch(url)
+    assert read(path) == 'changed'
+    assert http.transfers == 2
+
+def test_index_survives_restart(tmp,http):
+
+    root=os.path.join(tmp,'urls')
+    urlcache.URLCache(root,max_bytes=1<<20).fetch(http.url+'/file.fits')
+    cache=urlcache.URLCache(root,max_bytes=1<<20)
+    path,name,error=cache.fetch(http.url+'/file.fits')
+    assert read(path) == BODY
+    assert http.transfers == 1
+
+def test_http_error(tmp,http):
+
+    cache=urlcache.URLCache(os.path.join(tmp,'urls'),max_bytes=1<<20)
+    path,name,error=cache.fetch(http.url+'/missing')
+    assert path is None
+    assert '404' in error
+    assert os.listdir(os.path.join(tmp,'urls')) == []
+
+@pytest.mark.parametrize('url',['file:///etc/passwd','ftp://localhost/file.fits','FILE:///etc/hosts'])
+def test_unsupported_scheme(tmp,url):
+
+    cache=urlcache.URLCache(os.path.join(tmp,'urls'),max_bytes=1<<20)
+    path,name,error=cache.fetch(url)
+    assert path is None
+    assert error.startswith('Unsupported URL scheme')
+
+@pytest.mark.parametrize('target',['ftp|localhost/file.fits','file|/etc/passwd'])
+def test_redirect_to_other_scheme_refused(tmp,http,target):
+
+    cache=urlcache.URLCache(os.path.join(tmp,'urls'),max_bytes=1<<20)
+    path,name,error=cache.fetch(http.url+'/redirect/'+target)
+    assert path is None
+    assert 'HTTP Error 302' in error
+    assert cache.entries == {}
+
+def test_eviction(tmp,http):
+
+    cache=urlcache.URLCache(os.path.join(tmp,'urls'),max_bytes=len(BODY)+10)
+    cache.fetch(http.url+'/a.fits')
+    cache.fetch(http.url+'/b.fits')
+    assert list(cache.entries) == [http.url+'/b.fits']
+    assert cache.total == len(BODY)
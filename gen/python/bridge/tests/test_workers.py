@@ -0,0 +1,84 @@
+
+# IDL worker processes (workers.WorkerPool): dispatch, queue limit, pinning
+# of clients to workers and restart of workers that die
+
+import os,signal,time
+import config,mux
+
+def execute(command):
+
+    return {'action':'execute','command':command,'is_function':0,'keywords':{}}
+
+def channels(port,n):
+
+    return [mux.connect('localhost',port) for i in range(n)]
+
+def close(opened):
+
+    for channel in opened: channel.close()
+
+def test_jobs_run_in_parallel(start_server):
+
+    port=start_server(workers=2,unix_socket=False)
+    opened=channels(port,2)
+    try:
+        start=time.time()
+        calls=[channel.begin(execute('wait,1')) for channel in opened]
+        for call in calls: assert call.event.wait(10) and call.header['error'] == ''
+        assert time.time()-start < 1.8
+    finally:
+        close(opened)
+
+def test_queue_full(start_server):
+
+    port=start_server(workers=1,queue=1,unix_socket=False)
+    opened=channels(port,3)
+    try:
+        running=opened[0].begin(execute('wait,1'))
+        time.sleep(0.2)
+        queued=opened[1].begin(execute("result='queued'"))
+        time.sleep(0.2)
+        refused=opened[2].call(execute("result='refused'"),timeout=10)
+        assert refused.error == 'Server busy. Try again later.'
+        for call in (running,queued): assert call.event.wait(10) and call.header['error'] == ''
+        assert opened[2].run("result='later'") == 'later'
+    finally:
+        close(opened)
+
+# variables set by a client are seen by its later calls, as each client
+# keeps to one worker, and clients are spread over the workers
+
+def test_clients_pinned(start_server):
+
+    port=start_server(workers=3,unix_socket=False)
+    opened=channels(port,3)
+    try:
+        for i,channel in enumerate(opened): assert channel.run("v='c%d'" % i) == ''
+        for n in range(5):
+            for i,channel in enumerate(opened): assert channel.get('v') == 'c%d' % i
+        pins=config.servers[port].executor.pins
+        assert len(set(pins.values())) == 3
+    finally:
+        close(opened)
+
+# a job on a worker that dies fails, and the worker is replaced
+
+def test_worker_restart(start_server):
+
+    port=start_server(workers=1,unix_socket=False)
+    pool=config.servers[port].executor
+    channel=mux.connect('localhost',port)
+    try:
+        assert channel.run("v='before'") == ''
+        call=channel.begin(execute('wait,5'))
+        time.sleep(0.3)
+        pid=pool.workers.values()[0].pid
+        os.kill(pid,signal.SIGKILL)
+        assert call.event.wait(10)
+        assert call.header['error'] == 'IDL worker process died.'
+        assert channel.run("result='after'") == 'after'
+        assert pool.workers.values()[0].pid != pid
+        assert pool.sessions() == (1,1)
+        assert channel.get('v') is None
+    finally:
+        channel.close()
@@ -4,40 +4,46 @@
 # Read remote data with size bytes from socket and write to filename to current directory
 # session - if string, write file to temp_dir/session 
 # outdir - if string, write file to outdir
+# RECV_BUFFER - size of receive buffer [def = 1 MB]
+# encoding - if set, data is a compressed frame stream (see send_compressed)
+# offset - number of bytes already received in partial file to resume from
+# checksum - if set, hash (see blobs.file_hash) that completed file must match
+
+# Data is received into a preallocated buffer and written to file from it
+# without intermediate copies. The file is written as filename.part and 
+# renamed when complete, so an interrupted transfer can be resumed.
 
 
 def rdwrt(sock,filename,size,**kwargs):
    
-    import os, tempfile, sys
-    
-    session=None
-    if 'session' in kwargs:
-        session=kwargs['session']
+    import os, sys, time
     
-    outdir=None
-    if 'outdir' in kwargs:
-        outdir=kwargs['outdir']
-
     verbose=False
     if 'verbose' in kwargs:
         verbose=True
 
-    RECV_BUFFER=4096
+    RECV_BUFFER=DEF_RECV_BUFFER
     if 'RECV_BUFFER' in kwargs:
         RECV_BUFFER=long(kwargs['RECV_BUFFER'])
 
-    if type(outdir) == str:
-        tdir=expand_name(outdir)
-    elif type(session) == str:
-        tdir=os.path.join(tempfile.gettempdir(),session)
-    else: 
-        tdir=os.getcwd()
+    encoding=None
+    if 'encoding' in kwargs:
+        encoding=kwargs['encoding']
+
+    offset=0L
+    if 'offset' in kwargs:
+        offset=long(kwargs['offset'])
+
+    checksum=None
+    if 'checksum' in kwargs:
+        checksum=kwargs['checksum']
+
+    tdir=out_dir(**kwargs)
 
 # create output directory if doesn't exist
 
     try: 
         os.makedirs(tdir)
-        os.chmod(tdir,0o777)
     except OSError:
         sys.exc_clear()
 
@@ -53,28 +59,82 @@ def rdwrt(sock,filename,size,**kwargs):
     if verbose: print("Reading "+str(dsize)+" bytes of file: "+ifile)
 
     tfile=os.path.join(tdir,ifile) 
-    handle = open(tfile,'wb')
-    bsize=RECV_BUFFER
+    pfile=tfile+'.part'
+    if offset and os.path.isfile(pfile):
+        handle=open(pfile,'r+b')
+        handle.seek(offset)
+        handle.truncate()
+    else:
+        handle=open(pfile,'wb')
     wsize=0L; osize=dsize
-    while True:
-       if dsize <= bsize: bsize=dsize
-       buff=sock.recv(bsize)
-       if not buff: break
-       rsize=len(buff) 
-       handle.write(buff)
-       wsize += rsize
-       dsize -= rsize
-       if dsize < 0 or wsize == osize: break
+    tstart=time.time()
+    try:
+        if encoding:
+            wsize=recv_compressed(sock,handle,encoding)
+            dsize=0
+        else:
+            buff=memoryview(bytearray(min(RECV_BUFFER,max(dsize,1))))
+        while dsize > 0:
+           rsize=sock.recv_into(buff,min(len(buff),dsize))
+           if not rsize: break
+           handle.write(buff[:rsize])
+           wsize += rsize
+           dsize -= rsize
+    except IOError:
+        pass
     handle.close()
     if wsize != osize:
         err='Error writing '+filename
         result=None
-    else:
-        result=tfile
-        err=''
-        if verbose: print("Wrote "+str(wsize)+" bytes to: "+tfile)
+        return (result,err)
+    if checksum:
+        import blobs
+        if blobs.file_hash(pfile) != checksum:
+            os.remove(pfile)
+            return (None,'Checksum mismatch: '+filename)
+    if os.path.isfile(tfile): os.remove(tfile)
+    os.rename(pfile,tfile)
+    result=tfile
+    err=''
+    if verbose: 
+        print("Wrote "+str(wsize)+" bytes to: "+tfile)
+        print(throughput(wsize,time.time()-tstart))
     return (result,err)
 
+###########################################################################
+# directory rdwrt writes to, and size of partial file left there by an
+# interrupted transfer of filename
+
+def out_dir(**kwargs):
+
+    import os, tempfile
+    outdir=kwargs.get('outdir')
+    session=kwargs.get('session')
+    if type(outdir) == str: return expand_name(outdir)
+    if type(session) == str: return os.path.join(tempfile.gettempdir(),session)
+    return os.getcwd()
+
+def part_size(filename,**kwargs):
+
+    import os
+    pfile=os.path.join(out_dir(**kwargs),os.path.basename(filename))+'.part'
+    if not os.path.isfile(pfile): return 0L
+    return long(os.path.getsize(pfile))
+
+def remove_part(filename,**kwargs):
+
+    import os
+    pfile=os.path.join(out_dir(**kwargs),os.path.basename(filename))+'.part'
+    if os.path.isfile(pfile): os.remove(pfile)
+
+###########################################################################
+# transfer rate message
+
+def throughput(nbytes,elapsed):
+
+    rate=nbytes/max(elapsed,1e-6)/1048576.
+    return "Transferred %d bytes in %.3f s (%.1f MB/s)" % (nbytes,elapsed,rate)
+
 ###########################################################################
 # check if input directory exists and is writeable
 
@@ -163,47 +223,761 @@ def valid_url(*arg):
 ##############################################################################
 # useful socket functions
 
-def send_data(sock, data):
+# Socket buffer sizes in bytes. DEF_RECV_BUFFER is the size of the 
+# buffers files are received into. SOCK_BUFFER, if set, is applied as
+# SO_RCVBUF/SO_SNDBUF to new connections; by default the OS tunes them.
+
+DEF_RECV_BUFFER=1048576
+SOCK_BUFFER=0
+
+# Largest frame the server accepts, so a bad length prefix cannot make it
+# buffer gigabytes (see server.next_frame).
+
+MAX_FRAME=64*1048576
+
+def tune_socket(sock,size=None):
+    import socket
+    if size is None: size=SOCK_BUFFER
+    if not is_unix(sock): sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+    if size > 0:
+        sock.setsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF,size)
+        sock.setsockopt(socket.SOL_SOCKET,socket.SO_SNDBUF,size)
+
+##############################################################
+# Local transport. A server also listens on a Unix domain socket
+# (local_path), which clients on the same host connect to instead
+# of TCP. Only the server's user can connect to it, so on these
+# connections large arrays are passed through files in /dev/shm
+# (write_shm, map_shm) and files by path (link_file, server 'link'
+# action) instead of through the socket.
+
+# The socket is in a directory of the user's own (local_dir, mode
+# 0700). Clients only use a socket there if the directory and the
+# socket are the user's (local_server), so another user cannot
+# stand in for the server. Even so, shared memory files are only
+# mapped (and removed) if they are the user's idl_bridge_ files in
+# SHM_DIR or the temporary directory (shared_file), and files are
+# only linked if they are the file asked for (handed_file).
+
+SHM_DIR='/dev/shm'
+SHM_MIN=65536
+
+def local_dir():
+    import os,tempfile
+    return os.path.join(tempfile.gettempdir(),'idl_bridge_%d' % os.getuid())
+
+def local_path(port):
+    import os
+    return os.path.join(local_dir(),'%s.sock' % port)
+
+# make directory for local sockets, or check that one that exists is
+# the user's own and closed to others. Raises OSError if it is not.
+
+def private_dir(path):
+    import os,stat
+    if not os.path.lexists(path): os.mkdir(path,0o700)
+    st=os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise OSError('Not a private directory: '+path)
+
+# check that a server of this user listens on the local socket for port
+
+def local_server(port):
+    import os,stat
+    path=local_path(port)
+    try:
+        dst=os.lstat(os.path.dirname(path))
+        sst=os.lstat(path)
+    except OSError:
+        return False
+    if not stat.S_ISDIR(dst.st_mode) or dst.st_uid != os.getuid() or dst.st_mode & 0o077: return False
+    return stat.S_ISSOCK(sst.st_mode) and sst.st_uid == os.getuid()
+
+def is_unix(sock):
+    import socket
+    return hasattr(socket,'AF_UNIX') and sock.family == socket.AF_UNIX
+
+# connect to server, through its Unix socket if ip is local and it
+# has one, else by TCP. Gives up (raising socket.timeout) if the server
+# does not accept within CONNECT_TIMEOUT seconds, or timeout if that is
+# shorter; the socket then has timeout (blocking if None).
+
+CONNECT_TIMEOUT=10.
+
+def connect(ip,port,timeout=None):
+    import socket
+    wait=CONNECT_TIMEOUT
+    if timeout is not None: wait=min(wait,timeout)
+    path=local_path(port)
+    sock=None
+    if is_local(ip) and hasattr(socket,'AF_UNIX') and local_server(port):
+        sock=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        sock.settimeout(wait)
+        try:
+            sock.connect(path)
+        except socket.error:
+            sock.close()
+            sock=None
+    if sock is None: sock=socket.create_connection((ip,port),wait)
+    sock.settimeout(timeout)
+    return sock
+
+# write bytes of data to new shared memory file. Returns its path, 
+# or None if it cannot be written.
+
+def write_shm(data):
+    import os,tempfile,uuid
+    root=SHM_DIR
+    if not os.path.isdir(root): root=tempfile.gettempdir()
+    path=os.path.join(root,'idl_bridge_'+uuid.uuid4().hex)
+    try:
+        fd=os.open(path,os.O_WRONLY|os.O_CREAT|os.O_EXCL,0o600)
+        with os.fdopen(fd,'wb') as f: f.write(data)
+    except (IOError,OSError):
+        if os.path.exists(path): os.remove(path)
+        return None
+    return path
+
+# map shared memory file copy-on-write and remove it. The memory stays
+# mapped while the map is referenced.
+
+def map_shm(path):
+    import mmap,os
+    if not shared_file(path): raise ValueError('Not a shared memory file: '+path)
+    with open(path,'rb') as f:
+        data=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_COPY)
+    os.remove(path)
+    return data
+
+# check that path is a shared memory file written by write_shm
+
+def shared_file(path):
+    import os,stat,tempfile
+    real=os.path.realpath(path)
+    roots=[os.path.realpath(SHM_DIR),os.path.realpath(tempfile.gettempdir())]
+    if os.path.dirname(real) not in roots or not os.path.basename(real).startswith('idl_bridge_'): return False
+    try:
+        st=os.lstat(real)
+    except OSError:
+        return False
+    return stat.S_ISREG(st.st_mode) and st.st_uid == os.getuid()
+
+# check that path the server gave for a download of file requested
+# is that file (by name, if requested is relative to the server's
+# directory)
+
+def handed_file(path,requested):
+    import os
+    if not requested: return False
+    requested=expand_name(str(requested))
+    if not requested or not os.path.isabs(path) or not os.path.isfile(path): return False
+    if os.path.isabs(requested): return os.path.realpath(path) == os.path.realpath(requested)
+    return os.path.basename(path) == os.path.basename(requested)
+
+# link (or copy, across file systems) file filename, downloaded as
+# requested, to directory given by kwargs as for rdwrt. Returns 
+# (local file name,'') or (None,error).
+
+def link_file(filename,requested,**kwargs):
+    import os
+    import blobs
+    if not handed_file(filename,requested): return (None,'Server gave wrong file: '+filename)
+    tdir=out_dir(**kwargs)
+    try:
+        if not os.path.isdir(tdir): os.makedirs(tdir)
+        tfile=os.path.join(tdir,os.path.basename(filename))
+        pfile=tfile+'.part'
+        if os.path.isfile(pfile): os.remove(pfile)
+        blobs.link(filename,pfile)
+        if os.path.isfile(tfile): os.remove(tfile)
+        os.rename(pfile,tfile)
+    except (IOError,OSError) as e:
+        return (None,'Error linking '+filename+': '+str(e))
+    if 'verbose' in kwargs: print("Linked file: "+tfile)
+    return (tfile,'')
+
+# Frames are sent with a 4-byte length prefix. On connections that
+# have negotiated a codec (see negotiate), frames of COMPRESS_MIN 
+# bytes or more are compressed and flagged by the top bit of the length.
+
+def send_data(sock, data, codec=None):
     import struct
     length = len(data)
-    sock.sendall(struct.pack('!I', length))
-    sock.sendall(data)
+    if codec and length >= COMPRESS_MIN:
+        data = compress(codec, data)
+        length = len(data) | COMPRESSED
+    sock.sendall(struct.pack('!I', length)+data)
+
+# Frames over max_size bytes (before or after decompression) raise
+# ValueError; by default frames from the server are not limited.
 
-def recv_data(sock):
+def recv_data(sock, codec=None, max_size=None):
     import struct
     lengthbuf = recvall(sock, 4)
     if not lengthbuf: return None
     length, = struct.unpack('!I', lengthbuf)
-    return recvall(sock, length)
+    if max_size is not None and length & ~COMPRESSED > max_size:
+        raise ValueError('Frame of %d bytes exceeds limit.' % (length & ~COMPRESSED))
+    if not length & COMPRESSED: return recvall(sock, length)
+    data = recvall(sock, length & ~COMPRESSED)
+    if data is None: return None
+    return decompress(codec, data, max_size)
 
 def recvall(sock, count):
-    buf = b''
-    while count:
-        newbuf = sock.recv(count)
-        if not newbuf: return None
-        buf += newbuf
-        count -= len(newbuf)
-    return buf
+    buf = bytearray(count)
+    if not recvall_into(sock, memoryview(buf)): return None
+    return bytes(buf)
 
 ##############################################################
-# create temporary directory
+# create temporary directory: a new session in the server's scratch
+# store (see scratch.py) if it has one
 
 def get_temp_dir():
 
-    import tempfile,os,time,random,sys
+    import tempfile,os
+    import config
 
-    id=int(time.time())+random.randint(1,1000)
-    session='s'+str(id)
-    tdir=os.path.join(tempfile.gettempdir(),session)
- 
-# create output directory if doesn't exist
+    if config.scratch: return config.scratch.new_session()
+    tdir=tempfile.mkdtemp(prefix='s')
+    os.chmod(tdir,0o755)
+    return tdir
+
+
+##############################################################
+# Binary array results. A numpy array is described in the JSON
+# response by its dtype, shape, byte order and size in bytes, 
+# and its raw bytes follow the response on the socket, or are in
+# the shared memory file shm on local connections. Record arrays
+# (e.g. FITS table rows) also give their fields in descr.
+
+def is_array(value):
+
+    return hasattr(value,'dtype') and hasattr(value,'shape') and not value.dtype.hasobject
+
+def result_header(value):
+
+    if not is_array(value): return {'result':value}
+    byteorder={'<':'little','>':'big','|':'none'}[value.dtype.str[0]]
+    header={'result':'','type':'array','dtype':value.dtype.str,
+            'shape':list(value.shape),'byteorder':byteorder,'size':value.nbytes}
+    if value.dtype.names: header['descr']=value.dtype.descr
+    return header
+
+def array_bytes(value):
+
+    import numpy
+    data=numpy.ascontiguousarray(value).reshape(-1).view(numpy.uint8)
+    return memoryview(data)
+
+
+# read result described by header. Arrays are read into a 
+# bytearray and returned as numpy arrays without copying. 
+
+def recv_result(sock,header):
+
+    if header.get('type') != 'array': return str(header['result'])
+    if header.get('shm'): return make_array(header,b'')
+
+    size=long(header['size'])
+    if size == 0: return make_array(header,b'')
+    buf=bytearray(size)
+    if not recvall_into(sock,memoryview(buf)): return None
+    return make_array(header,buf)
+
+# array described by header from its bytes in buf
+
+def make_array(header,buf):
+
+    import numpy
+    if header.get('descr'):
+        dtype=numpy.dtype([tuple([str(f[0]),str(f[1])]+[tuple(s) for s in f[2:]]) for f in header['descr']])
+    else:
+        dtype=numpy.dtype(str(header['dtype']))
+    shape=[int(n) for n in header['shape']]
+    if header.get('shm'):
+        try:
+            buf=map_shm(str(header['shm']))
+        except (IOError,OSError,ValueError) as e:
+            print("Error reading shared memory: "+str(e))
+            return None
+    if len(buf) == 0: return numpy.empty(shape,dtype=dtype)
+    value=numpy.frombuffer(buf,dtype=dtype).reshape(shape)
+    if value.ndim == 0: value=value[()]
+    return value
+
+def recvall_into(sock,view):
+    count=len(view)
+    pos=0
+    while pos < count:
+        nbytes=sock.recv_into(view[pos:])
+        if not nbytes: return False
+        pos += nbytes
+    return True
 
+##############################################################
+# File sending without reading the file into memory. Files are
+# sent with os.sendfile where available, otherwise in chunks from
+# a sliding read-only memory map of the file, so memory use stays
+# flat whatever the file size.
+
+# send(sock) makes one send call and returns the number of bytes
+# sent, so it can be used on non-blocking sockets. 
+
+class FileSender(object):
+
+    CHUNK=1048576
+    WINDOW=16777216
+
+    def __init__(self,filename,offset=0,size=None):
+
+        import os
+        self.file=open(filename,'rb')
+        fsize=os.fstat(self.file.fileno()).st_size
+        if size is None: size=fsize-offset
+        self.pos=long(offset)
+        self.remaining=long(min(size,fsize-offset))
+        self.size=self.remaining
+        self.sendfile=hasattr(os,'sendfile')
+        self.map=None
+        self.map_start=0
+        self.done=self.remaining <= 0
+
+    def send(self,sock):
+
+        import os
+        count=min(self.CHUNK,self.remaining)
+        if self.sendfile:
+            nbytes=os.sendfile(sock.fileno(),self.file.fileno(),self.pos,count)
+        else:
+            nbytes=sock.send(self.chunk(count))
+        if nbytes == 0: raise IOError('File truncated while sending.')
+        self.pos += nbytes
+        self.remaining -= nbytes
+        self.done=self.remaining <= 0
+        return nbytes
+
+# return count bytes at current position from memory map, moving
+# the mapped window forward as needed
+
+    def chunk(self,count):
+
+        import mmap
+        start=self.pos-self.map_start
+        if self.map is None or start+count > len(self.map):
+            if self.map is not None: self.map.close()
+            self.map_start=self.pos-self.pos % mmap.ALLOCATIONGRANULARITY
+            length=min(self.WINDOW,self.pos+self.remaining-self.map_start)
+            self.map=mmap.mmap(self.file.fileno(),length,access=mmap.ACCESS_READ,offset=self.map_start)
+            start=self.pos-self.map_start
+            count=min(count,length-start)
+        return view(self.map,start,count)
+
+    def close(self):
+
+        if self.map is not None: self.map.close()
+        self.map=None
+        self.file.close()
+
+# send file on blocking socket (or socket with timeout)
+
+def send_file(sock,filename,offset=0,size=None):
+
+    import select,socket
+    import reactor
+    sender=FileSender(filename,offset=offset,size=size)
     try:
-        os.makedirs(tdir)
-        os.chmod(tdir,0o777)
-    except OSError:
-        sys.exc_clear()
+        while not sender.done:
+            try:
+                sender.send(sock)
+            except socket.error as e:
+                if not reactor.would_block(e): raise
+                r,w,x=select.select([],[sock],[],sock.gettimeout())
+                if not w: raise socket.timeout('timed out')
+    finally:
+        sender.close()
+    return sender.size
+
+# zero-copy slice of buffer (memoryview, or buffer for objects 
+# such as mmap that lack the new buffer interface in Python 2)
+
+def view(buf,offset,size):
 
-    return tdir
+    try:
+        return memoryview(buf)[offset:offset+size]
+    except TypeError:
+        return buffer(buf,offset,size)
+
+##############################################################
+# On-the-wire compression. A client that wants compression sends
+# a 'hello' request listing the codecs it supports; the server
+# replies with the one it chose (or none). Codecs are from the 
+# standard library: zlib (fast, default) and bz2 (smaller).
+
+# Compressed file transfers are sent as a stream of frames of 
+# compressed data ended by an empty frame; the JSON header gives
+# the codec as 'encoding' and the uncompressed 'size'.
+
+# Data is decompressed a piece at a time (see inflate), so that a
+# small frame that decompresses to a huge one (a compression bomb)
+# is rejected before it is held in memory: zlib output is limited
+# to OUT_CHUNK bytes per step, and bz2, which has no output limit,
+# is given BZ2_STEP bytes of input at a time (a bz2 block of a few
+# dozen bytes can still expand to about 45 MB).
+
+COMPRESSED=0x80000000
+COMPRESS_MIN=4096
+CODECS=['zlib','bz2']
+OUT_CHUNK=1048576
+BZ2_STEP=64
+PRECOMPRESSED=('.gz','.fz','.bz2','.z','.zip','.xz','.jpg','.jpeg','.png','.jp2','.mp4','.mpg')
+
+def compressor(codec):
+    import zlib,bz2
+    if codec == 'zlib': return zlib.compressobj(1)
+    if codec == 'bz2': return bz2.BZ2Compressor(1)
+    raise ValueError('Unsupported codec: '+str(codec))
+
+def decompressor(codec):
+    import zlib,bz2
+    if codec == 'zlib': return zlib.decompressobj()
+    if codec == 'bz2': return bz2.BZ2Decompressor()
+    raise ValueError('Unsupported codec: '+str(codec))
+
+def compress(codec,data):
+    comp=compressor(codec)
+    return comp.compress(data)+comp.flush()
+
+# decompress frame. If it decompresses to over limit bytes, raise 
+# ValueError.
+
+def decompress(codec,data,limit=None):
+    decomp=decompressor(codec)
+    if limit is None: return decomp.decompress(data)
+    pieces=[] ; size=0
+    for piece in inflate(decomp,data):
+        size += len(piece)
+        if size > limit: raise ValueError('Frame of more than %d bytes exceeds limit.' % limit)
+        pieces.append(piece)
+    return b''.join(pieces)
+
+# yield pieces of data decompressed by decomp (a stream decompressor)
+
+def inflate(decomp,data):
+    if hasattr(decomp,'unconsumed_tail'):
+        while True:
+            piece=decomp.decompress(data,OUT_CHUNK)
+            data=decomp.unconsumed_tail
+            if piece: yield piece
+            if not data and len(piece) < OUT_CHUNK: return
+    for pos in range(0,len(data),BZ2_STEP):
+        piece=decomp.decompress(data[pos:pos+BZ2_STEP])
+        if piece: yield piece
+
+# check if server address is on this host
+
+def is_local(ip):
+    return ip in ('','localhost','::1') or ip.startswith('127.')
+
+# check if file is worth compressing
+
+def compressible(filename,size):
+    import os
+    if size < COMPRESS_MIN: return False
+    return os.path.splitext(filename)[1].lower() not in PRECOMPRESSED
+
+# ask server for a codec from codecs. Servers predating compression
+# do not answer, so wait only briefly. Returns codec or ''.
+
+def negotiate(sock,codecs=CODECS,timeout=5.):
+    import json,socket
+    old=sock.gettimeout()
+    sock.settimeout(timeout)
+    try:
+        send_data(sock,json.dumps({'action':'hello','codecs':codecs}))
+        data=recv_data(sock)
+    except socket.timeout:
+        data=None
+    finally:
+        sock.settimeout(old)
+    if not data: return None
+    tdict=json.loads(data)
+    return str(tdict.get('codec') or '')
+
+# reason given by server refusing a new connection (see server.refuse),
+# or '' if data is not a refusal
+
+def refusal(data):
+    import json
+    if not data: return ''
+    try:
+        tdict=json.loads(data)
+    except ValueError:
+        return ''
+    if type(tdict) != dict or tdict.get('action') != 'busy': return ''
+    return str(tdict.get('error') or 'Server busy. Try again later.')
+
+# send file as compressed frame stream on blocking socket
+
+def send_compressed(sock,filename,codec,offset=0,CHUNK=1048576):
+    import struct
+    comp=compressor(codec)
+    with open(filename,'rb') as file:
+        file.seek(offset)
+        while True:
+            data=file.read(CHUNK)
+            if not data: break
+            data=comp.compress(data)
+            if data: sock.sendall(struct.pack('!I',len(data))+data)
+    data=comp.flush()
+    if data: sock.sendall(struct.pack('!I',len(data))+data)
+    sock.sendall(struct.pack('!I',0))
+
+# receive compressed frame stream from blocking socket, writing 
+# decompressed data to handle. Returns number of bytes written or
+# None if the stream ended early.
+
+def recv_compressed(sock,handle,codec):
+    import struct
+    decomp=decompressor(codec)
+    wsize=0L
+    while True:
+        lengthbuf=recvall(sock,4)
+        if not lengthbuf: return None
+        length,=struct.unpack('!I',lengthbuf)
+        if length == 0: break
+        data=recvall(sock,length)
+        if data is None: return None
+        for piece in inflate(decomp,data):
+            handle.write(piece)
+            wsize += len(piece)
+    return wsize
+
+# Producer of compressed frame stream for non-blocking sockets
+
+class CompressedFileSender(object):
+
+    CHUNK=1048576
+
+    def __init__(self,filename,codec,offset=0,size=None):
+        self.file=open(filename,'rb')
+        self.file.seek(offset)
+        self.remaining=size
+        self.comp=compressor(codec)
+        self.buf=b''
+        self.pos=0
+        self.eof=False
+        self.done=False
+
+    def fill(self):
+        import struct
+        while self.pos >= len(self.buf) and not self.eof:
+            count=self.CHUNK
+            if self.remaining is not None: 
+                count=min(count,self.remaining)
+                self.remaining -= count
+            data=b''
+            if count > 0: data=self.file.read(count)
+            if data:
+                data=self.comp.compress(data)
+            else:
+                data=self.comp.flush()
+                self.eof=True
+            frame=b''
+            if data: frame=struct.pack('!I',len(data))+data
+            if self.eof: frame += struct.pack('!I',0)
+            self.buf=frame
+            self.pos=0
+
+    def send(self,sock):
+        self.fill()
+        nbytes=sock.send(memoryview(self.buf)[self.pos:])
+        self.pos += nbytes
+        self.done=self.eof and self.pos >= len(self.buf)
+        return nbytes
+
+    def close(self):
+        self.file.close()
+
+# Consumer of compressed frame stream fed from a non-blocking 
+# socket. feed(buf) writes what it can decode to handle and
+# returns the number of bytes used; done is set at the end frame.
+
+class FrameDecoder(object):
+
+    def __init__(self,handle,codec,max_size=None):
+        self.handle=handle
+        self.decomp=decompressor(codec)
+        self.pending=bytearray()
+        self.size=0L
+        self.max_size=max_size
+        self.done=False
+
+    def feed(self,buf):
+        import struct
+        used=0
+        while not self.done and used < len(buf):
+            need=4 if len(self.pending) < 4 else 4+struct.unpack('!I',bytes(self.pending[:4]))[0]
+            if need > MAX_FRAME+4: raise ValueError('Frame of %d bytes exceeds limit.' % (need-4))
+            take=min(need-len(self.pending),len(buf)-used)
+            self.pending.extend(buf[used:used+take])
+            used += take
+            if len(self.pending) < need: continue
+            if need == 4:
+                if struct.unpack('!I',bytes(self.pending))[0] == 0: self.done=True
+                else: continue
+            else:
+                for data in inflate(self.decomp,bytes(self.pending[4:])):
+                    self.size += len(data)
+                    if self.max_size is not None and self.size > self.max_size: 
+                        raise ValueError('Upload larger than given size.')
+                    if self.handle: self.handle.write(data)
+            del self.pending[:]
+        return used
+
+##############################################################
+# Protocol version 2, agreed in 'hello' (version=2). Every message
+# is a frame with a 9-byte header: the length of the body (top bit
+# set if compressed), the id of the request it belongs to, and one
+# of the frame types
+
+# HEADER - JSON request or response. A request carries all of its
+#          parameters, e.g. the keywords of execute.
+# DATA   - bytes of an uploaded or downloaded file, or of an array
+#          result, in frames of up to DATA_CHUNK bytes
+
+# so several requests can be in flight on one connection, and the
+# frames of their responses are interleaved (see mux.py). Bodies
+# of compressed frames are compressed separately.
+
+VERSION=2
+FRAME_HEADER=9
+HEADER=1
+DATA=2
+DATA_CHUNK=262144
+
+def pack_frame(rid,ftype,body,codec=None):
+    import struct
+    length=len(body)
+    if codec and length >= COMPRESS_MIN:
+        body=compress(codec,bytes(body))
+        length=len(body) | COMPRESSED
+    return struct.pack('!IIB',length,rid,ftype)+bytes(body)
 
+# return (id,type,body) of next frame in buffer (removing it), or
+# None if the frame is not complete. Frames over max_size (before or
+# after decompression) raise ValueError.
 
+def parse_frame(buf,codec=None,max_size=MAX_FRAME):
+    import struct
+    if len(buf) < FRAME_HEADER: return None
+    length,rid,ftype=struct.unpack('!IIB',bytes(buf[:FRAME_HEADER]))
+    compressed=length & COMPRESSED
+    length &= ~COMPRESSED
+    if length > max_size: raise ValueError('Frame of %d bytes exceeds limit.' % length)
+    if len(buf) < FRAME_HEADER+length: return None
+    body=bytes(buf[FRAME_HEADER:FRAME_HEADER+length])
+    del buf[:FRAME_HEADER+length]
+    if compressed: body=decompress(codec,body,max_size)
+    return (rid,ftype,body)
+
+# read frame from blocking socket. Returns (id,type,body) or None
+# if the connection closed.
+
+def read_frame(sock,codec=None):
+    import struct
+    header=recvall(sock,FRAME_HEADER)
+    if not header: return None
+    length,rid,ftype=struct.unpack('!IIB',header)
+    body=b''
+    if length & ~COMPRESSED:
+        body=recvall(sock,length & ~COMPRESSED)
+        if body is None: return None
+    if length & COMPRESSED: body=decompress(codec,body)
+    return (rid,ftype,body)
+
+# Producer of DATA frames for request rid from source (an object
+# with read(count), remaining and close()), for non-blocking 
+# sockets. boundary is set between frames, where frames of other
+# responses may be sent.
+
+class DataFrames(object):
+
+    def __init__(self,source,rid,codec=None):
+        self.source=source
+        self.rid=rid
+        self.codec=codec
+        self.frame=b''
+        self.pos=0
+        self.boundary=True
+        self.done=source.remaining <= 0
+
+    def send(self,sock):
+        if self.pos >= len(self.frame):
+            data=self.source.read(DATA_CHUNK)
+            if not data: raise IOError('File truncated while sending.')
+            self.frame=memoryview(pack_frame(self.rid,DATA,data,self.codec))
+            self.pos=0
+        nbytes=sock.send(self.frame[self.pos:])
+        self.pos += nbytes
+        self.boundary=self.pos >= len(self.frame)
+        self.done=self.boundary and self.source.remaining <= 0
+        return nbytes
+
+    def close(self):
+        self.source.close()
+
+class FileSource(object):
+
+    def __init__(self,filename,offset=0,size=None):
+        import os
+        self.file=open(filename,'rb')
+        self.file.seek(offset)
+        if size is None: size=os.fstat(self.file.fileno()).st_size-offset
+        self.remaining=size
+
+    def read(self,count):
+        data=self.file.read(min(count,self.remaining))
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+class BytesSource(object):
+
+    def __init__(self,data):
+        self.view=memoryview(data)
+        self.pos=0
+        self.remaining=len(self.view)
+
+    def read(self,count):
+        data=self.view[self.pos:self.pos+count].tobytes()
+        self.pos += len(data)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.view=None
+
+# Producer of the bytes of source, unframed, for protocol version 1
+
+class SourceSender(object):
+
+    def __init__(self,source):
+        self.source=source
+        self.data=b''
+        self.pos=0
+        self.done=source.remaining <= 0
+
+    def send(self,sock):
+        if self.pos >= len(self.data):
+            self.data=memoryview(self.source.read(DATA_CHUNK))
+            if not len(self.data): raise IOError('File truncated while sending.')
+            self.pos=0
+        nbytes=sock.send(self.data[self.pos:])
+        self.pos += nbytes
+        self.done=self.pos >= len(self.data) and self.source.remaining <= 0
+        return nbytes
+
+    def close(self):
+        self.source.close()
@@ -0,0 +1,254 @@
+
+# Cache of remote files fetched by the Python-IDL bridge server
+
+# Files given to tprep as URLs are fetched by the server (the 'url' action)
+# and kept on disk, so prepping the same archive file again does not fetch
+# it again. Each cached file is stored under a hash of its URL and the ETag
+# (or Last-Modified date) the remote server gave it. A cached file is used
+# as it is for FRESH seconds after it was fetched or checked; after that
+# it is revalidated with a conditional GET, which only transfers the file
+# if it has changed.
+
+# The cache is bounded in size; least recently used files are removed
+# first. Requests for a URL already being fetched wait for that fetch
+# instead of starting another. The file name given by the remote server's
+# Content-Disposition header is kept with the file, so clients do not need
+# to ask for it (tools.disp_url) themselves.
+
+# Files are hard-linked out of the cache into a new temporary directory
+# (as in blobs.py), so a file being prepped is not lost if it is evicted.
+
+# Only http and https URLs (SCHEMES) are fetched, and redirects to other
+# schemes are refused, so clients cannot read the server's own files with
+# file:// (or ftp://) URLs.
+
+# Example:
+# >>> cache=urlcache.URLCache('/tmp/bridge_urls',max_bytes=5*1024**3)
+# >>> path,name,error=cache.fetch('https://hesperia.gsfc.nasa.gov/...')
+
+import collections,threading,urllib2
+
+FRESH=300.            # seconds a cached file is used without revalidating
+CHUNK=1048576
+TIMEOUT=60.           # seconds to wait for remote server
+INDEX='index.json'
+SCHEMES=('http','https')
+
+class URLCache(object):
+
+    def __init__(self,root,max_bytes,fresh=FRESH):
+
+        import json,os
+        self.root=root
+        self.max_bytes=max_bytes
+        self.fresh=fresh
+        self.lock=threading.Lock()
+        self.entries=collections.OrderedDict()     # URL -> entry, least recently used first
+        self.total=0
+        self.fetching={}                           # URL -> Fetch in progress
+        self.hits=0
+        self.misses=0
+        if not os.path.isdir(root): os.makedirs(root)
+        index=os.path.join(root,INDEX)
+        if os.path.isfile(index):
+            try:
+                with open(index) as f: saved=json.load(f)
+            except ValueError:
+                saved=[]
+            for url,entry in saved:
+                if os.path.isfile(self.path(entry['key'])):
+                    self.entries[url]=entry
+                    self.total += entry['size']
+        known=set([entry['key'] for entry in self.entries.values()]+[INDEX])
+        for name in os.listdir(root):
+            if name not in known: remove(os.path.join(root,name))
+        self.evict()
+
+    def path(self,key):
+
+        import os
+        return os.path.join(self.root,key)
+
+###############################################################################
+# return (path of new copy of file at url,file name from server,'') or
+# (None,'',error). Blocks while the file is fetched, so is called from a
+# thread (see server.Connection.fetch_url).
+
+    def fetch(self,url):
+
+        import time
+        if not allowed(url): return (None,'','Unsupported URL scheme: '+url)
+        with self.lock:
+            entry=self.entries.get(url)
+            if entry and time.time()-entry['checked'] < self.fresh:
+                self.hits += 1
+                self.touch(url)
+                return self.checkout(entry)
+            pending=self.fetching.get(url)
+            owner=pending is None
+            if owner: pending=self.fetching[url]=Fetch()
+        if not owner:
+            pending.event.wait()
+            return pending.result
+        try:
+            pending.result=self.update(url,entry)
+        except Exception as e:
+            pending.result=(None,'','Error fetching '+url+': '+str(e))
+        finally:
+            with self.lock:
+                del self.fetching[url]
+            pending.event.set()
+        return pending.result
+
+# fetch url, or revalidate entry if it has one
+
+    def update(self,url,entry):
+
+        import os,time,urllib2
+        request=urllib2.Request(url)
+        if entry:
+            if entry.get('etag'): request.add_header('If-None-Match',entry['etag'])
+            if entry.get('modified'): request.add_header('If-Modified-Since',entry['modified'])
+        try:
+            response=urllib2.build_opener(RedirectHandler).open(request,timeout=TIMEOUT)
+        except urllib2.HTTPError as e:
+            if e.code != 304 or not entry: raise
+            with self.lock:
+                self.hits += 1
+                entry['checked']=time.time()
+                self.touch(url)
+                self.save()
+                return self.checkout(entry)
+        headers=response.info()
+        etag=headers.getheader('ETag') or ''
+        modified=headers.getheader('Last-Modified') or ''
+        key=cache_key(url,etag or modified)
+        part=self.path(key)+'.part.'+str(os.getpid())+'.'+str(threading.current_thread().ident)
+        size=0
+        try:
+            with open(part,'wb') as f:
+                while True:
+                    data=response.read(CHUNK)
+                    if not data: break
+                    f.write(data)
+                    size += len(data)
+        except:
+            remove(part)
+            raise
+        finally:
+            response.close()
+        name=disposition(headers.getheader('Content-Disposition'))
+        if not name: name=url_name(response.geturl())
+        entry={'key':key,'size':size,'etag':etag,'modified':modified,'name':name,'checked':time.time()}
+        with self.lock:
+            self.misses += 1
+            if url in self.entries: self.remove(url)
+            os.rename(part,self.path(key))
+            os.chmod(self.path(key),0o444)
+            self.entries[url]=entry
+            self.total += size
+            result=self.checkout(entry)
+            self.evict()
+            self.save()
+        return result
+
+###############################################################################
+# entries are changed under lock
+
+    def checkout(self,entry):
+
+        import os
+        import tools,blobs
+        target=os.path.join(tools.get_temp_dir(),entry['name'])
+        try:
+            blobs.link(self.path(entry['key']),target)
+        except (IOError,OSError) as e:
+            return (None,'','Error reading cached file: '+str(e))
+        return (target,entry['name'],'')
+
+    def touch(self,url):
+
+        self.entries[url]=self.entries.pop(url)
+
+    def remove(self,url):
+
+        entry=self.entries.pop(url)
+        self.total -= entry['size']
+        remove(self.path(entry['key']))
+
+# remove least recently used files until cache is within max_bytes. The
+# newest file is kept even if larger, until the next is fetched.
+
+    def evict(self):
+
+        while len(self.entries) > 1 and self.total > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+
+    def save(self):
+
+        import json,os
+        index=self.path(INDEX)
+        try:
+            with open(index+'.tmp','w') as f: json.dump(list(self.entries.items()),f)
+            os.rename(index+'.tmp',index)
+        except (IOError,OSError) as e:
+            print("Error saving URL cache index: "+str(e))
+
+##############################################################################
+# fetch in progress, shared by requests for the same URL
+
+class Fetch(object):
+
+    def __init__(self):
+
+        self.event=threading.Event()
+        self.result=None
+
+##############################################################################
+# only http and https URLs, and redirects to them, are followed
+
+def allowed(url):
+
+    import urlparse
+    return urlparse.urlparse(url).scheme.lower() in SCHEMES
+
+class RedirectHandler(urllib2.HTTPRedirectHandler):
+
+    def redirect_request(self,req,fp,code,msg,headers,newurl):
+
+        if not allowed(newurl): 
+            raise urllib2.HTTPError(newurl,code,'Redirect to unsupported URL scheme',headers,fp)
+        return urllib2.HTTPRedirectHandler.redirect_request(self,req,fp,code,msg,headers,newurl)
+
+##############################################################################
+
+def cache_key(url,version):
+
+    import hashlib
+    return hashlib.sha1(url+'\n'+version).hexdigest()
+
+# file name from Content-Disposition header, or ''
+
+def disposition(header):
+
+    import os,re
+    if not header: return ''
+    names=re.findall('filename=(.+)',header)
+    if not names: return ''
+    name=names[0].split(';')[0].replace('"','').replace(':','_').strip()
+    return os.path.basename(name)
+
+def url_name(url):
+
+    import os,urlparse
+    name=os.path.basename(urlparse.urlparse(url).path)
+    return name or 'index.html'
+
+def remove(path):
+
+    import os
+    try:
+        os.chmod(path,0o644)
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,369 @@
+
+# IDL job executors for the Python-IDL bridge server
+
+# IDL jobs (execute, batch and get requests) are run off the server event
+# loop by one of two executors with the same interface:
+
+# IDLThread  - single IDL session in a thread of the server process
+# WorkerPool - pool of worker processes, each with its own bridge.startup()
+#              IDL session, for serving several clients at once
+
+# Sessions are started by the startup function of the backend module:
+# bridge, or fakeidl to run without IDL (see start_session).
+
+# submit(job,callback,owner) queues a job and returns False if the queue is
+# full. callback(reply) is called on the event loop when the job is done.
+# Jobs submitted before the IDL sessions have started wait for them. 
+# sessions() returns (number of sessions ready,total), and on_ready is
+# called on the loop each time a session becomes ready. timings holds the
+# startup phase timings (see bridge.startup) of the last session started.
+# pending() returns (number of jobs queued,number running). If metrics is
+# set, the time jobs wait in the queue and run in IDL is recorded in it,
+# as is the time spent in IDL statements other than the commands themselves
+# (overhead, see server.execute).
+
+# IDL variables live in a session, so each owner (client connection) of a
+# WorkerPool is pinned to one worker for its lifetime: all its jobs run in
+# that worker's session, in order, and a run('a=1') is seen by a later
+# get('a'). Owners are pinned to the worker with fewest owners when their
+# first job starts. Only stateless jobs (job['stateless'] set, for
+# idempotent commands; see server.submit) and jobs without an owner run on
+# whichever worker is free. If a worker dies, its owners are pinned anew.
+
+# Example:
+# >>> import server
+# >>> server.start(workers=4,queue=100)
+
+import collections
+
+class WorkerPool(object):
+
+    def __init__(self,size,loop,queue_size=100,warm=False,backend=None):
+        self.size=size
+        self.loop=loop
+        self.queue_size=queue_size
+        self.warm=warm
+        self.backend=backend
+        self.queue=collections.deque()
+        self.workers={}               # pipe connection -> worker process
+        self.free=[]                  # pipe connections of idle workers
+        self.jobs={}                  # pipe connection -> (job,callback,owner) running
+        self.ready=set()              # pipe connections of started workers
+        self.pins={}                  # owner -> pipe connection of its worker
+        self.timings=[]
+        self.on_ready=None
+        self.metrics=None
+        for i in range(size): self.spawn()
+
+###############################################################################
+# start a worker process
+
+    def spawn(self):
+
+        import multiprocessing
+        import config
+        conn,child_conn=multiprocessing.Pipe()
+
+# sockets of every server in this process, not only this pool's own
+
+        inherited=set(self.loop.handlers.keys())
+        for server in config.servers.values(): inherited.update(server.loop.handlers.keys())
+        inherited=list(inherited)
+        proc=multiprocessing.Process(target=worker,args=(child_conn,inherited,self.warm,self.backend))
+        proc.daemon=True
+        proc.start()
+        child_conn.close()
+        self.workers[conn]=proc
+        self.free.append(conn)
+        self.loop.register(conn,PipeHandler(self,conn))
+        print("Started IDL worker process: "+str(proc.pid))
+
+###############################################################################
+# submit job. Returns False if the queue is full.
+
+    def submit(self,job,callback,owner=None):
+
+        import time
+        item=(job,callback,owner,time.time())
+        for conn in sorted(self.free,key=self.load):
+            if self.runs_on(item,conn):
+                self.free.remove(conn)
+                self.dispatch(conn,item)
+                return True
+        if len(self.queue) >= self.queue_size: return False
+        self.queue.append(item)
+        return True
+
+# check if job item may run on worker conn, pinning its owner there if
+# not yet pinned
+
+    def runs_on(self,item,conn):
+
+        job,callback,owner=item[:3]
+        if owner is None or job.get('stateless'): return True
+        pinned=self.pins.get(owner)
+        if pinned is None:
+            if [c for c in self.free if self.load(c) < self.load(conn)]: return False
+            self.pins[owner]=conn
+            return True
+        return pinned is conn
+
+# number of owners pinned to worker conn
+
+    def load(self,conn):
+
+        return len([c for c in self.pins.values() if c is conn])
+
+    def dispatch(self,conn,item):
+
+        import time
+        now=time.time()
+        if self.metrics: self.metrics.observe('queue',now-item[3])
+        self.jobs[conn]=item+(now,)
+        conn.send(item[0])
+
+    def sessions(self):
+
+        return (len(self.ready),len(self.workers))
+
+    def pending(self):
+
+        return (len(self.queue),len(self.jobs))
+
+###############################################################################
+# read reply from worker whose pipe is ready and start next queued job on
+# it. A worker that died is replaced and its job fails with an error reply.
+# The first message from a worker reports that its IDL session started.
+
+    def collect(self,conn):
+
+        try:
+            reply=conn.recv()
+        except (EOFError,IOError):
+            reply=None
+        if type(reply) == dict and 'ready' in reply:
+            if reply['ready']: self.ready.add(conn)
+            self.timings=reply['timings']
+            if self.on_ready: self.on_ready()
+            return
+        item=self.jobs.pop(conn,None)
+        if reply is not None:
+            overhead=reply['overhead']
+            reply=reply['reply']
+        if item and self.metrics:
+            import time
+            self.metrics.observe('idl',time.time()-item[4])
+            if reply is not None: self.metrics.observe('overhead',overhead)
+        if reply is None:
+            proc=self.workers.pop(conn)
+            print("IDL worker process "+str(proc.pid)+" died. Restarting.")
+            self.loop.unregister(conn)
+            self.free=[c for c in self.free if c is not conn]
+            self.ready.discard(conn)
+            self.pins=dict([(o,c) for o,c in self.pins.items() if c is not conn])
+            conn.close()
+            if item: reply=failed(item[0],'IDL worker process died.')
+            self.spawn()
+            conn=self.free.pop()
+        self.free.append(conn)
+        self.start_queued()
+        if item: item[1](reply)
+
+# start queued jobs on free workers they may run on, oldest first
+
+    def start_queued(self):
+
+        for queued in list(self.queue):
+            if not self.free: return
+            for conn in sorted(self.free,key=self.load):
+                if self.runs_on(queued,conn):
+                    self.queue.remove(queued)
+                    self.free.remove(conn)
+                    self.dispatch(conn,queued)
+                    break
+
+###############################################################################
+# drop queued jobs of owner (e.g. client disconnected), and its pin
+
+    def cancel(self,owner):
+
+        self.queue=collections.deque([q for q in self.queue if q[2] is not owner])
+        self.pins.pop(owner,None)
+
+###############################################################################
+# stop worker processes
+
+    def close(self):
+
+        for conn in self.workers:
+            self.loop.unregister(conn)
+            try:
+                conn.send(None)
+            except (IOError,OSError):
+                pass
+        for conn,proc in self.workers.items():
+            proc.join(5)
+            if proc.is_alive(): proc.terminate()
+            conn.close()
+        self.workers={}
+        self.free=[]
+        self.jobs={}
+        self.pins={}
+        self.ready.clear()
+        self.queue.clear()
+
+class PipeHandler(object):
+
+    def __init__(self,pool,conn):
+        self.pool=pool
+        self.conn=conn
+
+    def on_readable(self):
+        self.pool.collect(self.conn)
+
+##############################################################################
+# single IDL session running jobs in order in a thread of the server. The
+# session is started in that thread, which then owns it.
+
+class IDLThread(object):
+
+    def __init__(self,loop,queue_size=100,warm=False,backend=None):
+
+        import threading
+        self.loop=loop
+        self.queue_size=queue_size
+        self.warm=warm
+        self.backend=backend
+        self.started=False
+        self.timings=[]
+        self.on_ready=None
+        self.metrics=None
+        self.running=0
+        self.queue=collections.deque()
+        self.cond=threading.Condition()
+        self.stopped=False
+        self.thread=threading.Thread(target=self.main)
+        self.thread.daemon=True
+        self.thread.start()
+
+    def submit(self,job,callback,owner=None):
+
+        import time
+        with self.cond:
+            if len(self.queue) >= self.queue_size: return False
+            self.queue.append((job,callback,owner,time.time()))
+            self.cond.notify()
+        return True
+
+    def sessions(self):
+
+        return (int(self.started),1)
+
+    def pending(self):
+
+        return (len(self.queue),self.running)
+
+    def set_ready(self,started,timings):
+
+        self.started=started
+        self.timings=timings
+        if self.on_ready: self.on_ready()
+
+    def cancel(self,owner):
+
+        with self.cond:
+            self.queue=collections.deque([q for q in self.queue if q[2] is not owner])
+
+    def close(self):
+
+        with self.cond:
+            self.stopped=True
+            self.queue.clear()
+            self.cond.notify()
+        self.thread.join(5)
+
+    def main(self):
+
+        import time
+        import server
+        IDL,timings=start_session(self.backend,self.warm)
+        self.loop.call_soon_threadsafe(self.set_ready,IDL is not None,timings)
+        while True:
+            with self.cond:
+                while not self.queue and not self.stopped: self.cond.wait()
+                if self.stopped: break
+                job,callback,owner,queued=self.queue.popleft()
+                self.running=1
+            tstart=time.time()
+            if self.metrics: self.metrics.observe('queue',tstart-queued)
+            if IDL is None:
+                reply=failed(job,'IDL session failed to start.')
+            else:
+                try:
+                    reply=server.run_job(IDL,job)
+                except Exception as e:
+                    reply=failed(job,str(e))
+            if self.metrics: 
+                self.metrics.observe('idl',time.time()-tstart)
+                self.metrics.observe('overhead',server.last_overhead())
+            self.running=0
+            self.loop.call_soon_threadsafe(callback,reply)
+        if IDL is not None: IDL.run(".reset")
+
+##############################################################################
+# start IDL session with backend, given as (module name,startup options);
+# bridge if None. Returns (IDL object or None,startup phase timings).
+
+def start_session(backend=None,warm=False):
+
+    name,options='bridge',{}
+    if backend: name,options=backend
+    try:
+        module=__import__(name)
+        IDL=module.startup(warm=warm,**options)
+    except Exception as e:
+        print("Failed to start IDL session: "+str(e))
+        return (None,[])
+    return (IDL,list(getattr(module,'timings',[])))
+
+##############################################################################
+# reply for job that could not be run
+
+def failed(job,error):
+
+    if job['action'] == 'batch': return ([],error)
+    return ('',error)
+
+##############################################################################
+# worker process main loop: start IDL session, report that it started and 
+# run jobs until sent None. Replies are sent with the job's IDL overhead.
+# Server sockets inherited from the parent are closed first, so that 
+# clients see their connections close when the server closes them.
+
+def worker(conn,inherited=[],warm=False,backend=None):
+
+    import os
+    import server
+    for fd in inherited:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+    IDL,timings=start_session(backend,warm)
+    conn.send({'ready':IDL is not None,'timings':timings})
+    while True:
+        try:
+            job=conn.recv()
+        except (EOFError,IOError):
+            break
+        if job is None: break
+        if IDL is None:
+            reply=failed(job,'IDL session failed to start.')
+        else:
+            try:
+                reply=server.run_job(IDL,job)
+            except Exception as e:
+                reply=failed(job,str(e))
+        conn.send({'reply':reply,'overhead':server.last_overhead()})
+    if IDL is not None: IDL.run(".reset")
+    conn.close()